@@ -1,6 +1,7 @@
 from . import crate
 from . import dockerfile
 from . import hipaacrates
+from . import lockfile
 from . import services
 from . import version
 
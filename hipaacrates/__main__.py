@@ -1,25 +1,143 @@
+import json
+
 import click
 
 from . import bundles
+from . import cache as bundle_cache
+from . import context as build_context
 from . import crate
 from . import dockerfile
+from . import hashing
 from . import hipaacrates
+from . import locking
+from . import ordering
+from . import server
 from . import services
+from . import transport
 from . import version
 
 @click.group()
 @click.option("--hipaacrates-file", envvar="HIPAACRATES_FILE", metavar="FILE", default=hipaacrates.HIPAACRATE_FILENAME)
 @click.option("--bundles-host", envvar="HIPAACRATES_BUNDLES_HOST", metavar="HOST", default="")
+@click.option("--bundles-mirror", "bundles_mirrors", envvar="HIPAACRATES_BUNDLES_MIRRORS", metavar="HOST", multiple=True,
+              help="Another host serving the same bundles; may be repeated")
+@click.option("--bundles-jobs", envvar="HIPAACRATES_BUNDLES_JOBS", metavar="N", type=click.IntRange(min=1),
+              default=bundles.HIPAACRATE_BUNDLES_MAX_WORKERS, help="Maximum concurrent bundle downloads")
+@click.option("--bundles-timeout", envvar="HIPAACRATES_BUNDLES_TIMEOUT", metavar="SECONDS", type=float,
+              default=bundles.HIPAACRATE_BUNDLES_TIMEOUT, help="Read timeout for each bundle request")
+@click.option("--bundles-connect-timeout", envvar="HIPAACRATES_BUNDLES_CONNECT_TIMEOUT", metavar="SECONDS", type=float,
+              default=transport.TRANSPORT_CONNECT_TIMEOUT, help="Timeout for connecting to a bundle host")
+@click.option("--bundles-retries", envvar="HIPAACRATES_BUNDLES_RETRIES", metavar="N", type=click.IntRange(min=0),
+              default=transport.TRANSPORT_RETRIES, help="Retries of a failed bundle request, across hosts")
+@click.option("--cache-max-size", envvar="HIPAACRATES_CACHE_MAX_SIZE", metavar="SIZE",
+              default=str(bundle_cache.HIPAACRATE_STORE_MAX_SIZE), help="Size cap of the bundle cache, e.g. 100M")
+@click.option("--order", envvar="HIPAACRATES_ORDER", type=click.Choice(ordering.ORDERINGS), default="name",
+              help="How to order bundles that do not depend on each other")
+@click.option("--lock-timeout", envvar="HIPAACRATES_LOCK_TIMEOUT", metavar="SECONDS", type=click.FloatRange(min=0),
+              default=locking.LOCK_TIMEOUT, help="How long to wait for another crater using the Hipaacrate")
+@click.option("--lock-stats", envvar="HIPAACRATES_LOCK_STATS", is_flag=True,
+              help="Report time spent waiting for the Hipaacrate lock on stderr")
 @click.version_option(version.__version__, prog_name="crater")
 @click.pass_context
-def crater(ctx, hipaacrates_file, bundles_host):
-    repo = bundles.BundleRepository(bundles_host)
-    ctx.obj = hipaacrates.Hipaacrates(repo, hipaacrates_file)
+def crater(ctx, hipaacrates_file, bundles_host, bundles_mirrors, bundles_jobs, bundles_timeout,
+           bundles_connect_timeout, bundles_retries, cache_max_size, order, lock_timeout, lock_stats):
+    try:
+        max_size = bundle_cache.parse_size(cache_max_size)
+    except ValueError as e:
+        ctx.fail(str(e))
+    repo = bundles.BundleRepository(bundles_host, max_workers=bundles_jobs, timeout=bundles_timeout,
+                                    cache_max_size=max_size, mirrors=bundles_mirrors,
+                                    connect_timeout=bundles_connect_timeout, retries=bundles_retries)
+    changes = repo.store.change_counts() if order == "history" else None
+    ctx.obj = hipaacrates.Hipaacrates(repo, hipaacrates_file, order=ordering.new(order, changes),
+                                      lock_timeout=lock_timeout)
+    if lock_stats:
+        ctx.call_on_close(lambda: _echo_lock_stats(ctx.obj.lock_stats))
+
+def _echo_lock_stats(stats: locking.LockStats) -> None:
+    s = stats.to_dict()
+    click.echo("lock: {} acquired, {} contended, {} timed out, {:.3f}s waited (max {:.3f}s)".format(
+        s["acquired"], s["contended"], s["timeouts"], s["wait_time"], s["max_wait"]), err=True)
+
+_RENDER_OPTIONS = [
+    click.option("--optimize", is_flag=True, help="Merge RUN steps to produce fewer layers"),
+    click.option("--collapse-scripts", is_flag=True, help="Copy all service scripts in one layer (implies --optimize)"),
+    click.option("--dedupe", is_flag=True, help="Skip package installs an earlier bundle already ran"),
+    click.option("--coalesce", is_flag=True, help="Merge the apt and pip installs of bundles at the same level"),
+    click.option("--buildkit", is_flag=True, help="Use BuildKit cache mounts and COPY --link"),
+]
+
+def render_options(command):
+    for option in reversed(_RENDER_OPTIONS):
+        command = option(command)
+    return command
+
+@crater.command()
+@click.option("--force", is_flag=True, help="Rebuild even if no input changed")
+@render_options
+@click.pass_context
+def build(ctx, force, **render):
+    options = dockerfile.RenderOptions(**render)
+    for path in ctx.obj.build_dockerfile(force=force, options=options):
+        click.echo("changed {}".format(path))
+
+@crater.command()
+@click.option("-o", "--output", "output_file", type=click.File("wb"), default="-",
+              help="Write the tar to a file instead of stdout")
+@render_options
+@click.pass_context
+def context(ctx, output_file, **render):
+    """Stream the build context as a tar, e.g. for docker build -"""
+    options = dockerfile.RenderOptions(**render)
+    try:
+        digest = ctx.obj.write_context(output_file, options=options)
+    except build_context.ContextError as e:
+        ctx.fail(str(e))
+    click.echo("sha256:{}".format(digest), err=True)
+
+@crater.command("hash")
+@click.option("-j", "--jobs", type=click.IntRange(min=1), default=hashing.HASHING_MAX_WORKERS,
+              help="Number of files to hash concurrently")
+@click.option("--json", "as_json", is_flag=True, help="Print the keys as JSON")
+@render_options
+@click.pass_context
+def hash_(ctx, jobs, as_json, **render):
+    """Print content keys of the bundles' included files and of the image"""
+    options = dockerfile.RenderOptions(**render)
+    try:
+        keys = ctx.obj.content_keys(options=options, max_workers=jobs)
+    except build_context.ContextError as e:
+        ctx.fail(str(e))
+    if as_json:
+        click.echo(json.dumps(keys.to_dict(), indent=2))
+        return
+    for name, key in keys.bundles.items():
+        click.echo("{} {}".format(key, name))
+    click.echo("{} (image)".format(keys.image))
+
+@crater.command()
+@click.pass_context
+def lock(ctx):
+    ctx.obj.lock_dependencies()
 
 @crater.command()
+@click.option("--refresh", is_flag=True, help="Only download bundles that changed since they were cached")
 @click.pass_context
-def build(ctx):
-    ctx.obj.build_dockerfile()
+def fetch(ctx, refresh):
+    ctx.obj.fetch_bundles(refresh=refresh)
+
+@crater.command()
+@click.option("--no-prefetch", is_flag=True, help="Only update the index, without downloading changed bundles")
+@click.pass_context
+def sync(ctx, no_prefetch):
+    """Update the local copy of the repository index"""
+    repo = ctx.obj.bundle_repo
+    changed, removed = repo.sync(prefetch=not no_prefetch)
+    for entry in changed:
+        click.echo("updated {}".format(entry))
+    for name in removed:
+        click.echo("removed {}".format(name))
+    click.echo("revision {}: {} bundles".format(repo.repository_index.revision, len(repo.repository_index)))
 
 @crater.command()
 @click.argument("bundles", nargs=-1, metavar="BUNDLE [BUNDLE]...")
@@ -38,6 +156,33 @@ def include(ctx, files):
     ctx.obj.include_files(*files)
 
 
+@crater.group()
+def cache():
+    """Inspect and trim the bundle cache"""
+
+@cache.command()
+@click.pass_context
+def stats(ctx):
+    s = ctx.obj.bundle_repo.store.stats()
+    click.echo("objects: {}".format(s["objects"]))
+    click.echo("names: {}".format(s["names"]))
+    click.echo("size: {}".format(s["size"]))
+    click.echo("max_size: {}".format(s["max_size"]))
+
+@cache.command()
+@click.option("--max-size", metavar="SIZE", help="Trim to this size instead of the configured cap")
+@click.pass_context
+def gc(ctx, max_size):
+    if max_size is not None:
+        try:
+            max_size = bundle_cache.parse_size(max_size)
+        except ValueError as e:
+            ctx.fail(str(e))
+    removed = ctx.obj.bundle_repo.gc(max_size)
+    for entry in removed:
+        click.echo("removed {}:{} ({})".format(entry["name"], entry["version"], entry["digest"]))
+    click.echo("{} objects, {} bytes freed".format(len(removed), sum(entry["size"] for entry in removed)))
+
 @crater.command()
 @click.option("-n", "--name", prompt=True, help="Crate name", metavar="NAME")
 @click.option("-v", "--version", prompt=True, help="Crate version", metavar="VERSION")
@@ -62,12 +207,32 @@ def remove(ctx, bundles):
     ctx.obj.remove_bundles(*bundles)
 
 @crater.command()
-@click.argument("key", type=click.Choice(["author", "name", "run_command", "version"]))
+@click.argument("key", type=click.Choice(hipaacrates.SETTABLE_KEYS))
 @click.argument("value")
 @click.pass_context
 def set(ctx, key, value):
     ctx.obj.set_value(key, value)
 
+@crater.command()
+@click.argument("operations", type=click.File("r"), default="-")
+@click.pass_context
+def apply(ctx, operations):
+    """
+    Apply crater edits from a file or stdin, one per line, e.g. "add foo" or "set version 1.0"
+
+    All edits are applied under one lock and saved together; if any fails, none are saved.
+    """
+    try:
+        parsed = hipaacrates.parse_operations(operations.read())
+    except ValueError as e:
+        ctx.fail(str(e))
+    with ctx.obj.transaction() as txn:
+        for number, words in parsed:
+            try:
+                txn.apply(*words)
+            except ValueError as e:
+                ctx.fail("line {}: {}".format(number, e))
+
 @crater.command()
 @click.argument("key", type=click.Choice(["author", "build_steps", "bundles", "includes", "name", "run_command", "version"]))
 @click.pass_context
@@ -80,6 +245,22 @@ def show(ctx, key) -> None:
     else:
         click.echo("{}: {}".format(key, v))
 
+@crater.command()
+@click.argument("directory", type=click.Path(exists=True, file_okay=False), default=bundles.HIPAACRATE_BUNDLES_CACHE_DIR)
+@click.option("-b", "--bind", metavar="ADDRESS", default=server.SERVER_ADDRESS[0], help="Address to listen on")
+@click.option("-p", "--port", type=click.IntRange(min=0, max=65535), default=server.SERVER_ADDRESS[1],
+              help="Port to listen on")
+def serve(directory, bind, port):
+    """Serve a directory of bundles, by default the bundle cache, to other craters"""
+    httpd = server.BundleServer(directory, (bind, port))
+    click.echo("serving {} on http://{}:{}".format(directory, *httpd.server_address[:2]), err=True)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
 if __name__ == '__main__':
     # arguments aren't needed due to Click.
     # pylint: disable=E1120
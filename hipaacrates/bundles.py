@@ -1,56 +1,211 @@
 from abc import ABC, abstractmethod
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+import json
 import os
 
+from filelock import FileLock, Timeout
 import requests
-from typing import Dict, Iterable, List
-from typing_extensions import Protocol
+from requests.adapters import HTTPAdapter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from typing_extensions import Protocol, runtime_checkable
 
+from . import cache
 from . import crate
+from . import index
+from . import transport
+from . import versions
+from .ordering import NameOrder, OrderingPolicy
+from .output import write_atomic
 
 HIPAACRATE_BUNDLES_ENDPOINT = "/bundles"
+HIPAACRATE_BUNDLES_BATCH_ROUTE = ":batch"
+HIPAACRATE_BUNDLES_INDEX_ROUTE = ":index"
+HIPAACRATE_BUNDLES_BATCH_SIZE = 100
 HIPAACRATE_BUNDLES_CACHE_DIR = "hipaacrate_bundles"
+HIPAACRATE_BUNDLES_MAX_WORKERS = 8
+HIPAACRATE_BUNDLES_TIMEOUT = 30.0
+HIPAACRATE_BUNDLES_VALIDATORS_SUFFIX = ".http"
+HIPAACRATE_BUNDLES_LOCK_DIR = ".locks"
+# How long to wait for another process downloading the same bundle before downloading it anyway
+HIPAACRATE_BUNDLES_FETCH_LOCK_TIMEOUT = 300.0
+
+# Statuses that mean the server has no batch route
+_BATCH_UNSUPPORTED = (404, 405, 501)
+
+def bundle_name(reference: str) -> str:
+    """
+    Strip the version from a ``name:version`` bundle reference
+    """
+    return reference.split(":")[0]
 
 class BundleLoader(Protocol):
     def load(self, name: str) -> crate.Crate:
         ...
 
-def load_dependencies(origin: crate.Crate, loader: BundleLoader) -> List[crate.Crate]:
+@runtime_checkable
+class VersionedBundleLoader(Protocol):
+    def load(self, name: str) -> crate.Crate:
+        ...
+
+    def load_version(self, name: str, version: str) -> crate.Crate:
+        ...
+
+    def versions(self, name: str) -> List[str]:
+        ...
+
+    def dependencies(self, name: str, version: str) -> List[str]:
+        ...
+
+def load_dependencies(origin: crate.Crate, loader: BundleLoader,
+                      cache: Dict[str, crate.Crate] = None) -> List[crate.Crate]:
+    """
+    Load every transitive dependency of a Crate, in depth-first discovery order
+
+    If the loader knows several versions of each bundle, a version of every
+    bundle is first chosen to satisfy the version constraints of the
+    ``name:constraint`` references, raising ResolutionError if none does.
+    Otherwise the loader's only copy of each bundle is used. Each bundle is
+    loaded once; loaded Crates are kept in ``cache`` (keyed by bundle name)
+    so that repeated calls can share them.
+    """
+    if cache is None:
+        cache = {}
+    chosen: Dict[str, str] = {}
+    load = loader.load
+    if isinstance(loader, VersionedBundleLoader):
+        chosen = versions.Resolver(loader).resolve(origin.bundles, origin.name)
+        load = lambda name: loader.load_version(name, chosen[name])
+
     crates: Dict[str, crate.Crate] = OrderedDict()
-    for dep in origin.bundles:
-        dep_info = dep.split(":")
-        c = loader.load(dep_info[0])
-        crates[c.name] = c
-        transitive_deps = load_dependencies(c, loader)
-        for td in transitive_deps:
-            crates[td.name] = td
+    seen = set()
+    stack = [bundle_name(dep) for dep in reversed(origin.bundles)]
+    while stack:
+        name = stack.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+
+        c = cache.get(name)
+        if c is None or (chosen and c.version != chosen[name]):
+            c = load(name)
+            cache[name] = c
+        crates.setdefault(c.name, c)
+        stack.extend(bundle_name(dep) for dep in reversed(c.bundles) if bundle_name(dep) not in seen)
     return list(crates.values())
 
-def resolve_dependencies(origin: crate.Crate, dependencies: Iterable[crate.Crate]) -> List[crate.Crate]:
-    crates = list(dependencies) + [origin]
+def resolve_dependencies(origin: crate.Crate, dependencies: Iterable[crate.Crate],
+                         order: OrderingPolicy = None) -> List[crate.Crate]:
+    """
+    Order a Crate and its dependencies so that every bundle follows the bundles it depends on
+
+    Bundles are emitted level by level, each level sorted by ``order``, which
+    defaults to sorting by name.
+    """
+    resolved: List[crate.Crate] = []
+    for level in _resolve_levels(origin, dependencies, order):
+        resolved.extend(level)
+    return resolved
+
+def index_closure(repository_index: index.RepositoryIndex, references: Iterable[str]) -> List[index.IndexEntry]:
+    """
+    Find the index entries of bundles and everything they depend on, in breadth-first discovery order
+
+    Raises UnknownBundleError if any of them is not in the index.
+    """
+    found: Dict[str, index.IndexEntry] = OrderedDict()
+    level = list(OrderedDict.fromkeys(bundle_name(ref) for ref in references))
+    while level:
+        for name in level:
+            entry = repository_index.get(name)
+            if entry is None:
+                raise index.UnknownBundleError(name)
+            found[name] = entry
+        next_level: Dict[str, None] = OrderedDict()
+        for name in level:
+            for dep in found[name].bundles:
+                dep_name = bundle_name(dep)
+                if dep_name not in found:
+                    next_level[dep_name] = None
+        level = list(next_level)
+    return list(found.values())
+
+def group_levels(resolved: Iterable[crate.Crate]) -> List[List[crate.Crate]]:
+    """
+    Split Crates that are already in build order into topological levels
 
-    resolved = []
+    A Crate's level is one more than the highest level of the bundles it
+    depends on; the order of Crates within a level is kept.
+    """
+    depth: Dict[str, int] = {}
+    levels: List[List[crate.Crate]] = []
+    for c in resolved:
+        d = max((depth[n] + 1 for n in (bundle_name(b) for b in c.bundles) if n in depth), default=0)
+        depth[c.name] = d
+        while len(levels) <= d:
+            levels.append([])
+        levels[d].append(c)
+    return levels
+
+def _resolve_levels(origin: crate.Crate, dependencies: Iterable[crate.Crate],
+                    order: OrderingPolicy = None) -> List[List[crate.Crate]]:
+    if order is None:
+        order = NameOrder()
+    crates = list(dependencies) + [origin]
     name_to_instance = dict((c.name, c) for c in crates)
-    name_to_deps = dict((c.name, set([b.split(":")[0] for b in c.bundles])) for c in crates)
 
-    while name_to_deps:
-        ready = {name for name, deps in name_to_deps.items() if not deps}
+    # Kahn's algorithm: count the unresolved dependencies of each bundle and
+    # index which bundles depend on it, so each edge is visited once.
+    indegree: Dict[str, int] = {}
+    dependents: Dict[str, List[str]] = dict((name, []) for name in name_to_instance)
+    for name, c in name_to_instance.items():
+        deps = set(bundle_name(b) for b in c.bundles)
+        for dep in deps:
+            if dep not in dependents:
+                raise ValueError("bundle {} depends on {}, which was not loaded".format(name, dep))
+            dependents[dep].append(name)
+        indegree[name] = len(deps)
 
-        if not ready:
-            raise ValueError("Circular dependencies found!")
-        
+    levels = []
+    ready = [name for name, count in indegree.items() if count == 0]
+    while ready:
+        level = order.sort(name_to_instance[name] for name in ready)
+        levels.append(level)
+        ready = [c.name for c in level]
+        next_ready = []
         for name in ready:
-            del name_to_deps[name]
-        for deps in name_to_deps.values():
-            deps.difference_update(ready)
-        
-        resolved.extend([name_to_instance[name] for name in sorted(ready)])
-    
-    return resolved
+            del indegree[name]
+            for dependent in dependents[name]:
+                indegree[dependent] -= 1
+                if indegree[dependent] == 0:
+                    next_ready.append(dependent)
+        ready = next_ready
+
+    if indegree:
+        raise CircularDependencyError(_find_cycle(indegree, name_to_instance))
+    return levels
+
+def _find_cycle(unresolved: Dict[str, int], name_to_instance: Dict[str, crate.Crate]) -> List[str]:
+    # Every unresolved bundle still depends on another unresolved bundle, so
+    # following those edges from any of them must eventually revisit one.
+    path: List[str] = []
+    position: Dict[str, int] = {}
+    name = min(unresolved)
+    while name not in position:
+        position[name] = len(path)
+        path.append(name)
+        name = min(bundle_name(b) for b in name_to_instance[name].bundles if bundle_name(b) in unresolved)
+    return path[position[name]:] + [name]
 
 class BundleRepository(object):
     def __init__(self, host: str, endpoint: str = HIPAACRATE_BUNDLES_ENDPOINT,
-                 cache_dir: str = HIPAACRATE_BUNDLES_CACHE_DIR) -> None:
+                 cache_dir: str = HIPAACRATE_BUNDLES_CACHE_DIR, max_workers: int = HIPAACRATE_BUNDLES_MAX_WORKERS,
+                 timeout: float = HIPAACRATE_BUNDLES_TIMEOUT,
+                 cache_max_size: Optional[int] = cache.HIPAACRATE_STORE_MAX_SIZE,
+                 batch_size: int = HIPAACRATE_BUNDLES_BATCH_SIZE, mirrors: Iterable[str] = (),
+                 connect_timeout: float = transport.TRANSPORT_CONNECT_TIMEOUT,
+                 retries: int = transport.TRANSPORT_RETRIES) -> None:
         if host.endswith("/"):
             host = host[:-1]
         if endpoint.endswith("/"):
@@ -61,6 +216,19 @@ class BundleRepository(object):
         self._host = host
         self._endpoint = endpoint
         self.cache_dir = cache_dir
+        self.cache_max_size = cache_max_size
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.mirrors = [mirror.rstrip("/") for mirror in mirrors]
+        self.batch_size = batch_size
+        self.batch_supported: Optional[bool] = None if batch_size > 0 else False
+        self._session: requests.Session = None
+        self._transport: transport.Transport = None
+        self._store: cache.BundleStore = None
+        self._index: index.RepositoryIndex = None
+        self._index_path: str = None
     
     @property
     def host(self) -> str:
@@ -71,6 +239,7 @@ class BundleRepository(object):
         if value.endswith("/"):
             value = value[:-1]
         self._host = value
+        self._transport = None
     
     @property
     def endpoint(self) -> str:
@@ -84,18 +253,398 @@ class BundleRepository(object):
             value = "/{}".format(value)
         self._endpoint = value
     
+    @property
+    def session(self) -> requests.Session:
+        """
+        The HTTP session shared by every download, with a connection pool
+        large enough for ``max_workers`` concurrent requests
+        """
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    @property
+    def transport(self) -> transport.Transport:
+        """
+        Sends every request to the best of ``host`` and ``mirrors``, with retries
+
+        The health and latency of each host is kept for the life of the repository.
+        """
+        if self._transport is None:
+            hosts = transport.HostPool([self.host] + self.mirrors)
+            self._transport = transport.Transport(self.session, hosts, self.retries)
+        return self._transport
+
+    @property
+    def store(self) -> cache.BundleStore:
+        """
+        The content-addressed store that keeps every version of the cached bundles
+        """
+        root = os.path.join(self.cache_dir, cache.HIPAACRATE_STORE_DIR)
+        if self._store is None or self._store.root != root:
+            self._store = cache.BundleStore(root, self.cache_max_size, copies=self.cache_dir)
+        self._store.max_size = self.cache_max_size
+        return self._store
+
+    @property
+    def repository_index(self) -> index.RepositoryIndex:
+        """
+        The local copy of the repository index, as of the last ``sync``
+        """
+        path = os.path.join(self.cache_dir, index.INDEX_FILENAME)
+        if self._index is None or self._index_path != path:
+            self._index = index.read(path)
+            self._index_path = path
+        return self._index
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+            self._transport = None
+
     def download(self, name: str, save_to_disk: bool = False) -> crate.Crate:
-        r = requests.get("{}{}/{}".format(self.host, self.endpoint, name))
+        """
+        Download a bundle, saving it to the cache if ``save_to_disk`` is set
+
+        Saving downloads are single-flight across the processes sharing a
+        cache: while one process downloads a bundle, the others wait and then
+        load the copy it saved.
+        """
+        with self._single_flight([name] if save_to_disk else []) as saved:
+            if name in saved:
+                return self.load(name)
+            r = self._request("GET", self._path(name))
+            r.raise_for_status()
+            c = crate.parse(r.text)
+            if save_to_disk:
+                self._save(c, _validators(r.headers))
+            return c
+
+    def refresh(self, name: str) -> crate.Crate:
+        """
+        Revalidate a cached bundle with a conditional GET
+
+        The ETag and Last-Modified headers of the last download are stored next
+        to the cached bundle. If the server answers 304 Not Modified the cached
+        copy is used; otherwise the new bundle is saved to disk. Like saving
+        downloads, refreshes are single-flight across processes.
+        """
+        with self._single_flight([name]) as saved:
+            if name in saved:
+                return self.load(name)
+            headers = {}
+            if os.path.isfile(os.path.join(self.cache_dir, name)):
+                validators = self._read_validators(name)
+                if "etag" in validators:
+                    headers["If-None-Match"] = validators["etag"]
+                if "last_modified" in validators:
+                    headers["If-Modified-Since"] = validators["last_modified"]
+
+            r = self._request("GET", self._path(name), headers=headers)
+            if r.status_code == requests.codes.not_modified and headers:
+                return self.load(name)
+            r.raise_for_status()
+            c = crate.parse(r.text)
+            self._save(c, _validators(r.headers))
+            return c
+
+    def download_many(self, names: Iterable[str], save_to_disk: bool = False,
+                      refresh: bool = False) -> List[crate.Crate]:
+        """
+        Download several bundles concurrently, returning them in the order requested
+
+        With ``refresh``, cached bundles are revalidated with ``refresh`` instead
+        of being downloaded unconditionally.
+        """
+        if refresh:
+            fetch = self.refresh
+        else:
+            fetch = lambda name: self.download(name, save_to_disk)
+
+        names = list(OrderedDict.fromkeys(names))
+        workers = min(self.max_workers, len(names))
+        if workers <= 1:
+            return [fetch(name) for name in names]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(fetch, names))
+
+    def download_batch(self, names: Iterable[str], save_to_disk: bool = False,
+                       refresh: bool = False) -> List[crate.Crate]:
+        """
+        Download several bundles with one request per ``batch_size`` bundles, returning them in the order requested
+
+        Bundles are posted to the batch route, ``{endpoint}:batch``. Bundles
+        the server does not return, or every bundle if the server has no batch
+        route, are downloaded with ``download_many`` instead. With ``refresh``,
+        the ETags of cached bundles are sent along and bundles the server
+        reports as not modified are loaded from the cache.
+        """
+        names = list(OrderedDict.fromkeys(names))
+        fetched: Dict[str, crate.Crate] = {}
+        if self.batch_supported is not False:
+            for start in range(0, len(names), self.batch_size):
+                batch = self._post_batch(names[start:start + self.batch_size], save_to_disk or refresh, refresh)
+                if batch is None:
+                    break
+                fetched.update(batch)
+
+        remaining = [name for name in names if name not in fetched]
+        for name, c in zip(remaining, self.download_many(remaining, save_to_disk, refresh)):
+            fetched[name] = c
+        return [fetched[name] for name in names]
+
+    def sync(self, prefetch: bool = True) -> Tuple[List[index.IndexEntry], List[str]]:
+        """
+        Update the local repository index, returning the entries that changed and the names removed
+
+        Only the entries changed since the last sync are transferred. With
+        ``prefetch``, changed bundles that are not already cached are
+        downloaded in the same pass.
+        """
+        local = self.repository_index
+        r = self._request("GET", self.endpoint + HIPAACRATE_BUNDLES_INDEX_ROUTE,
+                          params=dict(since=local.revision, epoch=local.epoch))
         r.raise_for_status()
-        c = crate.parse(r.text)
-        if save_to_disk:
-            os.makedirs(self.cache_dir, mode=0o755, exist_ok=True)
-            c.to_yaml(os.path.join(self.cache_dir, c.name))
-        
-        return c
+        changed, removed = local.apply(r.json())
+        os.makedirs(self.cache_dir, mode=0o755, exist_ok=True)
+        local.save(os.path.join(self.cache_dir, index.INDEX_FILENAME))
+
+        if prefetch:
+            stale = [entry.name for entry in changed if not self._is_cached(entry)]
+            if stale:
+                self.download_batch(stale, save_to_disk=True)
+        return changed, removed
+
+    def fetch_graph(self, origin: crate.Crate, save_to_disk: bool = True,
+                    refresh: bool = False) -> List[crate.Crate]:
+        """
+        Download every transitive dependency of a Crate
+
+        If the local repository index knows every bundle in the graph, the
+        graph is resolved from the index and only bundles that are not
+        already cached are downloaded, in one ``download_batch``. Otherwise,
+        or with ``refresh``, the graph is walked breadth-first and each level
+        is downloaded with ``download_batch``. Crates are returned in the
+        order they were discovered.
+        """
+        if not refresh:
+            try:
+                entries = index_closure(self.repository_index, origin.bundles)
+            except index.UnknownBundleError:
+                pass
+            else:
+                return self._fetch_indexed(entries, save_to_disk)
+
+        fetched: Dict[str, crate.Crate] = OrderedDict()
+        level = list(OrderedDict.fromkeys(bundle_name(dep) for dep in origin.bundles))
+        while level:
+            for name, c in zip(level, self.download_batch(level, save_to_disk, refresh)):
+                fetched[name] = c
+            next_level: Dict[str, None] = OrderedDict()
+            for name in level:
+                for dep in fetched[name].bundles:
+                    dep_name = bundle_name(dep)
+                    if dep_name not in fetched:
+                        next_level[dep_name] = None
+            level = list(next_level)
+        return list(fetched.values())
     
+    def _fetch_indexed(self, entries: List[index.IndexEntry], save_to_disk: bool) -> List[crate.Crate]:
+        fetched: Dict[str, crate.Crate] = {}
+        missing = []
+        for entry in entries:
+            if self._is_cached(entry):
+                fetched[entry.name] = self.load(entry.name)
+            else:
+                missing.append(entry.name)
+        for name, c in zip(missing, self.download_batch(missing, save_to_disk)):
+            fetched[name] = c
+        return [fetched[entry.name] for entry in entries]
+
+    def _is_cached(self, entry: index.IndexEntry) -> bool:
+        try:
+            return crate.read_yaml(os.path.join(self.cache_dir, entry.name), frozen=True).digest == entry.digest
+        except FileNotFoundError:
+            return False
+
     def load(self, name: str) -> crate.Crate:
-        return crate.read_yaml(os.path.join(self.cache_dir, name))
+        c = crate.read_yaml(os.path.join(self.cache_dir, name))
+        self.store.touch(name)
+        return c
+
+    def versions(self, name: str) -> List[str]:
+        """
+        List the versions of a bundle available offline, in the store or as the cached copy
+        """
+        found = set(self.store.versions(name))
+        try:
+            found.add(crate.read_yaml(os.path.join(self.cache_dir, name), frozen=True).version)
+        except FileNotFoundError:
+            pass
+        return sorted(found)
+
+    def dependencies(self, name: str, version: str) -> List[str]:
+        """
+        The bundle references of a cached version of a bundle
+        """
+        return list(self.load_version(name, version).bundles)
+
+    def load_version(self, name: str, version: str) -> crate.Crate:
+        """
+        Load a specific cached version of a bundle
+
+        The current cached copy is used when it has the right version,
+        otherwise the version is looked up in the store.
+        """
+        try:
+            c = self.load(name)
+            if c.version == version:
+                return c
+        except FileNotFoundError:
+            pass
+
+        digest = self.store.lookup(name, version)
+        if digest is None:
+            raise FileNotFoundError("bundle {}:{} is not cached".format(name, version))
+        return crate.parse(self.store.get(digest))
     
     def remove(self, name: str) -> None:
         os.remove(os.path.join(self.cache_dir, name))
+        try:
+            os.remove(self._validators_path(name))
+        except FileNotFoundError:
+            pass
+        self.store.forget(name)
+
+    def gc(self, max_size: int = None) -> List[Dict[str, Any]]:
+        """
+        Trim the bundle cache to ``max_size`` bytes, evicting least-recently-used bundles
+
+        The store removes the cached copies of evicted bundles; their
+        validators are removed here.
+        """
+        removed = self.store.gc(max_size)
+        for name in sorted(set(entry["name"] for entry in removed)):
+            if not os.path.isfile(os.path.join(self.cache_dir, name)):
+                try:
+                    os.remove(self._validators_path(name))
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def _path(self, name: str) -> str:
+        return "{}/{}".format(self.endpoint, name)
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        # timeout is the read timeout; connecting gets its own, usually shorter, limit
+        return self.transport.request(method, path, timeout=(self.connect_timeout, self.timeout), **kwargs)
+
+    def _post_batch(self, names: List[str], save_to_disk: bool,
+                    refresh: bool) -> Optional[Dict[str, crate.Crate]]:
+        # Returns None, and stops trying, if the server has no batch route
+        with self._single_flight(names if save_to_disk else []) as saved:
+            fetched = dict((name, self.load(name)) for name in names if name in saved)
+            requested = []
+            for name in names:
+                if name in saved:
+                    continue
+                entry = dict(name=name)
+                if refresh and os.path.isfile(os.path.join(self.cache_dir, name)):
+                    entry.update(self._read_validators(name))
+                requested.append(entry)
+            if not requested:
+                return fetched
+
+            r = self._request("POST", self.endpoint + HIPAACRATE_BUNDLES_BATCH_ROUTE,
+                              json=dict(bundles=requested))
+            if r.status_code in _BATCH_UNSUPPORTED:
+                self.batch_supported = False
+                return None
+            r.raise_for_status()
+            self.batch_supported = True
+            fetched.update(self._read_batch(r.json(), names, save_to_disk))
+            return fetched
+
+    def _read_batch(self, body: Dict[str, Any], names: List[str], save_to_disk: bool) -> Dict[str, crate.Crate]:
+        fetched: Dict[str, crate.Crate] = {}
+        for entry in body.get("bundles", []):
+            c = crate.parse(entry["body"])
+            if save_to_disk:
+                self._save(c, dict((key, entry[key]) for key in ("etag", "last_modified") if key in entry))
+            fetched[entry["name"]] = c
+        for name in body.get("not_modified", []):
+            if name in names:
+                fetched[name] = self.load(name)
+        return fetched
+
+    @contextmanager
+    def _single_flight(self, names: Iterable[str]) -> Iterator[Set[str]]:
+        # Hold the fetch locks of bundles, yielding the names another process
+        # saved to the cache while this one waited for them. Locks are taken
+        # in name order so that overlapping batches can't deadlock.
+        names = sorted(set(names))
+        if not names:
+            yield set()
+            return
+        before = dict((name, _signature(os.path.join(self.cache_dir, name))) for name in names)
+        os.makedirs(os.path.join(self.cache_dir, HIPAACRATE_BUNDLES_LOCK_DIR), mode=0o755, exist_ok=True)
+        with ExitStack() as stack:
+            for name in names:
+                lock = FileLock(os.path.join(self.cache_dir, HIPAACRATE_BUNDLES_LOCK_DIR, "{}.lock".format(name)),
+                                timeout=HIPAACRATE_BUNDLES_FETCH_LOCK_TIMEOUT)
+                try:
+                    stack.enter_context(lock)
+                except Timeout:
+                    # Whoever holds it is stuck; download without waiting any longer
+                    pass
+            yield set(name for name in names
+                      if _signature(os.path.join(self.cache_dir, name)) not in (None, before[name]))
+
+    def _save(self, c: crate.Crate, validators: Dict[str, str]) -> None:
+        # Every file is replaced atomically, so concurrent readers never see a partial bundle
+        os.makedirs(self.cache_dir, mode=0o755, exist_ok=True)
+        text = c.to_yaml(os.path.join(self.cache_dir, c.name))
+        self.store.put(c.name, c.version, text)
+
+        if validators:
+            write_atomic(self._validators_path(c.name), json.dumps(validators).encode("utf-8"))
+        else:
+            try:
+                os.remove(self._validators_path(c.name))
+            except FileNotFoundError:
+                pass
+
+    def _validators_path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, ".{}{}".format(name, HIPAACRATE_BUNDLES_VALIDATORS_SUFFIX))
+
+    def _read_validators(self, name: str) -> Dict[str, str]:
+        try:
+            with open(self._validators_path(name)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+def _signature(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _validators(headers: Dict[str, str]) -> Dict[str, str]:
+    validators = {}
+    if "ETag" in headers:
+        validators["etag"] = headers["ETag"]
+    if "Last-Modified" in headers:
+        validators["last_modified"] = headers["Last-Modified"]
+    return validators
+
+class CircularDependencyError(ValueError):
+    def __init__(self, cycle: List[str]) -> None:
+        super().__init__("Circular dependencies found: {}".format(" -> ".join(cycle)))
+        self.cycle = cycle
@@ -0,0 +1,280 @@
+"""
+Content-addressed storage for downloaded bundles
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from filelock import FileLock
+from typing import Any, Dict, List, Optional
+
+from .output import digest_file, write_atomic
+
+HIPAACRATE_STORE_DIR = ".store"
+HIPAACRATE_STORE_INDEX = "index.json"
+HIPAACRATE_STORE_MAX_SIZE = 100 * 1024 * 1024
+
+_SIZE_SUFFIXES = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+class BundleStore(object):
+    """
+    A size-bounded store of bundle texts keyed by their SHA-256 digest
+
+    Every stored text is recorded in an index together with the bundle name and
+    version it belongs to, and the index maps each name to its latest digest.
+    Reading an object refreshes its modification time, which is used as the
+    clock for least-recently-used eviction.
+
+    ``copies`` is a directory that may hold a copy of each name's latest text,
+    in a file named after the bundle. Copies count toward ``max_size``, and a
+    copy is removed when the text it matches is evicted.
+    """
+    def __init__(self, root: str, max_size: Optional[int] = HIPAACRATE_STORE_MAX_SIZE,
+                 copies: str = None) -> None:
+        self.root = root
+        self.max_size = max_size
+        self.copies = copies
+        self._mutex = threading.RLock()
+        self._index: Dict[str, Any] = None
+        self._index_stamp = None
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.root, HIPAACRATE_STORE_INDEX)
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def put(self, name: str, version: str, text: str) -> str:
+        """
+        Store the text of a bundle, returning its digest
+        """
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        with self._locked():
+            index = self._read_index()
+            if os.path.isfile(path):
+                os.utime(path)
+            else:
+                os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+                write_atomic(path, data, mode=0o644)
+            index["objects"][digest] = dict(name=name, version=version, size=len(data), added=time.time())
+            index["names"][name] = digest
+            self._write_index(index)
+
+            if self.max_size is not None and self._total_size(index) > self.max_size:
+                self._evict(index, self.max_size, keep=digest)
+        return digest
+
+    def get(self, digest: str) -> str:
+        """
+        Read the text stored under a digest
+        """
+        path = self.object_path(digest)
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)
+        return data.decode("utf-8")
+
+    def lookup(self, name: str, version: str = None) -> Optional[str]:
+        """
+        Find the digest of the latest stored text of a bundle, or of a specific version
+        """
+        index = self._cached_index()
+        latest = index["names"].get(name)
+        if version is None:
+            return latest
+        if latest is not None and index["objects"][latest]["version"] == version:
+            return latest
+        # A republished version has several texts; the one stored last is current
+        stored = [(entry["added"], digest) for digest, entry in index["objects"].items()
+                  if entry["name"] == name and entry["version"] == version]
+        return max(stored)[1] if stored else None
+
+    def versions(self, name: str) -> List[str]:
+        """
+        List the versions of a bundle with a stored text
+        """
+        return sorted(set(entry["version"] for entry in self._cached_index()["objects"].values()
+                          if entry["name"] == name))
+
+    def touch(self, name: str) -> None:
+        """
+        Mark the latest text of a bundle as recently used
+        """
+        digest = self._cached_index()["names"].get(name)
+        if digest is not None:
+            try:
+                os.utime(self.object_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def forget(self, name: str) -> None:
+        """
+        Drop a bundle name from the index; its objects are left for eviction
+        """
+        if not os.path.isfile(self.index_path):
+            return
+        with self._locked():
+            index = self._read_index()
+            if index["names"].pop(name, None) is not None:
+                self._write_index(index)
+
+    def stats(self) -> Dict[str, Any]:
+        index = self._cached_index()
+        return dict(
+            objects=len(index["objects"]),
+            names=len(index["names"]),
+            size=self._total_size(index),
+            max_size=self.max_size,
+        )
+
+    def change_counts(self) -> Dict[str, int]:
+        """
+        Count the distinct texts stored for each bundle name, a measure of how often it changed
+        """
+        counts: Dict[str, int] = {}
+        for entry in self._cached_index()["objects"].values():
+            counts[entry["name"]] = counts.get(entry["name"], 0) + 1
+        return counts
+
+    def gc(self, max_size: int = None) -> List[Dict[str, Any]]:
+        """
+        Evict least-recently-used objects until the store fits in ``max_size`` bytes
+
+        Index entries whose objects have gone missing are dropped as well.
+        Returns the index entries of everything removed.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if not os.path.isfile(self.index_path):
+            return []
+        with self._locked():
+            index = self._read_index()
+            removed = []
+            for digest in list(index["objects"]):
+                if not os.path.isfile(self.object_path(digest)):
+                    removed.append(self._drop(index, digest))
+            if max_size is not None:
+                removed.extend(self._evict(index, max_size))
+            elif removed:
+                self._write_index(index)
+            return removed
+
+    def _evict(self, index: Dict[str, Any], max_size: int, keep: str = None) -> List[Dict[str, Any]]:
+        def last_used(digest):
+            try:
+                return os.stat(self.object_path(digest)).st_mtime_ns
+            except FileNotFoundError:
+                return 0
+
+        removed = []
+        total = self._total_size(index)
+        for digest in sorted(index["objects"], key=last_used):
+            if total <= max_size:
+                break
+            if digest == keep:
+                continue
+            total -= self._footprint(index, digest)
+            try:
+                os.remove(self.object_path(digest))
+            except FileNotFoundError:
+                pass
+            removed.append(self._drop(index, digest))
+        self._write_index(index)
+        return removed
+
+    def _drop(self, index: Dict[str, Any], digest: str) -> Dict[str, Any]:
+        entry = index["objects"].pop(digest)
+        if index["names"].get(entry["name"]) == digest:
+            del index["names"][entry["name"]]
+            copy = self._copy_path(entry["name"])
+            # A newer text may have been copied in already; only remove the copy of this one
+            try:
+                if copy is not None and digest_file(copy) == digest:
+                    os.remove(copy)
+            except FileNotFoundError:
+                pass
+        return dict(entry, digest=digest)
+
+    def _copy_path(self, name: str) -> Optional[str]:
+        if self.copies is None:
+            return None
+        return os.path.join(self.copies, name)
+
+    def _footprint(self, index: Dict[str, Any], digest: str) -> int:
+        # The bytes freed by evicting an object, counting the copy of a latest text
+        entry = index["objects"][digest]
+        copy = self._copy_path(entry["name"])
+        if index["names"].get(entry["name"]) == digest and copy is not None and os.path.isfile(copy):
+            return 2 * entry["size"]
+        return entry["size"]
+
+    def _total_size(self, index: Dict[str, Any]) -> int:
+        return sum(self._footprint(index, digest) for digest in index["objects"])
+
+    def _locked(self):
+        os.makedirs(self.root, mode=0o755, exist_ok=True)
+        return _StoreLock(self._mutex, FileLock(os.path.join(self.root, "index.lock")))
+
+    def _cached_index(self) -> Dict[str, Any]:
+        with self._mutex:
+            try:
+                st = os.stat(self.index_path)
+                stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+            except FileNotFoundError:
+                stamp = None
+            if self._index is None or stamp != self._index_stamp:
+                self._index = self._read_index()
+                self._index_stamp = stamp
+            return self._index
+
+    def _read_index(self) -> Dict[str, Any]:
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            index = {}
+        index.setdefault("names", {})
+        index.setdefault("objects", {})
+        return index
+
+    def _write_index(self, index: Dict[str, Any]) -> None:
+        write_atomic(self.index_path, json.dumps(index, sort_keys=True).encode("utf-8"), mode=0o644)
+        self._index = None
+
+class _StoreLock(object):
+    def __init__(self, mutex: threading.RLock, lock: FileLock) -> None:
+        self._mutex = mutex
+        self._lock = lock
+
+    def __enter__(self) -> None:
+        self._mutex.acquire()
+        try:
+            self._lock.acquire()
+        except BaseException:
+            self._mutex.release()
+            raise
+
+    def __exit__(self, *exc_info) -> None:
+        try:
+            self._lock.release()
+        finally:
+            self._mutex.release()
+
+def parse_size(text: str) -> int:
+    """
+    Parse a size such as ``1048576``, ``512K``, ``100M`` or ``2G`` into bytes
+    """
+    text = text.strip().upper()
+    if text.endswith("B"):
+        text = text[:-1]
+    suffix = text[-1:] if text[-1:] in _SIZE_SUFFIXES else ""
+    number = text[:len(text) - len(suffix)]
+    try:
+        return int(float(number) * _SIZE_SUFFIXES[suffix])
+    except ValueError:
+        raise ValueError("invalid size: {}".format(text)) from None
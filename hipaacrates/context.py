@@ -0,0 +1,107 @@
+"""
+Deterministic build-context tarballs, for ``docker build -``
+"""
+import hashlib
+import io
+import os
+import posixpath
+import stat
+import tarfile
+
+from typing import BinaryIO, Dict, Iterable, List, Tuple
+
+from . import includes
+from .crate import Crate
+from .services import HIPAACRATES_WORK_DIR
+
+CONTEXT_MTIME = 0
+
+class _DigestWriter(object):
+    def __init__(self, fileobj: BinaryIO) -> None:
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        return self.fileobj.write(data)
+
+def write(fileobj: BinaryIO, dockerfile: str, scripts: Dict[str, str], crates: Iterable[Crate],
+          index: includes.FileIndex = None) -> str:
+    """
+    Stream a tar of the Dockerfile, service scripts and the includes of every Crate, returning its SHA-256
+
+    Entries are sorted by path and carry fixed owners and modification
+    times, so the same files always produce the same bytes. Included files
+    are read in chunks and never held in memory whole.
+    """
+    generated: Dict[str, Tuple[bytes, int]] = {"Dockerfile": (dockerfile.encode("utf-8"), 0o644)}
+    for name, content in scripts.items():
+        arcname = posixpath.join(HIPAACRATES_WORK_DIR, "{}.sh".format(name))
+        generated[arcname] = ((content + "\n").encode("utf-8"), 0o755)
+    files = dict((arcname, path) for arcname, path in include_paths(crates, index) if arcname not in generated)
+
+    out = _DigestWriter(fileobj)
+    with tarfile.open(fileobj=out, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        for arcname in sorted(set(generated) | set(files)):
+            if arcname in generated:
+                data, mode = generated[arcname]
+                info = _tarinfo(arcname, tarfile.REGTYPE, mode)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            else:
+                _add_path(tar, arcname, files[arcname])
+    return out.hash.hexdigest()
+
+def include_paths(crates: Iterable[Crate], index: includes.FileIndex = None) -> List[Tuple[str, str]]:
+    """
+    List every file, directory and symlink the Crates include, as (path in the context, path on disk)
+    """
+    if index is None:
+        index = includes.FileIndex()
+    found: Dict[str, str] = {}
+    for c in crates:
+        for arcname, _, _ in includes.expand(c.includes, index):
+            path = arcname.replace("/", os.sep)
+            if arcname == ".." or arcname.startswith("../"):
+                raise ContextError("include {} of {} is outside the build context".format(arcname, c.name))
+            if not os.path.lexists(path):
+                raise ContextError("include {} of {} does not exist".format(arcname, c.name))
+            if arcname == ".":
+                arcname = ""
+            else:
+                found[arcname] = path
+            if os.path.isdir(path) and not os.path.islink(path):
+                for root, dirnames, filenames in os.walk(path):
+                    dirnames.sort()
+                    prefix = posixpath.join(arcname, os.path.relpath(root, path).replace(os.sep, "/"))
+                    for name in dirnames + filenames:
+                        found[posixpath.normpath(posixpath.join(prefix, name))] = os.path.join(root, name)
+    return sorted(found.items())
+
+def _add_path(tar: tarfile.TarFile, arcname: str, path: str) -> None:
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        info = _tarinfo(arcname, tarfile.SYMTYPE, 0o777)
+        info.linkname = os.readlink(path)
+        tar.addfile(info)
+    elif stat.S_ISDIR(st.st_mode):
+        tar.addfile(_tarinfo(arcname, tarfile.DIRTYPE, 0o755))
+    elif stat.S_ISREG(st.st_mode):
+        info = _tarinfo(arcname, tarfile.REGTYPE, 0o755 if st.st_mode & 0o111 else 0o644)
+        info.size = st.st_size
+        with open(path, "rb") as f:
+            tar.addfile(info, f)
+    else:
+        raise ContextError("include {} is not a regular file, directory or symlink".format(path))
+
+def _tarinfo(arcname: str, kind: bytes, mode: int) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(arcname)
+    info.type = kind
+    info.mode = mode
+    info.mtime = CONTEXT_MTIME
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    return info
+
+class ContextError(Exception):
+    pass
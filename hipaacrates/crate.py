@@ -1,10 +1,57 @@
-from typing import Iterable, List
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 import yaml
 
+from .output import write_atomic
+
+try:
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
+READ_CACHE_SIZE = 1024
+
+_read_cache: Dict[str, Tuple[Tuple[int, int, int], "FrozenCrate"]] = OrderedDict()
+_read_cache_lock = threading.Lock()
+
+class Builder(object):
+    """
+    A separate build stage of a Crate, whose ``artifacts`` are copied into the final image
+    """
+    __slots__ = ("image", "build_steps", "artifacts")
+
+    def __init__(self, image: str, build_steps: Iterable[str] = None, artifacts: Iterable[str] = None) -> None:
+        self.image = image
+        self.build_steps = tuple(build_steps) if build_steps is not None else ()
+        self.artifacts = tuple(artifacts) if artifacts is not None else ()
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Builder):
+            return (
+                self.image == other.image and
+                self.build_steps == other.build_steps and
+                self.artifacts == other.artifacts
+            )
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash((self.image, self.build_steps, self.artifacts))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(image=self.image, build_steps=list(self.build_steps), artifacts=list(self.artifacts))
+
 class Crate(object):
+    __slots__ = ("author", "build_steps", "builder", "bundles", "includes", "name", "run_command", "version",
+                 "volatility")
+
     def __init__(self, name: str, version: str, author: str, build_steps: List[str], bundles: List[str],
-                 includes: List[str], run_command: str) -> None:
+                 includes: List[str], run_command: str, volatility: int = None, builder: Builder = None) -> None:
         self.author = author
         self.build_steps = build_steps
         self.bundles = bundles
@@ -12,17 +59,21 @@ class Crate(object):
         self.name = name
         self.run_command = run_command
         self.version = version
+        self.volatility = volatility
+        self.builder = builder
 
     def __eq__(self, other) -> bool:
         if isinstance(other, Crate):
             return (
                 self.author == other.author and
-                self.build_steps == other.build_steps and
-                self.bundles == other.bundles and
-                self.includes == other.includes and
+                list(self.build_steps) == list(other.build_steps) and
+                list(self.bundles) == list(other.bundles) and
+                list(self.includes) == list(other.includes) and
                 self.name == other.name and
                 self.run_command == other.run_command and
-                self.version == other.version
+                self.version == other.version and
+                self.volatility == other.volatility and
+                self.builder == other.builder
             )
         return NotImplemented
 
@@ -32,26 +83,112 @@ class Crate(object):
         )
 
     def to_yaml(self, filepath: str = None) -> str:
-        yaml_text = yaml.safe_dump(dict(
-            author=self.author,
-            build_steps=self.build_steps,
-            bundles=self.bundles,
-            includes=self.includes,
-            name=self.name,
-            run_command=self.run_command,
-            version=self.version,
-        ), default_flow_style=False)
+        yaml_text = yaml.dump(_to_dict(self), Dumper=SafeDumper, default_flow_style=False)
 
         if filepath is not None:
-            with open(filepath, "w") as f:
-                f.write(yaml_text)
+            # Replaced atomically, so a concurrent reader never sees a partial file
+            write_atomic(filepath, yaml_text.encode("utf-8"))
+            _forget(filepath)
         
         return yaml_text
 
+    def freeze(self) -> "FrozenCrate":
+        """
+        Make an immutable, hashable copy of this Crate
+        """
+        return FrozenCrate(name=self.name, version=self.version, author=self.author,
+                           build_steps=self.build_steps, bundles=self.bundles,
+                           includes=self.includes, run_command=self.run_command,
+                           volatility=self.volatility, builder=self.builder)
+
+class FrozenCrate(Crate):
+    """
+    An immutable Crate with tuple fields
+
+    Frozen Crates are hashable and carry a digest of their content, so they
+    can be stored in sets and used as cache keys. ``replace`` makes a modified
+    copy.
+    """
+    __slots__ = ("_digest", "_hash")
+
+    def __init__(self, name: str, version: str, author: str, build_steps: Iterable[str], bundles: Iterable[str],
+                 includes: Iterable[str], run_command: str, volatility: int = None,
+                 builder: Union[Builder, Dict[str, Any]] = None) -> None:
+        object.__setattr__(self, "author", author)
+        object.__setattr__(self, "build_steps", tuple(build_steps))
+        object.__setattr__(self, "bundles", tuple(bundles))
+        object.__setattr__(self, "includes", tuple(includes))
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "run_command", run_command)
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "volatility", volatility)
+        object.__setattr__(self, "builder", _builder(builder))
+        object.__setattr__(self, "_digest", None)
+        object.__setattr__(self, "_hash", None)
+
+    def __setattr__(self, name, value) -> None:
+        raise AttributeError("FrozenCrate is immutable, use replace()")
+
+    def __delattr__(self, name) -> None:
+        raise AttributeError("FrozenCrate is immutable, use replace()")
+
+    def __hash__(self) -> int:
+        if self._hash is None:
+            object.__setattr__(self, "_hash", hash((
+                self.author, self.build_steps, self.bundles, self.includes,
+                self.name, self.run_command, self.version, self.volatility, self.builder,
+            )))
+        return self._hash
+
+    def __reduce__(self):
+        return (FrozenCrate, (self.name, self.version, self.author, self.build_steps, self.bundles,
+                              self.includes, self.run_command, self.volatility, self.builder))
+
+    @property
+    def digest(self) -> str:
+        """
+        SHA-256 of the Crate's content, independent of how it was formatted on disk
+        """
+        if self._digest is None:
+            canonical = json.dumps(_to_dict(self), sort_keys=True, separators=(",", ":"))
+            object.__setattr__(self, "_digest", hashlib.sha256(canonical.encode("utf-8")).hexdigest())
+        return self._digest
+
+    def freeze(self) -> "FrozenCrate":
+        return self
+
+    def replace(self, **changes) -> "FrozenCrate":
+        """
+        Make a copy of this Crate with some fields changed
+        """
+        fields = _to_dict(self)
+        fields.setdefault("volatility", None)
+        fields.setdefault("builder", None)
+        unknown = set(changes) - set(fields)
+        if unknown:
+            raise TypeError("unknown Crate fields: {}".format(", ".join(sorted(unknown))))
+        fields.update(changes)
+        return FrozenCrate(**fields)
+
+    def thaw(self) -> Crate:
+        """
+        Make a mutable copy of this Crate
+        """
+        return Crate(name=self.name, version=self.version, author=self.author,
+                     build_steps=list(self.build_steps), bundles=list(self.bundles),
+                     includes=list(self.includes), run_command=self.run_command,
+                     volatility=self.volatility, builder=self.builder)
+
 def new(name: str, version: str, author: str = None, build_steps: Iterable[str] = None,
-        bundles: Iterable[str] = None, includes: Iterable[str] = None, run_command: str = None) -> Crate:
+        bundles: Iterable[str] = None, includes: Iterable[str] = None, run_command: str = None,
+        volatility: int = None, builder: Union[Builder, Dict[str, Any]] = None) -> Crate:
     """
     Create a new Crate
+
+    ``volatility`` optionally hints how often the Crate changes relative to
+    others, higher meaning more often; see ``ordering.VolatilityOrder``.
+    ``builder`` optionally declares a build stage, as a Builder or a dict
+    with ``image``, ``build_steps`` and ``artifacts``.
     """
     if author is None:
         author = ""
@@ -62,26 +199,88 @@ def new(name: str, version: str, author: str = None, build_steps: Iterable[str]
         run_command = ""
 
     return Crate(name=name, version=version, author=author, build_steps=build_steps,
-                 bundles=bundles, includes=includes, run_command=run_command)
+                 bundles=bundles, includes=includes, run_command=run_command, volatility=volatility,
+                 builder=_builder(builder))
 
 def parse(text: str) -> Crate:
     """
     Parse and load a Crate from a YAML string
     """
-    parsed = yaml.safe_load(text)
+    parsed = yaml.load(text, Loader=SafeLoader)
     return new(
         name=parsed["name"],
-        version=parsed["version"],
+        # An unquoted version such as 1.0 is read as a number
+        version=str(parsed["version"]),
         author=parsed.get("author"),
         build_steps=parsed.get("build_steps"),
         bundles=parsed.get("bundles"),
         includes=parsed.get("includes"),
         run_command=parsed.get("run_command"),
+        volatility=parsed.get("volatility"),
+        builder=parsed.get("builder"),
     )
 
-def read_yaml(filepath: str) -> Crate:
+def read_yaml(filepath: str, frozen: bool = False) -> Crate:
     """
     Load a Crate from a YAML file
+
+    Parsed files are cached by path and only re-parsed when their inode,
+    modification time or size change. With ``frozen``, the shared cached
+    FrozenCrate is returned instead of a mutable copy.
+    """
+    path = os.path.abspath(filepath)
+    st = os.stat(path)
+    stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+    with _read_cache_lock:
+        entry = _read_cache.get(path)
+        if entry is not None and entry[0] == stamp:
+            _read_cache.move_to_end(path)
+            return entry[1] if frozen else entry[1].thaw()
+
+    with open(path) as f:
+        c = parse(f.read()).freeze()
+    with _read_cache_lock:
+        _read_cache[path] = (stamp, c)
+        _read_cache.move_to_end(path)
+        while len(_read_cache) > READ_CACHE_SIZE:
+            _read_cache.popitem(last=False)
+    return c if frozen else c.thaw()
+
+def clear_cache() -> None:
+    """
+    Forget every Crate cached by ``read_yaml``
     """
-    with open(filepath) as f:
-        return parse(f.read())
+    with _read_cache_lock:
+        _read_cache.clear()
+
+def _forget(filepath: str) -> None:
+    # A rewrite within the filesystem's timestamp granularity can keep the
+    # same stamp, so files written here are always re-read.
+    with _read_cache_lock:
+        _read_cache.pop(os.path.abspath(filepath), None)
+
+def _to_dict(c: Crate) -> Dict[str, object]:
+    # Optional fields are left out when unset, so existing files and digests are unchanged
+    fields = dict(
+        author=c.author,
+        build_steps=list(c.build_steps),
+        bundles=list(c.bundles),
+        includes=list(c.includes),
+        name=c.name,
+        run_command=c.run_command,
+        version=c.version,
+    )
+    if c.volatility is not None:
+        fields["volatility"] = c.volatility
+    if c.builder is not None:
+        fields["builder"] = c.builder.to_dict()
+    return fields
+
+def _builder(value: Union[Builder, Dict[str, Any], None]) -> Optional[Builder]:
+    if value is None or isinstance(value, Builder):
+        return value
+    return Builder(
+        image=value["image"],
+        build_steps=value.get("build_steps"),
+        artifacts=value.get("artifacts"),
+    )
@@ -1,32 +1,204 @@
+from collections import OrderedDict
 from io import StringIO
+import posixpath
+import re
 
-from typing import Iterable
+from typing import Any, Dict, Iterable, List
 
+from . import includes
 from . import services
-from .bundles import BundleLoader, load_dependencies, resolve_dependencies
+from . import steps
+from .bundles import BundleLoader, group_levels, load_dependencies, resolve_dependencies
 from .crate import Crate
+from .ordering import OrderingPolicy
+from .output import OutputWriter
 
 DEFAULT_BASE_IMAGE = "phusion/baseimage:0.10.1"
 WORKDIR_PREFIX = "/opt/services"
+SERVICE_DIR = "/etc/service"
+BUILDKIT_SYNTAX = "docker/dockerfile:1"
+APT_CACHE_MOUNT = "--mount=type=cache,target=/var/cache/apt,sharing=locked"
+PIP_CACHE_MOUNT = "--mount=type=cache,target=/root/.cache/pip"
+APT_KEEP_DOWNLOADS = (
+    "rm -f /etc/apt/apt.conf.d/docker-clean \\\n"
+    "    && echo 'Binary::apt::APT::Keep-Downloaded-Packages \"true\";' > /etc/apt/apt.conf.d/keep-cache"
+)
 
-def make_file(crate: Crate, dependencies: Iterable[Crate]) -> None:
-    content = make(crate, dependencies)
-    with open("Dockerfile", "w") as f:
-        f.write(content + "\n")
+# Chained steps that could behave differently than in a RUN of their own
+_COMPOUND_STEP = re.compile(r"[;&|\n]")
+_COMMENT = re.compile(r"(^|\s)#")
+_STATEFUL_COMMANDS = frozenset([
+    ".", "alias", "cd", "exec", "exit", "export", "popd", "pushd", "set", "shopt", "source", "umask", "unset",
+])
 
-def make(crate: Crate, dependencies: Iterable[Crate]) -> str:
-    crates = resolve_dependencies(crate, dependencies)
+class RenderOptions(object):
+    """
+    Optional Dockerfile optimizations
 
+    ``optimize`` chains the build steps of each bundle into a single RUN and
+    makes every service script executable in one final layer.
+    ``collapse_scripts`` additionally copies all service scripts with a
+    single COPY; it implies ``optimize``.
+    ``dedupe`` drops package installs an earlier bundle already ran, and
+    ``coalesce`` merges the apt and pip installs of each topological level
+    into one install layer.
+    ``buildkit`` renders for BuildKit: apt and pip run with cache mounts and
+    included files are copied with ``COPY --link``.
+    """
+    def __init__(self, optimize: bool = False, collapse_scripts: bool = False, dedupe: bool = False,
+                 coalesce: bool = False, buildkit: bool = False) -> None:
+        self.optimize = optimize or collapse_scripts
+        self.collapse_scripts = collapse_scripts
+        self.dedupe = dedupe
+        self.coalesce = coalesce
+        self.buildkit = buildkit
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(optimize=self.optimize, collapse_scripts=self.collapse_scripts, dedupe=self.dedupe,
+                    coalesce=self.coalesce, buildkit=self.buildkit)
+
+def make_file(crate: Crate, dependencies: Iterable[Crate], resolved: bool = False,
+              writer: OutputWriter = None, options: RenderOptions = None, order: OrderingPolicy = None,
+              index: includes.FileIndex = None) -> bool:
+    """
+    Write the Dockerfile for a Crate, returning whether it changed
+    """
+    if writer is None:
+        writer = OutputWriter()
+    content = make(crate, dependencies, resolved, options, order, index)
+    return writer.write("Dockerfile", content + "\n")
+
+def make(crate: Crate, dependencies: Iterable[Crate], resolved: bool = False,
+         options: RenderOptions = None, order: OrderingPolicy = None, index: includes.FileIndex = None) -> str:
+    """
+    Render the Dockerfile for a Crate
+
+    Unless ``resolved`` is set, the dependencies are put in build order first,
+    ordering each level by ``order``; otherwise they are rendered in the order
+    given, followed by the Crate. Crates that declare a builder get their own
+    build stage ahead of the final image. Include patterns are expanded
+    against ``index``.
+    """
+    if options is None:
+        options = RenderOptions()
+    if index is None:
+        index = includes.FileIndex()
+    if resolved:
+        crates = list(dependencies) + [crate]
+    else:
+        crates = resolve_dependencies(crate, dependencies, order)
+
+    # With a pip cache mount, merged installs can keep pip's cache out of the image for free
+    groups = [(steps.InstallLayer([]), crates)]
+    if options.coalesce:
+        groups = steps.coalesce(group_levels(crates), pip_cache=options.buildkit)
+    if options.dedupe:
+        groups = steps.dedupe(groups)
+
+    buildkit = options.buildkit
     string = StringIO()
-    string.write(make_header(crate) + "\n")
+    if buildkit:
+        string.write("# syntax={}\n".format(BUILDKIT_SYNTAX))
     for c in crates:
-        string.write("# Hipaacrate bundle {}, version {}\n".format(c.name, c.version))
-        string.write(change_workdir(c) + "\n")
-        string.write(include_files(c) + "\n")
-        string.write(convert_build_steps(c) + "\n")
-        string.write(make_service_definition(c) + "\n")
+        if c.builder is not None:
+            string.write(make_builder_stage(c, buildkit, options.optimize, index) + "\n")
+    string.write(make_header(crate) + "\n")
+    if buildkit and _uses_apt(groups):
+        string.write(make_run_statement(APT_KEEP_DOWNLOADS) + "\n")
+
+    if options.optimize:
+        return string.getvalue() + _make_optimized(groups, options, index)
+
+    for layer, level in groups:
+        if layer.steps:
+            string.write(make_install_layer(layer, level, buildkit) + "\n")
+        for c in level:
+            string.write("# Hipaacrate bundle {}, version {}\n".format(c.name, c.version))
+            string.write(change_workdir(c) + "\n")
+            string.write(include_files(c, buildkit, index) + "\n")
+            if c.builder is not None:
+                string.write(copy_artifacts(c, buildkit) + "\n")
+            string.write(convert_build_steps(c, buildkit) + "\n")
+            string.write(make_service_definition(c) + "\n")
     return string.getvalue()
 
+def _make_optimized(groups: List[steps.Group], options: RenderOptions, index: includes.FileIndex) -> str:
+    buildkit = options.buildkit
+    statements = []
+    crates = []
+    for layer, level in groups:
+        if layer.steps:
+            statements.append(make_install_layer(layer, level, buildkit))
+        for c in level:
+            statements.append("# Hipaacrate bundle {}, version {}".format(c.name, c.version))
+            statements.append(change_workdir(c))
+            statements.append(include_files(c, buildkit, index))
+            statements.append(copy_artifacts(c, buildkit))
+            statements.append(chain_build_steps(c, buildkit))
+            if not options.collapse_scripts:
+                statements.append(copy_service_script(c))
+            crates.append(c)
+    statements.append(make_services_layer(crates, options.collapse_scripts))
+    return "".join(s + "\n" for s in statements if s)
+
+def _uses_apt(groups: List[steps.Group]) -> bool:
+    for layer, level in groups:
+        if any(s.manager == "apt" for s in layer.steps):
+            return True
+        if any("apt" in steps.package_managers(step) for c in level for step in c.build_steps):
+            return True
+    return False
+
+def make_install_layer(layer: steps.InstallLayer, crates: Iterable[Crate], buildkit: bool = False) -> str:
+    """
+    Render the package installs merged from a level of bundles as one RUN statement
+    """
+    names = ", ".join(c.name for c in crates)
+    return "# Hipaacrate packages for {}\n{}".format(
+        names, make_run_statement(" \\\n    && ".join(layer.commands()), buildkit),
+    )
+
+def builder_stage_name(crate: Crate) -> str:
+    return "{}-builder".format(crate.name)
+
+def make_builder_stage(crate: Crate, buildkit: bool = False, optimize: bool = False,
+                       index: includes.FileIndex = None) -> str:
+    """
+    Render the build stage declared by a Crate
+
+    The stage starts from the builder image, gets the Crate's included files
+    in the same WORKDIR as the final image, and runs the builder's steps.
+    """
+    builder = crate.builder
+    statements = [
+        "# Hipaacrate builder for bundle {}".format(crate.name),
+        "FROM {} AS {}".format(builder.image, builder_stage_name(crate)),
+        change_workdir(crate),
+        include_files(crate, buildkit, index),
+    ]
+    if buildkit and any("apt" in steps.package_managers(step) for step in builder.build_steps):
+        statements.append(make_run_statement(APT_KEEP_DOWNLOADS))
+    if optimize:
+        statements.append(_chain(builder.build_steps, buildkit))
+    else:
+        statements.extend(make_run_statement(step, buildkit) for step in builder.build_steps if step)
+    return "\n".join(s for s in statements if s)
+
+def copy_artifacts(crate: Crate, buildkit: bool = False) -> str:
+    """
+    Copy the artifacts of a Crate's build stage into its WORKDIR
+
+    COPY --from resolves sources from the stage's root, so relative artifacts
+    are taken from the WORKDIR the builder's steps ran in.
+    """
+    if crate.builder is None or not crate.builder.artifacts:
+        return ""
+    workdir = posixpath.join(WORKDIR_PREFIX, crate.name)
+    return "COPY {}--from={} {} {}/".format(
+        "--link " if buildkit else "", builder_stage_name(crate),
+        " ".join(posixpath.join(workdir, artifact) for artifact in crate.builder.artifacts), workdir,
+    )
+
 def make_header(crate: Crate, baseimage: str = None) -> str:
     if baseimage is None:
         baseimage = DEFAULT_BASE_IMAGE
@@ -47,23 +219,115 @@ def change_workdir(crate: Crate, prefix: str = None) -> str:
             prefix = prefix[:-1]
     return "WORKDIR {}/{}".format(prefix, crate.name)
 
-def convert_build_steps(crate: Crate) -> str:
-    steps = [make_run_statement(step) for step in crate.build_steps if step]
+def convert_build_steps(crate: Crate, buildkit: bool = False) -> str:
+    steps = [make_run_statement(step, buildkit) for step in crate.build_steps if step]
     return "\n".join(steps)
 
-def make_run_statement(cmd: str) -> str:
-    return "RUN {}".format(cmd) if cmd else ""
+def chain_build_steps(crate: Crate, buildkit: bool = False) -> str:
+    """
+    Render the build steps of a Crate as one RUN statement
 
-def include_files(crate: Crate) -> str:
-    if crate.includes:
-        all_files = " ".join(crate.includes)
-        return "COPY {} {}/{}/".format(all_files, WORKDIR_PREFIX, crate.name)
-    else:
+    Steps are joined with ``&&`` so the RUN fails as soon as a step does.
+    A step with its own operators, such as ``||`` or ``;``, or that changes
+    the shell's state, such as ``cd``, runs in a subshell. Docker joins the
+    continuation lines of a RUN, so a comment would swallow every step after
+    it: a step with a comment keeps a RUN of its own.
+    """
+    return _chain(crate.build_steps, buildkit)
+
+def _chain(build_steps: Iterable[str], buildkit: bool) -> str:
+    statements = []
+    chained: List[str] = []
+    for step in (step.strip() for step in build_steps if step and step.strip()):
+        if _COMMENT.search(step):
+            statements.append(make_run_statement(" \\\n    && ".join(chained), buildkit))
+            statements.append(make_run_statement(step, buildkit))
+            chained = []
+        elif _COMPOUND_STEP.search(step) or step.split()[0] in _STATEFUL_COMMANDS:
+            chained.append("( {} )".format(step))
+        else:
+            chained.append(step)
+    statements.append(make_run_statement(" \\\n    && ".join(chained), buildkit))
+    return "\n".join(s for s in statements if s)
+
+def make_run_statement(cmd: str, buildkit: bool = False) -> str:
+    """
+    Render a RUN statement, with cache mounts for the package managers it uses under BuildKit
+    """
+    if not cmd:
         return ""
+    if buildkit:
+        mounts = cache_mounts(cmd)
+        if mounts:
+            return "RUN {} {}".format(" ".join(mounts), cmd)
+    return "RUN {}".format(cmd)
+
+def cache_mounts(cmd: str) -> List[str]:
+    managers = steps.package_managers(cmd)
+    mounts = []
+    if "apt" in managers:
+        mounts.append(APT_CACHE_MOUNT)
+    if "pip" in managers:
+        mounts.append(PIP_CACHE_MOUNT)
+    return mounts
+
+def include_files(crate: Crate, buildkit: bool = False, index: includes.FileIndex = None) -> str:
+    """
+    Copy the files a Crate includes into its WORKDIR
+
+    Literal includes are copied by one COPY. If the Crate uses include
+    patterns, matched paths keep their place relative to the build context
+    and are copied with one COPY per target directory.
+    """
+    link = "--link " if buildkit else ""
+    if not any(includes.is_pattern(i) for i in crate.includes):
+        if crate.includes:
+            all_files = " ".join(crate.includes)
+            return "COPY {}{} {}/{}/".format(link, all_files, WORKDIR_PREFIX, crate.name)
+        else:
+            return ""
+
+    targets: Dict[str, List[str]] = OrderedDict()
+    for path, base, is_dir in includes.expand(crate.includes, index):
+        target = posixpath.relpath(path if is_dir else posixpath.dirname(path) or ".", base)
+        targets.setdefault(target, []).append(path)
+    statements = []
+    for target, sources in targets.items():
+        dest = posixpath.normpath(posixpath.join(WORKDIR_PREFIX, crate.name, target))
+        statements.append("COPY {}{} {}/".format(link, " ".join(sources), dest))
+    return "\n".join(statements)
 
 def make_copy_statement(src: str, dest: str) -> str:
     return "COPY {} {}".format(src, dest)
 
+def copy_service_script(crate: Crate) -> str:
+    if crate.run_command:
+        return "COPY .hipaacrates/{}.sh {}/{}/run".format(crate.name, SERVICE_DIR, crate.name)
+    return ""
+
+def make_services_layer(crates: Iterable[Crate], collapse_scripts: bool = False) -> str:
+    """
+    Make the service scripts of every Crate executable in a single layer
+
+    With ``collapse_scripts`` the scripts are also copied by one COPY statement
+    and moved into place by the same RUN.
+    """
+    names = [c.name for c in crates if c.run_command]
+    if not names:
+        return ""
+    runs = ["{}/{}/run".format(SERVICE_DIR, name) for name in names]
+    if not collapse_scripts:
+        return make_run_statement("chmod a+x {}".format(" ".join(runs)))
+
+    sources = " ".join(".hipaacrates/{}.sh".format(name) for name in names)
+    commands = ["cd {}".format(SERVICE_DIR)]
+    commands.extend("mkdir -p {n} && mv {n}.sh {n}/run".format(n=name) for name in names)
+    commands.append("chmod a+x {}".format(" ".join("{}/run".format(name) for name in names)))
+    return "{}\n{}".format(
+        make_copy_statement(sources, "{}/".format(SERVICE_DIR)),
+        make_run_statement(" \\\n    && ".join(commands)),
+    )
+
 def make_service_definition(crate: Crate) -> str:
     if crate.run_command:
         string = StringIO()
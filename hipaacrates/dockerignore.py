@@ -0,0 +1,72 @@
+"""
+Allow-list .dockerignore files, which limit the build context to what the Dockerfile copies
+"""
+import re
+
+from typing import Iterable, Optional
+
+from . import includes
+from .crate import Crate
+from .output import OutputWriter
+from .services import HIPAACRATES_WORK_DIR
+
+DOCKERIGNORE_FILENAME = ".dockerignore"
+GENERATED_HEADER = "# Generated by crater build, edits will be overwritten"
+
+_SPECIAL = re.compile(r"([*?\[\]\\])")
+
+def make(crates: Iterable[Crate]) -> str:
+    """
+    Render a .dockerignore that excludes everything except the Dockerfile, service scripts and includes
+
+    If a Crate includes the whole build directory, nothing is excluded.
+    Include patterns are kept as patterns, which Docker matches the same
+    way; ``!`` exclusions are left out, since they only apply to their own
+    Crate's includes.
+    """
+    patterns = []
+    for c in crates:
+        for include in c.includes:
+            if include.startswith("!"):
+                continue
+            pattern = _pattern(include)
+            if pattern == ".":
+                return GENERATED_HEADER + "\n"
+            if pattern is not None and pattern not in patterns:
+                patterns.append(pattern)
+
+    lines = [GENERATED_HEADER, "*", "!Dockerfile", "!{}/*.sh".format(HIPAACRATES_WORK_DIR)]
+    lines.extend("!{}".format(p) for p in sorted(patterns))
+    return "\n".join(lines) + "\n"
+
+def make_file(crates: Iterable[Crate], writer: OutputWriter = None, filepath: str = DOCKERIGNORE_FILENAME) -> bool:
+    """
+    Write the .dockerignore for a build, returning whether it changed
+
+    A .dockerignore that was not generated by crater is never overwritten.
+    """
+    if writer is None:
+        writer = OutputWriter()
+    if not is_generated(filepath):
+        return False
+    return writer.write(filepath, make(crates))
+
+def is_generated(filepath: str = DOCKERIGNORE_FILENAME) -> bool:
+    """
+    Check whether a .dockerignore is missing or was generated by crater
+    """
+    try:
+        with open(filepath) as f:
+            return f.readline().rstrip("\n") == GENERATED_HEADER
+    except FileNotFoundError:
+        return True
+
+def _pattern(include: str) -> Optional[str]:
+    # Docker cleans patterns the same way, relative to the context root;
+    # paths outside the context can't be copied anyway.
+    path = includes.normalize(include)
+    if path == ".." or path.startswith("../"):
+        return None
+    if includes.is_pattern(path):
+        return path
+    return _SPECIAL.sub(r"\\\1", path)
@@ -0,0 +1,168 @@
+"""
+Content keys for the files crates include, for build skipping and image cache lookups
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import mmap
+import os
+import stat
+import threading
+import time
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from . import includes
+from . import output
+from .context import ContextError, include_paths
+from .crate import Crate
+from .services import HIPAACRATES_WORK_DIR
+
+HASH_CACHE_FILENAME = os.path.join(HIPAACRATES_WORK_DIR, "hashes.json")
+HASHING_MAX_WORKERS = 8
+HASHING_MMAP_THRESHOLD = 1024 * 1024
+# Files modified this recently may still change within the same mtime, so
+# their digests are not cached.
+HASHING_RACY_WINDOW_NS = 2 * 10 ** 9
+
+class FileHasher(object):
+    """
+    Hashes files on a thread pool, remembering digests by stat signature
+
+    Digests are kept in a JSON cache keyed by path and only recomputed when
+    a file's inode, modification time or size change. ``save`` writes the
+    digests of the files hashed since the cache was loaded.
+    """
+    def __init__(self, cache_path: Optional[str] = HASH_CACHE_FILENAME,
+                 max_workers: int = HASHING_MAX_WORKERS) -> None:
+        self.cache_path = cache_path
+        self.max_workers = max_workers
+        self.hits = 0
+        self.misses = 0
+        self._cache = self._load()
+        self._seen: Dict[str, List] = {}
+        self._lock = threading.Lock()
+
+    def digest(self, path: str) -> str:
+        """
+        SHA-256 of a file's content, as a hex string
+        """
+        st = os.stat(path)
+        signature = [st.st_ino, st.st_mtime_ns, st.st_size]
+        entry = self._cache.get(path)
+        if entry is not None and entry[:3] == signature:
+            with self._lock:
+                self.hits += 1
+                self._seen[path] = entry
+            return entry[3]
+
+        digest = hash_file(path, st.st_size)
+        with self._lock:
+            self.misses += 1
+            if time.time_ns() - st.st_mtime_ns > HASHING_RACY_WINDOW_NS:
+                self._seen[path] = signature + [digest]
+        return digest
+
+    def digest_many(self, paths: Iterable[str]) -> Dict[str, str]:
+        """
+        Hash several files concurrently, returning their digests by path
+        """
+        unique = sorted(set(paths))
+        if len(unique) <= 1 or self.max_workers <= 1:
+            return dict((path, self.digest(path)) for path in unique)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip(unique, executor.map(self.digest, unique)))
+
+    def save(self) -> None:
+        if self.cache_path is None:
+            return
+        with self._lock:
+            if self._seen == self._cache:
+                return
+            data = json.dumps(self._seen, sort_keys=True).encode("utf-8")
+        os.makedirs(os.path.dirname(self.cache_path) or ".", mode=0o775, exist_ok=True)
+        output.write_atomic(self.cache_path, data)
+
+    def _load(self) -> Dict[str, List]:
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        return cache if isinstance(cache, dict) else {}
+
+class ContentKeys(object):
+    """
+    The content key of each bundle, in build order, and of the whole image
+    """
+    def __init__(self, bundles: Dict[str, str], image: str) -> None:
+        self.bundles = bundles
+        self.image = image
+
+    def to_dict(self) -> Dict[str, object]:
+        return dict(bundles=self.bundles, image=self.image)
+
+def hash_file(path: str, size: int = None) -> str:
+    """
+    SHA-256 of a file's content, mapping large files into memory instead of reading them
+    """
+    if size is None:
+        size = os.stat(path).st_size
+    with open(path, "rb") as f:
+        if size < HASHING_MMAP_THRESHOLD:
+            return hashlib.sha256(f.read()).hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return hashlib.sha256(m).hexdigest()
+
+def bundle_keys(crates: Iterable[Crate], hasher: FileHasher = None,
+                index: includes.FileIndex = None) -> Dict[str, str]:
+    """
+    Compute a content key for each Crate, in the order given
+
+    A key covers the Crate's definition and the content, type and executable
+    bit of every file it includes, so it changes whenever anything the
+    Crate's layers are built from changes.
+    """
+    if hasher is None:
+        hasher = FileHasher(cache_path=None)
+    if index is None:
+        index = includes.FileIndex()
+    crates = list(crates)
+    entries: Dict[str, List[Tuple[str, str, int]]] = {}
+    files = []
+    for c in crates:
+        entries[c.name] = []
+        for arcname, path in include_paths([c], index):
+            st = os.lstat(path)
+            entries[c.name].append((arcname, path, st.st_mode))
+            if stat.S_ISREG(st.st_mode):
+                files.append(path)
+    digests = hasher.digest_many(files)
+
+    keys = OrderedDict()
+    for c in crates:
+        listing = []
+        for arcname, path, mode in entries[c.name]:
+            if stat.S_ISLNK(mode):
+                listing.append([arcname, "link", os.readlink(path)])
+            elif stat.S_ISDIR(mode):
+                listing.append([arcname, "dir", ""])
+            elif stat.S_ISREG(mode):
+                listing.append([arcname, "exec" if mode & 0o111 else "file", digests[path]])
+            else:
+                raise ContextError("include {} is not a regular file, directory or symlink".format(path))
+        keys[c.name] = _digest(dict(crate=c.freeze().digest, files=listing))
+    return keys
+
+def image_key(dockerfile: str, keys: Dict[str, str]) -> str:
+    """
+    Combine the rendered Dockerfile and the bundle keys, in build order, into one key for the image
+    """
+    return _digest(dict(dockerfile=hashlib.sha256(dockerfile.encode("utf-8")).hexdigest(),
+                        bundles=[[name, key] for name, key in keys.items()]))
+
+def _digest(value: object) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
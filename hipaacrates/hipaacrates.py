@@ -1,125 +1,356 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 import hashlib
 import os
+import shlex
 import tempfile
 
-from filelock import FileLock, Timeout
-from typing import Any, Iterable
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from . import bundles
+from . import context
 from . import crate
 from . import dockerfile
+from . import dockerignore
+from . import hashing
+from . import includes
+from . import lockfile
+from . import locking
+from . import ordering
+from . import output
 from . import services
+from . import stamp
+from . import version
 
 HIPAACRATE_FILENAME = "Hipaacrate"
 
 def hipaacrate_guard(method):
     def wrapper(self, *args, **kwargs):
-        try:
-            with self._lock:
-                return method(self, *args, **kwargs)
-        except Timeout as e:
-            raise HipaacrateLockTimeout("failed to acquire hipaacrate lock file") from e
+        with self._exclusive():
+            return method(self, *args, **kwargs)
     
     return wrapper
 
+def hipaacrate_read_guard(method):
+    def wrapper(self, *args, **kwargs):
+        with self._shared():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
 class Hipaacrates(object):
-    def __init__(self, bundle_repo: bundles.BundleRepository, filename: str = None) -> None:
+    def __init__(self, bundle_repo: bundles.BundleRepository, filename: str = None,
+                 order: ordering.OrderingPolicy = None,
+                 lock_timeout: Optional[float] = locking.LOCK_TIMEOUT) -> None:
         if filename is None:
             filename = HIPAACRATE_FILENAME
+        if order is None:
+            order = ordering.NameOrder()
         self.bundle_repo = bundle_repo
         self.filename = filename
-        self._lock = FileLock(_get_lock_file_name(), timeout=0.1)
+        self.order = order
+        self._lock = locking.ReadWriteLock(_get_lock_file_name(filename), timeout=lock_timeout)
+
+    @property
+    def lock_stats(self) -> locking.LockStats:
+        return self._lock.stats
+
+    @contextmanager
+    def _shared(self) -> Iterator[None]:
+        try:
+            with self._lock.shared():
+                yield
+        except locking.LockTimeout as e:
+            raise HipaacrateLockTimeout("failed to acquire hipaacrate lock file") from e
 
-    def _get_crate(self) -> crate.Crate:
+    @contextmanager
+    def _exclusive(self) -> Iterator[None]:
         try:
-            return crate.read_yaml(self.filename)
+            with self._lock.exclusive():
+                yield
+        except locking.LockTimeout as e:
+            raise HipaacrateLockTimeout("failed to acquire hipaacrate lock file") from e
+
+    def _get_crate(self) -> crate.FrozenCrate:
+        try:
+            return crate.read_yaml(self.filename, frozen=True)
         except FileNotFoundError as e:
             raise HipaacrateFileError("could not open Hipaacrate file") from e
     
-    def _save_crate(self, crate: crate.Crate) -> None:
-        crate.to_yaml(self.filename)
+    def _save_crate(self, c: crate.Crate) -> None:
+        c.to_yaml(self.filename)
+
+    @property
+    def lock_filename(self) -> str:
+        return self.filename + lockfile.LOCKFILE_SUFFIX
+
+    def _load_locked(self, c: crate.Crate) -> Optional[List[crate.Crate]]:
+        try:
+            lock = lockfile.read_yaml(self.lock_filename)
+        except FileNotFoundError:
+            return None
+        if not lock.is_current(c):
+            raise lockfile.LockfileError("{} is out of date, run crater lock".format(self.lock_filename))
+
+        deps = []
+        for locked in lock.bundles:
+            try:
+                dep = self.bundle_repo.load_version(locked.name, locked.version)
+            except FileNotFoundError as e:
+                raise lockfile.LockfileError("locked bundle {} is not cached".format(locked)) from e
+            if dep.freeze().digest != locked.digest:
+                raise lockfile.LockfileError("digest mismatch for locked bundle {}".format(locked))
+            deps.append(dep)
+        return deps
+
+    def _load_graph(self, c: crate.Crate) -> Tuple[List[crate.Crate], bool]:
+        # Load dependencies for the local Hipaacrate, pinned by the lockfile if there is one
+        deps = self._load_locked(c)
+        if deps is not None:
+            return deps, True
+        return bundles.load_dependencies(c, self.bundle_repo), False
+
+    def _make_scripts(self, c: crate.Crate, deps: List[crate.Crate]) -> Dict[str, str]:
+        scripts = services.make_scripts(deps)
+        scripts[c.name] = services.make_script(c)
+        return scripts
 
     @hipaacrate_guard
     def init_file(self, name: str, version: str) -> None:
         c = crate.new(name, version)
         c.to_yaml(self.filename)
     
-    @hipaacrate_guard
-    def build_dockerfile(self):
+    def _build_settings(self, options: dockerfile.RenderOptions) -> Dict[str, Any]:
+        return dict(
+            base_image=dockerfile.DEFAULT_BASE_IMAGE,
+            cache_dir=os.path.abspath(self.bundle_repo.cache_dir),
+            order=self.order.to_dict(),
+            render=options.to_dict(),
+            version=version.__version__,
+        )
+
+    @hipaacrate_read_guard
+    def build_dockerfile(self, force: bool = False, options: dockerfile.RenderOptions = None) -> List[str]:
+        """
+        Write the Dockerfile, service scripts and .dockerignore, returning the paths that changed
+
+        Unless ``force`` is set, nothing is done when the build stamp shows that
+        no input changed since the last build.
+        """
+        if options is None:
+            options = dockerfile.RenderOptions()
+        settings = self._build_settings(options)
+        if not force:
+            previous = stamp.read()
+            if previous is not None and previous.is_current(settings):
+                return []
+
         c = self._get_crate()
-        # Load dependencies for the local Hipaacrate
-        deps = bundles.load_dependencies(c, self.bundle_repo)
+        deps, locked = self._load_graph(c)
         # Make shell scripts for the necessary services
-        scripts = services.make_scripts(deps)
-        cmd = services.make_script(c)
-        scripts[c.name] = cmd
-        services.to_file(scripts)
+        scripts = self._make_scripts(c, deps)
+        writer = output.OutputWriter()
+        services.to_file(scripts, writer)
         # Finally, make the Dockerfile
-        dockerfile.make_file(c, deps)
-    
+        index = includes.FileIndex(cache_path=includes.INDEX_FILENAME)
+        dockerfile.make_file(c, deps, resolved=locked, writer=writer, options=options, order=self.order,
+                             index=index)
+        index.save()
+        # Keep the build context down to the files the Dockerfile copies
+        dockerignore.make_file([c] + deps, writer)
+
+        inputs = [self.filename, self.lock_filename]
+        inputs.extend(os.path.join(self.bundle_repo.cache_dir, d.name) for d in deps)
+        outputs = ["Dockerfile"]
+        if dockerignore.is_generated():
+            outputs.append(dockerignore.DOCKERIGNORE_FILENAME)
+        outputs.extend(os.path.join(services.HIPAACRATES_WORK_DIR, "{}.sh".format(name)) for name in sorted(scripts))
+        stamp.new(settings, inputs, outputs, dirs=index.directories()).write()
+        return writer.changed
+
+    @hipaacrate_read_guard
+    def write_context(self, fileobj: BinaryIO, options: dockerfile.RenderOptions = None) -> str:
+        """
+        Stream the build context as a tar, returning its SHA-256
+
+        The tar holds the rendered Dockerfile, the service scripts and every
+        included file, so it can be piped to ``docker build -`` without the
+        working directory being scanned. Nothing is written to disk.
+        """
+        c = self._get_crate()
+        deps, locked = self._load_graph(c)
+        scripts = self._make_scripts(c, deps)
+        index = includes.FileIndex(cache_path=includes.INDEX_FILENAME)
+        content = dockerfile.make(c, deps, resolved=locked, options=options, order=self.order, index=index) + "\n"
+        return context.write(fileobj, content, scripts, [c] + deps, index)
+
+    @hipaacrate_read_guard
+    def content_keys(self, options: dockerfile.RenderOptions = None,
+                     max_workers: int = hashing.HASHING_MAX_WORKERS) -> hashing.ContentKeys:
+        """
+        Hash the includes of every bundle, returning a key per bundle and for the whole image
+
+        Digests of unchanged files are taken from the hash cache, so only new
+        or modified files are read.
+        """
+        c = self._get_crate()
+        deps, locked = self._load_graph(c)
+        resolved = deps + [c] if locked else bundles.resolve_dependencies(c, deps, self.order)
+        hasher = hashing.FileHasher(max_workers=max_workers)
+        index = includes.FileIndex(cache_path=includes.INDEX_FILENAME)
+        keys = hashing.bundle_keys(resolved, hasher, index)
+        hasher.save()
+        content = dockerfile.make(c, resolved[:-1], resolved=True, options=options, index=index)
+        return hashing.ContentKeys(keys, hashing.image_key(content, keys))
+
     @hipaacrate_guard
-    def add_bundles(self, *names: str):
+    def lock_dependencies(self) -> lockfile.Lockfile:
         c = self._get_crate()
-        combined = set(c.bundles) | set(names)
-        c.bundles = list(combined)
-        c.bundles.sort()
-        self._save_crate(c)
+        deps = bundles.load_dependencies(c, self.bundle_repo)
+        resolved = bundles.resolve_dependencies(c, deps, self.order)[:-1]
+        lock = lockfile.new(c, resolved)
+        lock.to_yaml(self.lock_filename)
+        return lock
     
-    @hipaacrate_guard
+    @hipaacrate_read_guard
+    def fetch_bundles(self, refresh: bool = False) -> None:
+        c = self._get_crate()
+        self.bundle_repo.fetch_graph(c, save_to_disk=True, refresh=refresh)
+
+    @contextmanager
+    def transaction(self) -> Iterator["Transaction"]:
+        """
+        Edit the Hipaacrate under a single lock, with one read and one write
+
+        The Hipaacrate is saved atomically when the block exits, and only if
+        it changed; if the block raises, nothing is saved.
+        """
+        with self._exclusive():
+            original = self._get_crate()
+            txn = Transaction(original)
+            yield txn
+            if txn.crate != original:
+                self._save_crate(txn.crate)
+
+    def add_bundles(self, *names: str):
+        with self.transaction() as txn:
+            txn.add_bundles(*names)
+
     def remove_bundles(self, *names: str):
+        with self.transaction() as txn:
+            txn.remove_bundles(*names)
+
+    def include_files(self, *names: str):
+        with self.transaction() as txn:
+            txn.include_files(*names)
+
+    def omit_files(self, *names: str):
+        with self.transaction() as txn:
+            txn.omit_files(*names)
+
+    @hipaacrate_read_guard
+    def get_value(self, key: str) -> Any:
         c = self._get_crate()
+        return getattr(c, key)
+
+    def set_value(self, key: str, value: Any) -> Any:
+        with self.transaction() as txn:
+            return txn.set_value(key, value)
+
+class Transaction(object):
+    """
+    A batch of edits to a Hipaacrate, applied to an in-memory copy
+
+    See ``Hipaacrates.transaction``.
+    """
+    def __init__(self, c: crate.FrozenCrate) -> None:
+        self.crate = c
+
+    def add_bundles(self, *names: str) -> None:
+        combined = set(self.crate.bundles) | set(names)
+        self.crate = self.crate.replace(bundles=sorted(combined))
+
+    def remove_bundles(self, *names: str) -> None:
         to_remove = set(names)
-        existing = set(c.bundles)
+        existing = set(self.crate.bundles)
         if not existing >= to_remove:
             raise ValueError("no bundles named {} added".format(", ".join(to_remove - existing)))
-        else:
-            c.bundles = list(existing - to_remove)
-            c.bundles.sort()
-            self._save_crate(c)
+        self.crate = self.crate.replace(bundles=sorted(existing - to_remove))
 
-    @hipaacrate_guard
-    def include_files(self, *names: str):
-        c = self._get_crate()
-        combined = set(c.includes) | set(names)
-        c.includes = list(combined)
-        c.includes.sort()
-        self._save_crate(c)
+    def include_files(self, *names: str) -> None:
+        # Order matters once includes contain ! exclusions, so new includes are appended
+        combined = list(self.crate.includes)
+        combined.extend(name for name in names if name not in combined)
+        self.crate = self.crate.replace(includes=combined)
 
-    @hipaacrate_guard
-    def omit_files(self, *names: str):
-        c = self._get_crate()
+    def omit_files(self, *names: str) -> None:
         to_remove = set(names)
-        existing = set(c.includes)
+        existing = set(self.crate.includes)
         if not existing >= to_remove:
             raise ValueError("no files named {} included".format(", ".join(to_remove - existing)))
-        else:
-            c.includes = list(existing - to_remove)
-            c.includes.sort()
-            self._save_crate(c)
+        self.crate = self.crate.replace(includes=[i for i in self.crate.includes if i not in to_remove])
 
-    @hipaacrate_guard
     def get_value(self, key: str) -> Any:
-        c = self._get_crate()
-        return getattr(c, key)
-    
-    @hipaacrate_guard
+        return getattr(self.crate, key)
+
     def set_value(self, key: str, value: Any) -> Any:
-        c = self._get_crate()
-        prev = getattr(c, key)
-        setattr(c, key, value)
+        prev = getattr(self.crate, key)
+        self.crate = self.crate.replace(**{key: value})
         return prev
 
+    def apply(self, operation: str, *args: str) -> None:
+        """
+        Apply one operation, written as the crater command that would perform it
+        """
+        if operation not in OPERATIONS:
+            raise ValueError("unknown operation {}, expected one of {}".format(operation, ", ".join(OPERATIONS)))
+        if operation == "set":
+            if len(args) != 2 or args[0] not in SETTABLE_KEYS:
+                raise ValueError("set expects a key ({}) and a value".format(", ".join(SETTABLE_KEYS)))
+            self.set_value(*args)
+            return
+        if not args:
+            raise ValueError("{} expects one or more arguments".format(operation))
+        getattr(self, OPERATIONS[operation])(*args)
+
+OPERATIONS = OrderedDict([
+    ("add", "add_bundles"),
+    ("remove", "remove_bundles"),
+    ("include", "include_files"),
+    ("omit", "omit_files"),
+    ("set", "set_value"),
+])
+SETTABLE_KEYS = ("author", "name", "run_command", "version")
+
+def parse_operations(text: str) -> List[Tuple[int, List[str]]]:
+    """
+    Parse one operation per line, as (line number, words) pairs
+
+    Words are split like a shell would; blank lines and ``#`` comments are
+    skipped.
+    """
+    operations = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        try:
+            words = shlex.split(line, comments=True)
+        except ValueError as e:
+            raise ValueError("line {}: {}".format(number, e)) from e
+        if words:
+            operations.append((number, words))
+    return operations
+
 class HipaacrateFileError(Exception):
     pass
 
 class HipaacrateLockTimeout(Exception):
     pass
 
-def _get_lock_file_name() -> str:
+def _get_lock_file_name(filename: str) -> str:
+    # Keyed by the Hipaacrate itself, so unrelated files in one directory don't contend
     return os.path.join(
         tempfile.gettempdir(),
-        _hash_cwd(),
+        "hipaacrates-{}.lock".format(_hash_path(filename)),
     )
 
-def _hash_cwd() -> str:
-    return hashlib.sha256(os.getcwdb()).hexdigest()
\ No newline at end of file
+def _hash_path(filename: str) -> str:
+    return hashlib.sha256(os.fsencode(os.path.realpath(filename))).hexdigest()
\ No newline at end of file
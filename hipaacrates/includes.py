@@ -0,0 +1,253 @@
+"""
+Expansion of crate includes: literal paths, glob patterns and ``!`` exclusions
+
+Includes are applied in order. A literal path is kept as written; a glob
+(``*``, ``?``, ``[...]``, and ``**`` for any number of directories) adds
+every matching file or directory; a ``!`` include removes whatever it
+matches from the includes before it. Directory listings come from a
+FileIndex, so each directory is scanned at most once per build.
+"""
+from collections import OrderedDict
+import json
+import os
+import posixpath
+import re
+import time
+
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from . import output
+from .services import HIPAACRATES_WORK_DIR
+
+INDEX_FILENAME = os.path.join(HIPAACRATES_WORK_DIR, "files.json")
+# Directories modified this recently may still change within the same mtime,
+# so their listings are not cached.
+INDEX_RACY_WINDOW_NS = 2 * 10 ** 9
+
+_GLOB_CHARS = set("*?[")
+
+Entry = Tuple[str, str, bool]
+
+class FileIndex(object):
+    """
+    Directory listings of a tree, each read with one ``os.scandir``
+
+    Listings are reused while a directory's modification time is unchanged,
+    within a build and, if ``cache_path`` is set, across builds. The work
+    directory is never listed.
+    """
+    def __init__(self, root: str = ".", cache_path: Optional[str] = None) -> None:
+        self.root = root
+        self.cache_path = cache_path
+        self.scans = 0
+        self._cached = self._load()
+        self._listings: Dict[str, List] = {}
+
+    def listdir(self, path: str) -> List[Tuple[str, bool]]:
+        """
+        List a directory as sorted (name, is directory) pairs, or nothing if it is not a directory
+        """
+        listing = self._listings.get(path)
+        if listing is not None:
+            return listing[1]
+        full = os.path.join(self.root, path)
+        try:
+            mtime = os.stat(full).st_mtime_ns
+            cached = self._cached.get(path)
+            if cached is not None and cached[0] == mtime:
+                entries = [(name, is_dir) for name, is_dir in cached[1]]
+            else:
+                with os.scandir(full) as it:
+                    entries = sorted((e.name, e.is_dir(follow_symlinks=False)) for e in it)
+                self.scans += 1
+        except (FileNotFoundError, NotADirectoryError):
+            mtime, entries = None, []
+        if path == "." or path == "":
+            entries = [(name, is_dir) for name, is_dir in entries if name != HIPAACRATES_WORK_DIR]
+        self._listings[path] = [mtime, entries]
+        return entries
+
+    def isdir(self, path: str) -> bool:
+        full = os.path.join(self.root, path)
+        return os.path.isdir(full) and not os.path.islink(full)
+
+    def walk(self, path: str) -> Iterator[Tuple[str, bool]]:
+        """
+        Yield every path below a directory, parents before their contents
+        """
+        for name, is_dir in self.listdir(path):
+            child = name if path in (".", "") else posixpath.join(path, name)
+            yield child, is_dir
+            if is_dir:
+                yield from self.walk(child)
+
+    def directories(self) -> List[str]:
+        """
+        The directories listed so far
+        """
+        return sorted(path for path, (mtime, _) in self._listings.items() if mtime is not None)
+
+    def save(self) -> None:
+        if self.cache_path is None:
+            return
+        now = time.time_ns()
+        cache = dict((path, listing) for path, listing in self._listings.items()
+                     if listing[0] is not None and now - listing[0] > INDEX_RACY_WINDOW_NS)
+        data = json.dumps(cache, sort_keys=True).encode("utf-8")
+        os.makedirs(os.path.dirname(self.cache_path) or ".", mode=0o775, exist_ok=True)
+        output.write_if_changed(self.cache_path, data)
+
+    def _load(self) -> Dict[str, List]:
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        return cache if isinstance(cache, dict) else {}
+
+def is_pattern(include: str) -> bool:
+    """
+    Check whether an include is a glob or an exclusion rather than a literal path
+    """
+    return include.startswith("!") or any(ch in _GLOB_CHARS for ch in include)
+
+def normalize(path: str) -> str:
+    """
+    Clean an include the way Docker does, relative to the build context
+    """
+    return posixpath.normpath(path.replace(os.sep, "/")).lstrip("/") or "."
+
+def expand(includes: Iterable[str], index: FileIndex = None) -> List[Entry]:
+    """
+    Expand includes into (path, base, is directory) entries
+
+    A file ends up in the Crate's WORKDIR at its path relative to ``base``; a
+    directory's contents end up at the directory's path relative to
+    ``base``. Literal paths are their own base, like a plain COPY, while
+    glob matches keep their full path. Directories whose contents are all
+    matched are returned as a single entry.
+    """
+    if index is None:
+        index = FileIndex()
+    selected: Dict[str, Tuple[str, bool]] = OrderedDict()
+    for include in includes:
+        negate = include.startswith("!")
+        pattern = normalize(include[1:] if negate else include)
+        if negate:
+            selected = _exclude(selected, _matcher(pattern), index)
+        elif not is_pattern(pattern):
+            is_dir = include.endswith("/") or index.isdir(pattern)
+            selected.setdefault(pattern, (pattern if is_dir else posixpath.dirname(pattern) or ".", is_dir))
+        else:
+            matches = _match(pattern, index)
+            for path, is_dir in _compact(matches, index):
+                selected.setdefault(path, (".", is_dir))
+    return [(path, base, is_dir) for path, (base, is_dir) in selected.items()]
+
+def _match(pattern: str, index: FileIndex) -> List[Tuple[str, bool]]:
+    # Only the part of the tree below the pattern's literal prefix is listed
+    segments = pattern.split("/")
+    prefix = []
+    for segment in segments[:-1]:
+        if is_pattern(segment):
+            break
+        prefix.append(segment)
+    root = "/".join(prefix) or "."
+
+    matcher = _matcher(pattern)
+    matches = []
+    # The walk lists a directory's contents right after it, so the contents
+    # of a matched directory can be skipped by prefix.
+    skip = None
+    for path, is_dir in index.walk(root):
+        if skip is not None and path.startswith(skip):
+            continue
+        skip = None
+        if matcher(path):
+            matches.append((path, is_dir))
+            if is_dir:
+                skip = path + "/"
+    return matches
+
+def _compact(matches: List[Tuple[str, bool]], index: FileIndex) -> List[Tuple[str, bool]]:
+    # Replace directories whose every entry matched by the directory itself,
+    # until no directory is left with all of its entries matched.
+    matched = OrderedDict(matches)
+    while True:
+        parents = OrderedDict()
+        for path in matched:
+            parent = posixpath.dirname(path)
+            if parent:
+                parents.setdefault(parent, []).append(path)
+        complete = set(parent for parent, children in parents.items()
+                       if parent not in matched and
+                       len(children) == len(index.listdir(parent)) and index.listdir(parent))
+        if not complete:
+            return list(matched.items())
+        compacted = OrderedDict()
+        for path, is_dir in matched.items():
+            parent = posixpath.dirname(path)
+            if parent in complete:
+                compacted.setdefault(parent, True)
+            else:
+                compacted[path] = is_dir
+        matched = compacted
+
+def _exclude(selected: Dict[str, Tuple[str, bool]], matcher: Callable[[str], bool],
+             index: FileIndex) -> Dict[str, Tuple[str, bool]]:
+    result: Dict[str, Tuple[str, bool]] = OrderedDict()
+
+    def visit(path, base, is_dir):
+        if matcher(path):
+            return
+        if is_dir and any(matcher(p) for p, _ in index.walk(path)):
+            # Split the directory so the excluded paths can be left out
+            for name, child_is_dir in index.listdir(path):
+                visit(name if path == "." else posixpath.join(path, name), base, child_is_dir)
+        else:
+            result.setdefault(path, (base, is_dir))
+
+    for path, (base, is_dir) in selected.items():
+        visit(path, base, is_dir)
+    return result
+
+def _matcher(pattern: str) -> Callable[[str], bool]:
+    regex = re.compile(_translate(pattern))
+
+    def match(path: str) -> bool:
+        return regex.match(path) is not None
+    return match
+
+def _translate(pattern: str) -> str:
+    i, n = 0, len(pattern)
+    parts = []
+    while i < n:
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[":
+            end = pattern.find("]", i + 2)
+            if end == -1:
+                parts.append(re.escape("["))
+                i += 1
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                parts.append("[{}]".format(body.replace("\\", "\\\\")))
+                i = end + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(parts) + r"\Z"
@@ -0,0 +1,187 @@
+"""
+Repository indexes: what bundles a repository has, and what changed since a revision
+
+An index lists the name, version, digest and bundle references of every
+bundle. Each change to a repository bumps its revision, and every entry
+records the revision it last changed at, so a client that has seen revision
+``N`` only needs the entries changed after ``N``. Revisions are only
+comparable within one ``epoch``; when a server's epoch changes, clients
+start over with a full index.
+"""
+from collections import OrderedDict
+import json
+import os
+import threading
+import uuid
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import yaml
+
+from . import crate
+from . import output
+
+INDEX_FILENAME = ".index.json"
+
+class IndexEntry(object):
+    __slots__ = ("name", "version", "digest", "bundles", "revision")
+
+    def __init__(self, name: str, version: str, digest: str, bundles: Iterable[str] = None,
+                 revision: int = 0) -> None:
+        self.name = name
+        self.version = version
+        self.digest = digest
+        self.bundles = list(bundles or [])
+        self.revision = revision
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, IndexEntry):
+            return self.to_dict() == other.to_dict()
+        return NotImplemented
+
+    def __str__(self) -> str:
+        return "{}:{}".format(self.name, self.version)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(name=self.name, version=self.version, digest=self.digest, bundles=self.bundles,
+                    revision=self.revision)
+
+    def same_bundle(self, other: Optional["IndexEntry"]) -> bool:
+        """
+        Check whether two entries describe the same bundle, whatever revision they were recorded at
+        """
+        return other is not None and (self.name, self.version, self.digest, self.bundles) == \
+            (other.name, other.version, other.digest, other.bundles)
+
+    @classmethod
+    def from_dict(cls, value: Dict[str, Any]) -> "IndexEntry":
+        return cls(value["name"], value["version"], value["digest"], value.get("bundles"), value.get("revision", 0))
+
+class RepositoryIndex(object):
+    """
+    The bundles of a repository as of one revision
+    """
+    def __init__(self, entries: Iterable[IndexEntry] = (), revision: int = 0, epoch: str = "") -> None:
+        self.entries: Dict[str, IndexEntry] = OrderedDict((e.name, e) for e in sorted(entries, key=lambda e: e.name))
+        self.revision = revision
+        self.epoch = epoch
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, name: str) -> Optional[IndexEntry]:
+        return self.entries.get(name)
+
+    def apply(self, delta: Dict[str, Any]) -> Tuple[List[IndexEntry], List[str]]:
+        """
+        Apply a delta from a repository, returning the entries that changed and the names removed
+
+        A delta marked ``full`` replaces the whole index.
+        """
+        incoming = [IndexEntry.from_dict(value) for value in delta.get("bundles", [])]
+        if delta.get("full"):
+            names = set(e.name for e in incoming)
+            removed = sorted(name for name in self.entries if name not in names)
+            merged: Dict[str, IndexEntry] = {}
+        else:
+            removed = sorted(name for name in delta.get("removed", []) if name in self.entries)
+            merged = dict((name, e) for name, e in self.entries.items() if name not in removed)
+        changed = [e for e in incoming if not e.same_bundle(self.entries.get(e.name))]
+        for e in incoming:
+            merged[e.name] = e
+        self.entries = OrderedDict((name, merged[name]) for name in sorted(merged))
+        self.revision = delta["revision"]
+        self.epoch = delta.get("epoch", self.epoch)
+        return changed, removed
+
+    def delta(self, since: int = 0, epoch: str = None) -> Dict[str, Any]:
+        """
+        The changes after revision ``since``, or the whole index if ``epoch`` is not this index's epoch
+        """
+        full = since <= 0 or epoch != self.epoch or since > self.revision
+        bundles = [e.to_dict() for e in self.entries.values() if full or e.revision > since]
+        return dict(epoch=self.epoch, revision=self.revision, full=full, bundles=bundles)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(epoch=self.epoch, revision=self.revision, bundles=[e.to_dict() for e in self.entries.values()])
+
+    def save(self, filepath: str) -> None:
+        output.write_atomic(filepath, json.dumps(self.to_dict(), sort_keys=True).encode("utf-8"))
+
+def read(filepath: str) -> RepositoryIndex:
+    """
+    Load a saved index, or an empty one if there is none
+    """
+    try:
+        with open(filepath) as f:
+            value = json.load(f)
+        return RepositoryIndex([IndexEntry.from_dict(e) for e in value["bundles"]], value["revision"], value["epoch"])
+    except (FileNotFoundError, KeyError, TypeError, ValueError):
+        return RepositoryIndex()
+
+class DirectoryIndex(object):
+    """
+    The index of a directory of bundles, as served by ``crater serve``
+
+    Each ``scan`` re-reads the bundles whose files changed and bumps the
+    revision if any entry was added, changed or removed. Removals are kept
+    as tombstones so deltas can report them.
+    """
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.index = RepositoryIndex(epoch=uuid.uuid4().hex)
+        self._removed: Dict[str, int] = {}
+        self._mutex = threading.Lock()
+
+    def scan(self) -> RepositoryIndex:
+        with self._mutex:
+            return self._scan()
+
+    def delta(self, since: int = 0, epoch: str = None) -> Dict[str, Any]:
+        with self._mutex:
+            delta = self._scan().delta(since, epoch)
+            if not delta["full"]:
+                delta["removed"] = sorted(name for name, rev in self._removed.items() if rev > since)
+            return delta
+
+    def _scan(self) -> RepositoryIndex:
+        current: Dict[str, IndexEntry] = {}
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isfile(path):
+                continue
+            try:
+                c = crate.read_yaml(path, frozen=True)
+            except (KeyError, TypeError, ValueError, yaml.YAMLError):
+                # Not a bundle
+                continue
+            current[name] = IndexEntry(name, c.version, c.digest, c.bundles)
+
+        revision = self.index.revision + 1
+        changed = False
+        for name, entry in current.items():
+            previous = self.index.get(name)
+            if entry.same_bundle(previous):
+                entry.revision = previous.revision
+            else:
+                entry.revision = revision
+                self._removed.pop(name, None)
+                changed = True
+        for name in self.index.entries:
+            if name not in current:
+                self._removed[name] = revision
+                changed = True
+        if changed:
+            self.index = RepositoryIndex(current.values(), revision, self.index.epoch)
+        return self.index
+
+class UnknownBundleError(KeyError):
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self.name = name
+
+    def __str__(self) -> str:
+        return "bundle {} is not in the repository index".format(self.name)
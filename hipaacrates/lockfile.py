@@ -0,0 +1,94 @@
+from typing import Iterable, List
+
+import yaml
+
+from .crate import Crate, SafeDumper, SafeLoader
+from .output import write_atomic
+
+LOCKFILE_SUFFIX = ".lock"
+
+class LockedBundle(object):
+    __slots__ = ("name", "version", "digest")
+
+    def __init__(self, name: str, version: str, digest: str) -> None:
+        self.name = name
+        self.version = version
+        self.digest = digest
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, LockedBundle):
+            return (
+                self.name == other.name and
+                self.version == other.version and
+                self.digest == other.digest
+            )
+        return NotImplemented
+
+    def __str__(self) -> str:
+        return "{}:{}".format(self.name, self.version)
+
+class Lockfile(object):
+    """
+    The resolved dependency graph of a Hipaacrate
+
+    ``requires`` holds the Hipaacrate's own bundle references at the time it
+    was locked, and ``bundles`` every dependency in build order.
+    """
+    def __init__(self, requires: List[str], bundles: List[LockedBundle]) -> None:
+        self.requires = requires
+        self.bundles = bundles
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Lockfile):
+            return self.requires == other.requires and self.bundles == other.bundles
+        return NotImplemented
+
+    def is_current(self, origin: Crate) -> bool:
+        """
+        Check that the Hipaacrate has not changed its bundles since it was locked
+        """
+        return self.requires == sorted(origin.bundles)
+
+    def to_yaml(self, filepath: str = None) -> str:
+        yaml_text = yaml.dump(dict(
+            requires=self.requires,
+            bundles=[dict(name=b.name, version=b.version, digest=b.digest) for b in self.bundles],
+        ), Dumper=SafeDumper, default_flow_style=False)
+
+        if filepath is not None:
+            # Replaced atomically, so an interrupted write never leaves a truncated lockfile
+            write_atomic(filepath, yaml_text.encode("utf-8"))
+
+        return yaml_text
+
+def new(origin: Crate, resolved: Iterable[Crate]) -> Lockfile:
+    """
+    Lock a Hipaacrate to its dependencies, given in build order
+    """
+    return Lockfile(
+        requires=sorted(origin.bundles),
+        bundles=[LockedBundle(c.name, c.version, c.freeze().digest) for c in resolved],
+    )
+
+def parse(text: str) -> Lockfile:
+    """
+    Parse a Lockfile from a YAML string
+    """
+    parsed = yaml.load(text, Loader=SafeLoader)
+    try:
+        return Lockfile(
+            requires=list(parsed.get("requires") or []),
+            bundles=[LockedBundle(b["name"], b["version"], b["digest"]) for b in parsed.get("bundles") or []],
+        )
+    except (AttributeError, KeyError, TypeError) as e:
+        raise LockfileError("malformed lockfile") from e
+
+def read_yaml(filepath: str) -> Lockfile:
+    """
+    Load a Lockfile from a YAML file
+    """
+    with open(filepath) as f:
+        return parse(f.read())
+
+class LockfileError(Exception):
+    pass
@@ -0,0 +1,138 @@
+"""
+Reader/writer file locks, so read-only commands can run alongside each other
+"""
+from contextlib import contextmanager
+import os
+import random
+import threading
+import time
+
+from filelock import FileLock, Timeout
+from typing import Any, Dict, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # No shared locks without flock(); every lock is exclusive instead
+    fcntl = None
+
+LOCK_TIMEOUT = 10.0
+LOCK_POLL_INTERVAL = 0.001
+LOCK_MAX_POLL_INTERVAL = 0.1
+
+class LockStats(object):
+    """
+    How often a lock was taken and how long callers waited for it
+    """
+    def __init__(self) -> None:
+        self.acquired = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self._mutex = threading.Lock()
+
+    def record(self, waited: float, contended: bool, acquired: bool = True) -> None:
+        with self._mutex:
+            if acquired:
+                self.acquired += 1
+            else:
+                self.timeouts += 1
+            if contended:
+                self.contended += 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._mutex:
+            return dict(acquired=self.acquired, contended=self.contended, timeouts=self.timeouts,
+                        wait_time=self.wait_time, max_wait=self.max_wait)
+
+class ReadWriteLock(object):
+    """
+    A lock file that many readers or one writer can hold at a time
+
+    Each acquisition opens the lock file anew, so threads of one process
+    lock against each other just like separate processes do. A contended
+    lock is polled with exponential backoff until ``timeout`` seconds have
+    passed, or forever if ``timeout`` is None.
+    """
+    def __init__(self, path: str, timeout: Optional[float] = LOCK_TIMEOUT,
+                 poll_interval: float = LOCK_POLL_INTERVAL,
+                 max_poll_interval: float = LOCK_MAX_POLL_INTERVAL) -> None:
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.stats = LockStats()
+
+    @contextmanager
+    def shared(self) -> Iterator[None]:
+        with self._acquire(exclusive=False):
+            yield
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with self._acquire(exclusive=True):
+            yield
+
+    @contextmanager
+    def _acquire(self, exclusive: bool) -> Iterator[None]:
+        if fcntl is None:
+            with self._acquire_filelock():
+                yield
+            return
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            self._wait(lambda: _flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH))
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def _acquire_filelock(self) -> Iterator[None]:
+        lock = FileLock(self.path, timeout=0)
+
+        def try_lock():
+            try:
+                lock.acquire()
+            except Timeout:
+                return False
+            return True
+
+        self._wait(try_lock)
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def _wait(self, try_lock) -> None:
+        start = time.monotonic()
+        interval = self.poll_interval
+        contended = False
+        while not try_lock():
+            contended = True
+            waited = time.monotonic() - start
+            if self.timeout is not None and waited >= self.timeout:
+                self.stats.record(waited, contended, acquired=False)
+                raise LockTimeout("timed out after {:.2f}s waiting for {}".format(waited, self.path))
+            delay = random.uniform(interval / 2, interval)
+            if self.timeout is not None:
+                delay = min(delay, self.timeout - waited)
+            time.sleep(delay)
+            interval = min(interval * 2, self.max_poll_interval)
+        self.stats.record(time.monotonic() - start, contended)
+
+def _flock(fd: int, operation: int) -> bool:
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+class LockTimeout(Exception):
+    pass
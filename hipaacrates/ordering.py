@@ -0,0 +1,67 @@
+"""
+Policies for ordering the bundles of one topological level
+
+Bundles in the same level do not depend on each other, so any order is a
+valid build order. Docker reuses cached layers only up to the first layer
+that changed, so putting the bundles that change least first keeps more of
+the image cached.
+"""
+from abc import ABC, abstractmethod
+
+from typing import Any, Dict, Iterable, List
+
+from .crate import Crate
+
+ORDERINGS = ("name", "volatility", "history")
+
+class OrderingPolicy(ABC):
+    @abstractmethod
+    def key(self, c: Crate) -> Any:
+        """
+        Sort key of a Crate within its level; ties must not depend on input order
+        """
+
+    def sort(self, crates: Iterable[Crate]) -> List[Crate]:
+        return sorted(crates, key=self.key)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(policy=type(self).__name__)
+
+class NameOrder(OrderingPolicy):
+    """
+    Alphabetical order
+    """
+    def key(self, c: Crate) -> Any:
+        return c.name
+
+class VolatilityOrder(OrderingPolicy):
+    """
+    Stable bundles first, by the ``volatility`` hint of each bundle
+
+    Bundles without a hint use their number of ``changes``, if given, and
+    are otherwise treated as volatility 0. Ties are broken by name.
+    """
+    def __init__(self, changes: Dict[str, int] = None) -> None:
+        self.changes = changes if changes is not None else {}
+
+    def key(self, c: Crate) -> Any:
+        volatility = c.volatility if c.volatility is not None else self.changes.get(c.name, 0)
+        return (volatility, c.name)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(policy=type(self).__name__, changes=self.changes)
+
+def new(name: str, changes: Dict[str, int] = None) -> OrderingPolicy:
+    """
+    Create one of the named ORDERINGS
+
+    ``history`` orders by volatility, estimating it for bundles without a hint
+    from ``changes``, e.g. how many versions of each bundle were cached.
+    """
+    if name == "name":
+        return NameOrder()
+    if name == "volatility":
+        return VolatilityOrder()
+    if name == "history":
+        return VolatilityOrder(changes if changes is not None else {})
+    raise ValueError("unknown ordering {}, expected one of {}".format(name, ", ".join(ORDERINGS)))
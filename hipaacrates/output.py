@@ -0,0 +1,91 @@
+"""
+Writing generated files
+"""
+import hashlib
+import os
+import tempfile
+
+from typing import List, Union
+
+def _current_umask() -> int:
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+_UMASK = _current_umask()
+
+class OutputWriter(object):
+    """
+    Writes generated files atomically, leaving files whose content is unchanged untouched
+
+    Every path written or removed is recorded in ``changed``, so callers can
+    report what a build actually modified.
+    """
+    def __init__(self) -> None:
+        self.changed: List[str] = []
+
+    def write(self, path: str, content: Union[str, bytes]) -> bool:
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        if not write_if_changed(path, content):
+            return False
+        self.changed.append(path)
+        return True
+
+    def remove(self, path: str) -> bool:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        self.changed.append(path)
+        return True
+
+def write_if_changed(path: str, data: bytes) -> bool:
+    """
+    Atomically replace a file with ``data`` unless it already holds exactly that
+
+    Returns whether the file was written.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        pass
+    else:
+        if st.st_size == len(data) and digest_file(path) == hashlib.sha256(data).hexdigest():
+            return False
+    write_atomic(path, data)
+    return True
+
+def write_atomic(path: str, data: bytes, mode: int = None) -> None:
+    """
+    Write a file through a temporary file in the same directory and rename it into place,
+    so readers see either the old or the new content
+    """
+    if mode is None:
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+    directory = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".{}.".format(os.path.basename(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+def digest_file(path: str) -> str:
+    """
+    SHA-256 of a file's content, as a hex string
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,142 @@
+"""
+A reference bundle server, serving a directory of bundles over the crater protocol
+
+``GET {endpoint}/{name}`` returns one bundle as YAML, with an ETag and
+Last-Modified so it can be revalidated. ``POST {endpoint}:batch`` takes
+``{"bundles": [{"name": ..., "etag": ...}, ...]}`` and returns
+``{"bundles": [{"name", "etag", "last_modified", "body"}, ...],
+"not_modified": [...], "missing": [...]}``. ``GET {endpoint}:index``
+returns the repository index, or with ``?since=REVISION&epoch=EPOCH`` only
+the entries changed since that revision. Responses are gzipped for clients
+that accept it.
+"""
+from email.utils import formatdate
+import gzip
+import hashlib
+import json
+import os
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from . import version
+from .bundles import HIPAACRATE_BUNDLES_BATCH_ROUTE, HIPAACRATE_BUNDLES_ENDPOINT, HIPAACRATE_BUNDLES_INDEX_ROUTE
+from .index import DirectoryIndex
+
+SERVER_ADDRESS = ("127.0.0.1", 8080)
+SERVER_GZIP_MIN_SIZE = 256
+SERVER_MAX_BATCH_BODY = 1024 * 1024
+
+class BundleServer(ThreadingHTTPServer):
+    """
+    Serves the bundles in a directory, such as a crater bundle cache
+    """
+    daemon_threads = True
+
+    def __init__(self, directory: str, address: Tuple[str, int] = SERVER_ADDRESS,
+                 endpoint: str = HIPAACRATE_BUNDLES_ENDPOINT) -> None:
+        super().__init__(address, BundleRequestHandler)
+        self.directory = directory
+        self.endpoint = "/" + endpoint.strip("/")
+        self.index = DirectoryIndex(directory)
+
+    def read_bundle(self, name: str) -> Optional[Dict[str, Any]]:
+        """
+        Read a bundle with its validators, or None if there is no such bundle
+        """
+        # Hidden files hold cache metadata, and anything with a separator is outside the directory
+        if not name or name.startswith(".") or "/" in name or os.sep in name:
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as f:
+                body = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
+        return dict(
+            body=body,
+            etag='"{}"'.format(hashlib.sha256(body).hexdigest()[:32]),
+            last_modified=formatdate(mtime, usegmt=True),
+        )
+
+class BundleRequestHandler(BaseHTTPRequestHandler):
+    server: BundleServer
+    protocol_version = "HTTP/1.1"
+    server_version = "crater/{}".format(version.__version__)
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        if path == self.server.endpoint + HIPAACRATE_BUNDLES_INDEX_ROUTE:
+            self._send_index(parse_qs(url.query))
+            return
+        prefix = self.server.endpoint + "/"
+        bundle = self.server.read_bundle(path[len(prefix):]) if path.startswith(prefix) else None
+        if bundle is None:
+            self._send(404, b"Not Found", "text/plain")
+            return
+
+        headers = {"ETag": bundle["etag"], "Last-Modified": bundle["last_modified"]}
+        if bundle["etag"] in _header_values(self.headers.get("If-None-Match", "")):
+            self._send(304, b"", None, headers)
+        else:
+            self._send(200, bundle["body"], "application/x-yaml", headers)
+
+    def do_POST(self) -> None:
+        if urlsplit(self.path).path != self.server.endpoint + HIPAACRATE_BUNDLES_BATCH_ROUTE:
+            self._send(404, b"Not Found", "text/plain")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+            if length > SERVER_MAX_BATCH_BODY:
+                raise ValueError("batch request too large")
+            requested = json.loads(self.rfile.read(length).decode("utf-8"))["bundles"]
+            entries = [(str(entry["name"]), entry.get("etag")) for entry in requested]
+        except (KeyError, TypeError, ValueError):
+            self.close_connection = True
+            self._send(400, b"Bad Request", "text/plain")
+            return
+
+        found, not_modified, missing = [], [], []
+        for name, etag in entries:
+            bundle = self.server.read_bundle(name)
+            if bundle is None:
+                missing.append(name)
+            elif bundle["etag"] == etag:
+                not_modified.append(name)
+            else:
+                found.append(dict(name=name, etag=bundle["etag"], last_modified=bundle["last_modified"],
+                                  body=bundle["body"].decode("utf-8")))
+        body = json.dumps(dict(bundles=found, not_modified=not_modified, missing=missing))
+        self._send(200, body.encode("utf-8"), "application/json")
+
+    def _send_index(self, query: Dict[str, List[str]]) -> None:
+        try:
+            since = int(query.get("since", ["0"])[0])
+        except ValueError:
+            self._send(400, b"Bad Request", "text/plain")
+            return
+        delta = self.server.index.delta(since, query.get("epoch", [None])[0])
+        self._send(200, json.dumps(delta).encode("utf-8"), "application/json")
+
+    def _send(self, status: int, body: bytes, content_type: Optional[str],
+              headers: Dict[str, str] = None) -> None:
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if content_type is not None:
+            self.send_header("Content-Type", content_type)
+            self.send_header("Vary", "Accept-Encoding")
+            accepted = _header_values(self.headers.get("Accept-Encoding", ""))
+            if len(body) >= SERVER_GZIP_MIN_SIZE and "gzip" in accepted:
+                body = gzip.compress(body)
+                self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def _header_values(header: str) -> List[str]:
+    # Comma-separated header values, with any parameters like ;q=1 dropped
+    return [value.split(";")[0].strip() for value in header.split(",") if value.strip()]
@@ -1,8 +1,9 @@
 import os
 
-from typing import Dict, Iterable, Optional
+from typing import Dict, Iterable, List, Optional
 
 from .crate import Crate
+from .output import OutputWriter
 
 HIPAACRATES_WORK_DIR = ".hipaacrates"
 
@@ -14,8 +15,23 @@ def make_script(crate: Crate) -> str:
         return "#!/bin/sh\n\n{}".format(crate.run_command)
     return ""
 
-def to_file(scripts: Dict[str, str]) -> None:
+def to_file(scripts: Dict[str, str], writer: OutputWriter = None) -> List[str]:
+    """
+    Write service scripts into the work directory, removing scripts of services that no longer exist
+
+    Returns the paths that changed.
+    """
+    if writer is None:
+        writer = OutputWriter()
+    start = len(writer.changed)
+
     os.makedirs(HIPAACRATES_WORK_DIR, mode=0o775, exist_ok=True)
-    for name, content in scripts.items():
-        with open(os.path.join(HIPAACRATES_WORK_DIR, "{}.sh".format(name)), "w") as f:
-            f.write(content + "\n")
+    filenames = set()
+    for name, content in sorted(scripts.items()):
+        filename = "{}.sh".format(name)
+        filenames.add(filename)
+        writer.write(os.path.join(HIPAACRATES_WORK_DIR, filename), content + "\n")
+    for filename in sorted(os.listdir(HIPAACRATES_WORK_DIR)):
+        if filename.endswith(".sh") and filename not in filenames:
+            writer.remove(os.path.join(HIPAACRATES_WORK_DIR, filename))
+    return writer.changed[start:]
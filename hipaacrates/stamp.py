@@ -0,0 +1,110 @@
+"""
+Build stamps, which let ``crater build`` skip work when none of its inputs changed
+"""
+import json
+import os
+
+from typing import Any, Dict, Iterable, List, Optional
+
+from . import output
+from .services import HIPAACRATES_WORK_DIR
+
+STAMP_FILENAME = os.path.join(HIPAACRATES_WORK_DIR, "build.stamp")
+
+class BuildStamp(object):
+    """
+    The settings, inputs and outputs of a finished build
+
+    Each file is recorded with its stat signature and content digest (or
+    ``None`` if it did not exist), so checking an unchanged build only takes
+    a ``stat`` per file. ``dirs`` records the modification times of the
+    directories include patterns were matched against, so adding or removing
+    a file there invalidates the build.
+    """
+    def __init__(self, settings: Dict[str, Any], inputs: Dict[str, Optional[List]],
+                 outputs: Dict[str, Optional[List]], filepath: str = STAMP_FILENAME,
+                 dirs: Dict[str, Optional[int]] = None) -> None:
+        self.settings = settings
+        self.inputs = inputs
+        self.outputs = outputs
+        self.filepath = filepath
+        self.dirs = dirs if dirs is not None else {}
+
+    def is_current(self, settings: Dict[str, Any]) -> bool:
+        """
+        Check whether a build with ``settings`` would reproduce the recorded outputs
+
+        Files whose stat signature changed are compared by digest; if their
+        content is the same, their new signatures are recorded so the next
+        check is stat-only again.
+        """
+        if settings != self.settings:
+            return False
+        if any(_mtime(path) != mtime for path, mtime in self.dirs.items()):
+            return False
+        refreshed = False
+        for files in (self.inputs, self.outputs):
+            for path, state in files.items():
+                current = _stat(path)
+                if state is None or current is None:
+                    if state is not current:
+                        return False
+                elif current != state[:3]:
+                    if output.digest_file(path) != state[3]:
+                        return False
+                    files[path] = current + [state[3]]
+                    refreshed = True
+        if refreshed:
+            self.write()
+        return True
+
+    def to_json(self) -> str:
+        return json.dumps(dict(settings=self.settings, inputs=self.inputs, outputs=self.outputs, dirs=self.dirs),
+                          sort_keys=True, indent=2)
+
+    def write(self) -> None:
+        os.makedirs(os.path.dirname(self.filepath) or ".", mode=0o775, exist_ok=True)
+        output.write_atomic(self.filepath, self.to_json().encode("utf-8"))
+
+def new(settings: Dict[str, Any], inputs: Iterable[str], outputs: Iterable[str],
+        filepath: str = STAMP_FILENAME, dirs: Iterable[str] = ()) -> BuildStamp:
+    """
+    Record the current state of a build's input and output files, and of the directories it listed
+    """
+    return BuildStamp(
+        settings=settings,
+        inputs=dict((path, file_state(path)) for path in inputs),
+        outputs=dict((path, file_state(path)) for path in outputs),
+        filepath=filepath,
+        dirs=dict((path, _mtime(path)) for path in dirs),
+    )
+
+def read(filepath: str = STAMP_FILENAME) -> Optional[BuildStamp]:
+    """
+    Load a BuildStamp, or return None if there is no usable stamp
+    """
+    try:
+        with open(filepath) as f:
+            parsed = json.load(f)
+        return BuildStamp(parsed["settings"], parsed["inputs"], parsed["outputs"], filepath, parsed.get("dirs"))
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return None
+
+def file_state(path: str) -> Optional[List]:
+    current = _stat(path)
+    if current is None:
+        return None
+    return current + [output.digest_file(path)]
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _stat(path: str) -> Optional[List]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_ino, st.st_mtime_ns, st.st_size]
@@ -0,0 +1,275 @@
+"""
+Analysis of package-manager build steps, used to deduplicate and merge them across bundles
+
+Only simple ``apt-get``/``apt`` and ``pip`` commands are understood: a single
+command with known flags and plain package names, without any shell syntax.
+Every other build step is left exactly as written.
+"""
+import re
+import shlex
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .crate import Crate
+
+APT_LISTS_DIR = "/var/lib/apt/lists"
+
+_APT_COMMANDS = ("apt-get", "apt")
+_APT_UPDATE_FLAGS = {"-q", "-qq", "--quiet", "-y", "--yes"}
+_APT_INSTALL_FLAGS = {"-q", "-qq", "--quiet", "-y", "--yes", "--assume-yes", "--no-install-recommends"}
+_APT_PACKAGE = re.compile(r"^[a-z0-9][a-z0-9.+\-]*(:[a-z0-9\-]+)?(=[A-Za-z0-9.+:~\-]+)?$")
+_PIP_LAUNCHERS = (("pip",), ("pip3",), ("python", "-m", "pip"), ("python3", "-m", "pip"))
+_PIP_INSTALL_FLAGS = {"-q", "--quiet", "--no-cache-dir", "-U", "--upgrade"}
+_PIP_REQUIREMENT = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._\-]*(\[[A-Za-z0-9._,\-]+\])?([<>=!~]=?[A-Za-z0-9.*+!\-]+,?)*$")
+_REMOVALS = {"remove", "purge", "autoremove", "uninstall"}
+# Steps mentioning these delete the apt lists or change the sources and keys they come from
+_APT_LISTS_STALE = (APT_LISTS_DIR, "/etc/apt", "add-apt-repository", "apt-key")
+
+class PackageStep(object):
+    """
+    A parsed ``apt-get update``, ``apt-get install`` or ``pip install`` step
+    """
+    __slots__ = ("command", "action", "flags", "packages")
+
+    def __init__(self, command: Tuple[str, ...], action: str, flags: Iterable[str], packages: Iterable[str]) -> None:
+        self.command = command
+        self.action = action
+        self.flags = tuple(flags)
+        self.packages = tuple(packages)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, PackageStep):
+            return (
+                self.command == other.command and
+                self.action == other.action and
+                self.flags == other.flags and
+                self.packages == other.packages
+            )
+        return NotImplemented
+
+    @property
+    def manager(self) -> str:
+        """
+        The namespace packages are installed into: ``apt``, or the pip launcher
+        """
+        if self.command[0] in _APT_COMMANDS:
+            return "apt"
+        return " ".join(self.command)
+
+    def replace(self, packages: Iterable[str]) -> "PackageStep":
+        return PackageStep(self.command, self.action, self.flags, packages)
+
+    def render(self) -> str:
+        words = list(self.command) + [self.action] + list(self.flags) + [shlex.quote(p) for p in self.packages]
+        return " ".join(words)
+
+def parse_step(step: str) -> Optional[PackageStep]:
+    """
+    Parse a build step if it is a simple package-manager command
+    """
+    words = _split(step)
+    if not words:
+        return None
+
+    if words[0] in _APT_COMMANDS and len(words) >= 2:
+        command, action, args = tuple(words[:1]), words[1], words[2:]
+        flags = [a for a in args if a.startswith("-")]
+        packages = [a for a in args if not a.startswith("-")]
+        if action == "update" and not packages and set(flags) <= _APT_UPDATE_FLAGS:
+            return PackageStep(command, action, flags, [])
+        if (action == "install" and packages and set(flags) <= _APT_INSTALL_FLAGS and
+                all(_APT_PACKAGE.match(p) for p in packages)):
+            return PackageStep(command, action, flags, packages)
+        return None
+
+    for launcher in _PIP_LAUNCHERS:
+        n = len(launcher)
+        if tuple(words[:n]) == launcher and len(words) > n + 1 and words[n] == "install":
+            args = words[n + 1:]
+            flags = [a for a in args if a.startswith("-")]
+            packages = [a for a in args if not a.startswith("-")]
+            if packages and set(flags) <= _PIP_INSTALL_FLAGS and all(_PIP_REQUIREMENT.match(p) for p in packages):
+                return PackageStep(launcher, "install", flags, packages)
+            return None
+    return None
+
+class InstallLayer(object):
+    """
+    Package installs merged from the bundles of one topological level
+
+    ``cleanup`` removes the apt lists at the end of the layer; it is only set
+    when no later step relies on the lists without refreshing them.
+    """
+    __slots__ = ("steps", "cleanup")
+
+    def __init__(self, steps: List[PackageStep], cleanup: bool = False) -> None:
+        self.steps = steps
+        self.cleanup = cleanup
+
+    def commands(self) -> List[str]:
+        commands = [s.render() for s in self.steps]
+        if self.cleanup and any(s.manager == "apt" for s in self.steps):
+            apt_steps = sum(1 for s in self.steps if s.manager == "apt")
+            commands.insert(apt_steps, "rm -rf {}/*".format(APT_LISTS_DIR))
+        return commands
+
+Group = Tuple[InstallLayer, List[Crate]]
+
+def coalesce(levels: Iterable[Iterable[Crate]], pip_cache: bool = False) -> List[Group]:
+    """
+    Merge the leading package installs of the bundles in each topological level
+
+    Returns, for every level, the merged install layer to run before it and
+    the level's bundles with those steps removed. apt installs are merged per
+    set of flags and pip installs per launcher. A bundle's apt steps are left
+    alone if its remaining steps still call apt. Merged pip installs skip
+    pip's cache unless ``pip_cache`` is set.
+    """
+    groups = [_coalesce_level(level, pip_cache) for level in levels]
+
+    # Removing the apt lists is only safe if nothing later installs from them
+    # without an update of its own.
+    needs_lists = False
+    for layer, crates in reversed(groups):
+        for c in reversed(crates):
+            for step in reversed(c.build_steps):
+                if _is_apt_update(step):
+                    needs_lists = False
+                elif _uses_apt(step):
+                    needs_lists = True
+        layer.cleanup = not needs_lists
+        if any(s.manager == "apt" for s in layer.steps):
+            needs_lists = False
+    return groups
+
+def _coalesce_level(level: Iterable[Crate], pip_cache: bool) -> Group:
+    updates: List[PackageStep] = []
+    installs: Dict[Tuple, List[str]] = {}
+    crates = []
+    for c in level:
+        parsed = []
+        for step in c.build_steps:
+            package_step = parse_step(step)
+            if package_step is None:
+                break
+            parsed.append(package_step)
+        rest = list(c.build_steps[len(parsed):])
+        merge_apt = (any(s.manager == "apt" and s.action == "install" for s in parsed) and
+                     not any(_uses_apt(step) for step in rest))
+        consumed = [s for s in parsed if merge_apt or s.manager != "apt"]
+        kept = [step for step, s in zip(c.build_steps, parsed) if s.manager == "apt" and not merge_apt]
+        rest = kept + rest
+
+        for s in consumed:
+            if s.action == "update":
+                updates.append(s)
+                continue
+            flags = set(s.flags) - {"-q", "-qq", "--quiet", "--yes", "--assume-yes"}
+            if s.manager == "apt":
+                flags.add("-y")
+            elif not pip_cache:
+                flags.add("--no-cache-dir")
+            packages = installs.setdefault((s.command, tuple(sorted(flags))), [])
+            packages.extend(p for p in s.packages if p not in packages)
+        crates.append(c if len(rest) == len(c.build_steps) else c.freeze().replace(build_steps=rest))
+
+    merged = [PackageStep(command, "install", flags, sorted(packages))
+              for (command, flags), packages in sorted(installs.items())]
+    # apt steps first, so the lists can be removed before the pip installs
+    merged.sort(key=lambda s: s.manager != "apt")
+    if any(s.manager == "apt" for s in merged):
+        command = updates[0].command if updates else ("apt-get",)
+        merged.insert(0, PackageStep(command, "update", ["-q"], []))
+    return InstallLayer(merged), crates
+
+def dedupe(groups: Iterable[Group]) -> List[Group]:
+    """
+    Drop package installs and apt list updates that an earlier step already ran
+
+    ``groups`` are the install layers and bundles of each level, in build
+    order. A package stays installed until a step removes packages. The apt
+    lists stay fresh until a step deletes them or changes the apt sources or
+    keys, unless that step updates the lists again itself.
+    """
+    installed: Dict[str, Set[str]] = {}
+    state = dict(apt_lists_fresh=False)
+
+    def keep(s: PackageStep) -> Optional[PackageStep]:
+        if s.action == "update":
+            if state["apt_lists_fresh"]:
+                return None
+            state["apt_lists_fresh"] = True
+            return s
+        seen = installed.setdefault(s.manager, set())
+        remaining = [p for p in s.packages if p not in seen]
+        seen.update(s.packages)
+        if not remaining:
+            return None
+        return s if len(remaining) == len(s.packages) else s.replace(remaining)
+
+    result = []
+    for layer, crates in groups:
+        # A merged layer keeps its own update, since it may remove the lists again
+        steps = [s if s.action == "update" else keep(s) for s in layer.steps]
+        steps = [s for s in steps if s is not None]
+        if not any(s.manager == "apt" and s.action == "install" for s in steps):
+            steps = [s for s in steps if s.action != "update"]
+        elif layer.cleanup:
+            state["apt_lists_fresh"] = False
+        else:
+            state["apt_lists_fresh"] = True
+
+        deduped = []
+        for c in crates:
+            kept_steps = []
+            for step in c.build_steps:
+                package_step = parse_step(step)
+                if package_step is None:
+                    if any(marker in step for marker in _APT_LISTS_STALE):
+                        state["apt_lists_fresh"] = _is_apt_update(step) and APT_LISTS_DIR not in step
+                    if _REMOVALS & set(_split(step) or step.split()):
+                        installed.clear()
+                    kept_steps.append(step)
+                    continue
+                kept = keep(package_step)
+                if kept is package_step:
+                    kept_steps.append(step)
+                elif kept is not None:
+                    kept_steps.append(kept.render())
+            deduped.append(c if kept_steps == list(c.build_steps) else c.freeze().replace(build_steps=kept_steps))
+        result.append((InstallLayer(steps, layer.cleanup), deduped))
+    return result
+
+def package_managers(step: str) -> Set[str]:
+    """
+    Guess which package managers, ``apt`` or ``pip``, a build step runs
+    """
+    words = _split(step) or step.split()
+    managers = set()
+    if any(w in _APT_COMMANDS for w in words):
+        managers.add("apt")
+    if any(w in ("pip", "pip3") for w in words):
+        managers.add("pip")
+    return managers
+
+def _is_apt_update(step: str) -> bool:
+    words = _split(step) or step.split()
+    return any(w in _APT_COMMANDS for w in words) and "update" in words
+
+def _uses_apt(step: str) -> bool:
+    words = _split(step) or step.split()
+    return any(w in _APT_COMMANDS or w == "apt-cache" for w in words)
+
+def _split(step: str) -> Optional[List[str]]:
+    # Only plain commands are analysed: no operators, expansions or line breaks
+    if "\n" in step or "\\" in step:
+        return None
+    lexer = shlex.shlex(step.strip(), posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        words = list(lexer)
+    except ValueError:
+        return None
+    if any(w and (set(w) <= set("();<>|&") or "$" in w or "`" in w) for w in words):
+        return None
+    return words
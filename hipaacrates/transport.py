@@ -0,0 +1,174 @@
+"""
+Requests to a bundle repository that tolerate slow, failing and unreachable hosts
+
+A repository can be served by several mirror hosts. Every request goes to
+the healthiest, fastest host and is retried, with jittered exponential
+backoff, on connection errors, timeouts and 5xx responses, failing over to
+the other hosts. A host that fails several requests in a row is skipped
+until a cool-down passes.
+"""
+import random
+import threading
+import time
+
+import requests
+from typing import Callable, Iterable, List, Optional
+
+TRANSPORT_CONNECT_TIMEOUT = 5.0
+TRANSPORT_RETRIES = 3
+TRANSPORT_BACKOFF = 0.2
+TRANSPORT_MAX_BACKOFF = 5.0
+TRANSPORT_FAILURE_THRESHOLD = 3
+TRANSPORT_RESET_TIMEOUT = 30.0
+# Weight of the newest sample in a host's moving average latency
+TRANSPORT_LATENCY_WEIGHT = 0.3
+
+# Failures of an attempt that another attempt, or another host, may not have;
+# a connection dropped or garbled partway through the body counts too
+_RETRIED_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ContentDecodingError,
+)
+
+class HostState(object):
+    """
+    A host's moving average latency and circuit breaker
+    """
+    def __init__(self, host: str, position: int) -> None:
+        self.host = host
+        self.position = position
+        self.latency: Optional[float] = None
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        # Whether a request is testing this host while its circuit is open
+        self.probing = False
+
+class HostPool(object):
+    """
+    Chooses among mirror hosts by health, then latency, then the order given
+
+    After ``failure_threshold`` consecutive failures a host's circuit opens
+    and it is skipped for ``reset_timeout`` seconds. Then one probe request
+    is let through, and other callers keep skipping the host until it ends:
+    a success closes the circuit, and a failure opens it again. If every
+    circuit is open, the host that has been skipped longest is probed anyway
+    rather than failing without a request. Once every host is being probed,
+    ``choose`` raises HostsUnavailable.
+    """
+    def __init__(self, hosts: Iterable[str], failure_threshold: int = TRANSPORT_FAILURE_THRESHOLD,
+                 reset_timeout: float = TRANSPORT_RESET_TIMEOUT, clock: Callable[[], float] = time.monotonic) -> None:
+        self.hosts = [HostState(host.rstrip("/"), i) for i, host in enumerate(hosts)]
+        if not self.hosts:
+            raise ValueError("at least one host is required")
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._mutex = threading.Lock()
+
+    def choose(self, exclude: Iterable[str] = ()) -> HostState:
+        """
+        Pick the host for the next attempt, preferring hosts not in ``exclude``
+
+        The attempt must end with ``succeeded``, ``failed`` or ``released``.
+        """
+        exclude = set(exclude)
+        now = self.clock()
+        with self._mutex:
+            idle = [h for h in self.hosts if not h.probing]
+            if not idle:
+                raise HostsUnavailable("every bundle host is failing")
+            ready = [h for h in idle if h.opened_at is None or now - h.opened_at >= self.reset_timeout]
+            if ready:
+                fresh = [h for h in ready if h.host not in exclude] or ready
+                state = min(fresh, key=lambda h: (h.failures, h.latency or 0.0, h.position))
+            else:
+                state = min(idle, key=lambda h: h.opened_at)
+            state.probing = state.opened_at is not None
+            return state
+
+    def succeeded(self, state: HostState, latency: float) -> None:
+        with self._mutex:
+            state.probing = False
+            if state.latency is None:
+                state.latency = latency
+            else:
+                state.latency += TRANSPORT_LATENCY_WEIGHT * (latency - state.latency)
+            state.failures = 0
+            state.opened_at = None
+
+    def failed(self, state: HostState) -> None:
+        with self._mutex:
+            state.probing = False
+            state.failures += 1
+            if state.failures >= self.failure_threshold:
+                state.opened_at = self.clock()
+
+    def released(self, state: HostState) -> None:
+        """
+        End an attempt that neither succeeded nor failed because of the host
+        """
+        with self._mutex:
+            state.probing = False
+
+class Transport(object):
+    """
+    Sends requests for repository paths to a HostPool, retrying failed attempts
+
+    Up to ``retries`` further attempts are made after a connection error,
+    timeout, truncated or undecodable body, or 5xx response, each on the best host that has not failed this
+    request yet, after a random delay of up to ``backoff`` seconds, doubled
+    with every attempt.
+    """
+    def __init__(self, session: requests.Session, hosts: HostPool, retries: int = TRANSPORT_RETRIES,
+                 backoff: float = TRANSPORT_BACKOFF, max_backoff: float = TRANSPORT_MAX_BACKOFF,
+                 sleep: Callable[[float], None] = time.sleep) -> None:
+        self.session = session
+        self.hosts = hosts
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Send a request for a path on the repository, returning the first response that is not a 5xx
+
+        Keyword arguments, such as a ``(connect, read)`` timeout, are passed
+        to the session. If every attempt fails, the last 5xx response is
+        returned, or the last error raised.
+        """
+        failed: List[str] = []
+        attempt = 0
+        while True:
+            try:
+                state = self.hosts.choose(exclude=failed)
+            except HostsUnavailable:
+                if attempt >= self.retries:
+                    raise
+            else:
+                start = time.monotonic()
+                try:
+                    r = self.session.request(method, state.host + path, **kwargs)
+                except _RETRIED_ERRORS:
+                    self.hosts.failed(state)
+                    if attempt >= self.retries:
+                        raise
+                except BaseException:
+                    self.hosts.released(state)
+                    raise
+                else:
+                    if r.status_code < 500:
+                        self.hosts.succeeded(state, time.monotonic() - start)
+                        return r
+                    self.hosts.failed(state)
+                    if attempt >= self.retries:
+                        return r
+                    r.close()
+                failed.append(state.host)
+            self.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+            attempt += 1
+
+class HostsUnavailable(requests.ConnectionError):
+    pass
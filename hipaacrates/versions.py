@@ -0,0 +1,307 @@
+"""
+Version constraints on bundle references, and a resolver that picks a version of every bundle
+
+A bundle reference is a name with an optional constraint after a colon:
+
+- ``foo`` or ``foo:*`` allows any version
+- ``foo:1.2.3`` or ``foo:=1.2.3`` allows exactly 1.2.3
+- ``foo:>=1.2,<2`` allows versions within the range; comparisons are
+  ``=``, ``!=``, ``<``, ``<=``, ``>`` and ``>=``, joined by commas
+- ``foo:^1.2.3`` allows 1.2.3 up to, but not including, the next version
+  that changes the first non-zero part: 2.0.0 here, 0.3.0 for ``^0.2.3``
+"""
+from collections import OrderedDict
+import re
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from typing_extensions import Protocol
+
+VersionKey = Tuple[Any, ...]
+
+_COMPARISON = re.compile(r"^(==|=|!=|<=|>=|<|>)?\s*(\S+)$")
+# Returned by Resolver._descend once every bundle is decided
+_SOLVED: Set[str] = set()
+
+_OPERATORS: Dict[str, Callable[[VersionKey, VersionKey], bool]] = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+def version_key(version: str) -> VersionKey:
+    """
+    A sort key for a version string
+
+    Versions are split into dot-separated numeric parts, which compare as
+    numbers and ignore trailing zeros, so ``1.2`` equals ``1.2.0``. A
+    suffix after ``-`` marks a pre-release, which sorts before the release.
+    """
+    release, _, pre = str(version).strip().lstrip("v").partition("-")
+    parts = [_part(p) for p in release.split(".")]
+    while len(parts) > 1 and parts[-1] == (1, 0, ""):
+        parts.pop()
+    # A release sorts after every pre-release of it
+    return (tuple(parts), (0, tuple(_part(p) for p in pre.split("."))) if pre else (1, ()))
+
+def _part(text: str) -> Tuple[int, int, str]:
+    # Numbers sort after words, so 1.0.rc sorts before 1.0.0
+    return (1, int(text), "") if text.isdigit() else (0, 0, text)
+
+class Constraint(object):
+    """
+    A set of allowed versions, parsed from the text after the colon of a bundle reference
+    """
+    def __init__(self, text: str = "") -> None:
+        self.text = text.strip()
+        self._checks: List[Tuple[Callable[[VersionKey, VersionKey], bool], VersionKey]] = []
+        for clause in (c.strip() for c in self.text.split(",")):
+            if clause in ("", "*"):
+                continue
+            if clause.startswith("^"):
+                lower = clause[1:].strip()
+                self._checks.append((_OPERATORS[">="], version_key(lower)))
+                self._checks.append((_OPERATORS["<"], version_key(_caret_upper(lower))))
+                continue
+            match = _COMPARISON.match(clause)
+            if match is None:
+                raise ConstraintError("invalid version constraint {!r}".format(self.text))
+            operator = match.group(1) or "="
+            self._checks.append((_OPERATORS["=" if operator == "==" else operator], version_key(match.group(2))))
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Constraint):
+            return self.text == other.text
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(self.text)
+
+    def __str__(self) -> str:
+        return self.text or "*"
+
+    def allows(self, version: str) -> bool:
+        return self.allows_key(version_key(version))
+
+    def allows_key(self, key: VersionKey) -> bool:
+        return all(check(key, bound) for check, bound in self._checks)
+
+def _caret_upper(version: str) -> str:
+    parts = version.split("-")[0].split(".")
+    for i, part in enumerate(parts):
+        if not part.isdigit():
+            raise ConstraintError("invalid caret constraint ^{}".format(version))
+        if int(part) != 0 or i == len(parts) - 1:
+            return ".".join(parts[:i] + [str(int(part) + 1)])
+    return version
+
+def parse_reference(reference: str) -> Tuple[str, Constraint]:
+    """
+    Split a ``name:constraint`` bundle reference
+    """
+    name, _, text = reference.partition(":")
+    return name.strip(), Constraint(text)
+
+class VersionProvider(Protocol):
+    def versions(self, name: str) -> List[str]:
+        ...
+
+    def dependencies(self, name: str, version: str) -> List[str]:
+        ...
+
+class Resolver(object):
+    """
+    Picks one version of every bundle in a graph, so that every constraint is met
+
+    The search decides the bundle with the fewest allowed versions first and
+    tries its versions newest first. A failed choice returns the set of
+    decisions that caused the conflict: the search backjumps straight to
+    the most recent of them, and remembers the combination so it is never
+    tried again. Versions and dependencies are only read once from the
+    provider. The search keeps its own stack rather than recursing, so the
+    depth of a graph is not limited by the interpreter's recursion limit.
+    """
+    def __init__(self, provider: VersionProvider, max_steps: int = 1000000) -> None:
+        self.provider = provider
+        self.max_steps = max_steps
+        self.steps = 0
+        self._versions: Dict[str, List[Tuple[VersionKey, str]]] = {}
+        self._dependencies: Dict[Tuple[str, str], List[Tuple[str, Constraint]]] = {}
+
+    def resolve(self, references: Iterable[str], requirer: str = "") -> Dict[str, str]:
+        """
+        Choose a version for each referenced bundle and everything it depends on
+
+        Returns the chosen version of every bundle, keyed by name in the order
+        they were decided. Raises ResolutionError, with an explanation, when
+        the constraints cannot all be met.
+        """
+        self.steps = 0
+        self._requirer = requirer
+        self._constraints: Dict[str, List[Tuple[Constraint, str]]] = OrderedDict()
+        self._decisions: Dict[str, str] = OrderedDict()
+        self._nogoods: Dict[Tuple[str, str], List[frozenset]] = {}
+        self._failure: Optional[str] = None
+        for reference in references:
+            name, constraint = parse_reference(reference)
+            self._constraints.setdefault(name, []).append((constraint, requirer))
+
+        conflict = self._search()
+        if conflict is not None:
+            raise ResolutionError(self._failure or "no combination of versions satisfies every constraint")
+        return OrderedDict(self._decisions)
+
+    def versions(self, name: str) -> List[Tuple[VersionKey, str]]:
+        """
+        The known versions of a bundle, newest first, with their sort keys
+        """
+        known = self._versions.get(name)
+        if known is None:
+            known = sorted(((version_key(v), v) for v in set(self.provider.versions(name))), reverse=True)
+            self._versions[name] = known
+        return known
+
+    def dependencies(self, name: str, version: str) -> List[Tuple[str, Constraint]]:
+        key = (name, version)
+        deps = self._dependencies.get(key)
+        if deps is None:
+            deps = [parse_reference(reference) for reference in self.provider.dependencies(name, version)]
+            self._dependencies[key] = deps
+        return deps
+
+    def _allowed(self, name: str) -> List[str]:
+        constraints = [c for c, _ in self._constraints[name]]
+        return [v for key, v in self.versions(name) if all(c.allows_key(key) for c in constraints)]
+
+    def _requirers(self, name: str) -> Set[str]:
+        return set(requirer for _, requirer in self._constraints.get(name, []))
+
+    def _search(self) -> Optional[Set[str]]:
+        # Returns None once every bundle is decided, or the decisions behind a conflict.
+        # frames[-1] is the latest bundle decided; a conflict returned to it means
+        # the search below its current version failed.
+        frames: List[_Frame] = []
+        cause = self._descend(frames)
+        while cause is not _SOLVED:
+            if cause is not None:
+                if not frames:
+                    return cause
+                frame = frames[-1]
+                self._learn(cause)
+                self._undo(frame.name, frame.version)
+                if frame.name not in cause:
+                    # This bundle's version had nothing to do with the conflict
+                    frames.pop()
+                    continue
+                frame.conflict |= cause - {frame.name}
+            cause = self._advance(frames[-1])
+            if cause is None:
+                cause = self._descend(frames)
+            else:
+                frames.pop()
+        return None
+
+    def _descend(self, frames: List["_Frame"]) -> Optional[Set[str]]:
+        # Open a frame for the next bundle to decide, returning _SOLVED if there is
+        # none, or a conflict if no version of it is allowed
+        self.steps += 1
+        if self.steps > self.max_steps:
+            raise ResolutionError("gave up after {} steps".format(self.max_steps))
+
+        pending = [name for name in self._constraints if name not in self._decisions]
+        if not pending:
+            return _SOLVED
+        name, allowed = min(((n, self._allowed(n)) for n in pending), key=lambda item: len(item[1]))
+        conflict = self._requirers(name)
+        if not allowed:
+            self._explain(name)
+            return conflict
+        frames.append(_Frame(name, allowed, conflict))
+        return None
+
+    def _advance(self, frame: "_Frame") -> Optional[Set[str]]:
+        # Decide the next version of a frame's bundle that doesn't clash at once,
+        # returning None, or the conflict to pass back once the frame is done
+        while frame.remaining:
+            version = frame.remaining.pop()
+            cause = self._known_conflict(frame.name, version)
+            if cause is None:
+                cause = self._decide(frame.name, version)
+                if cause is None:
+                    frame.version = version
+                    return None
+                self._learn(cause)
+                self._undo(frame.name, version)
+            if frame.name not in cause:
+                return cause
+            frame.conflict |= cause - {frame.name}
+        return frame.conflict
+
+    def _decide(self, name: str, version: str) -> Optional[Set[str]]:
+        # Record a decision and the constraints it adds, returning a conflict if it clashes
+        self._decisions[name] = version
+        for dep, constraint in self.dependencies(name, version):
+            self._constraints.setdefault(dep, []).append((constraint, name))
+        for dep, constraint in self.dependencies(name, version):
+            decided = self._decisions.get(dep)
+            if decided is not None and not constraint.allows(decided):
+                self._explain(dep)
+                return {name, dep}
+            if decided is None and not self._allowed(dep):
+                self._explain(dep)
+                return self._requirers(dep)
+        return None
+
+    def _undo(self, name: str, version: str) -> None:
+        for dep, _ in reversed(self.dependencies(name, version)):
+            constraints = self._constraints[dep]
+            constraints.pop()
+            if not constraints and dep not in self._decisions:
+                del self._constraints[dep]
+        del self._decisions[name]
+
+    def _known_conflict(self, name: str, version: str) -> Optional[Set[str]]:
+        # A combination of decisions already known to fail, if deciding this version would repeat it
+        for nogood in self._nogoods.get((name, version), []):
+            if all(n == name or self._decisions.get(n) == v for n, v in nogood):
+                return set(n for n, _ in nogood)
+        return None
+
+    def _learn(self, cause: Set[str]) -> None:
+        decided = frozenset((n, self._decisions[n]) for n in cause if n in self._decisions)
+        if decided and len(decided) == len(cause):
+            for item in decided:
+                self._nogoods.setdefault(item, []).append(decided)
+
+    def _explain(self, name: str) -> None:
+        required = ", ".join("{} (required by {})".format(constraint, self._describe(requirer))
+                             for constraint, requirer in self._constraints.get(name, []))
+        known = [v for _, v in self.versions(name)]
+        if not known:
+            self._failure = "no versions of {} are available; it is required as {}".format(name, required)
+        else:
+            self._failure = "no version of {} satisfies {}; available: {}".format(
+                name, required, ", ".join(reversed(known)))
+
+    def _describe(self, requirer: str) -> str:
+        if requirer == self._requirer:
+            return requirer or "the Hipaacrate"
+        return "{} {}".format(requirer, self._decisions.get(requirer, ""))
+
+class _Frame(object):
+    __slots__ = ("name", "remaining", "conflict", "version")
+
+    def __init__(self, name: str, allowed: List[str], conflict: Set[str]) -> None:
+        self.name = name
+        # Popped from the end, so the newest version is tried first
+        self.remaining = list(reversed(allowed))
+        self.conflict = conflict
+        self.version: Optional[str] = None
+
+class ConstraintError(ValueError):
+    pass
+
+class ResolutionError(ValueError):
+    pass
@@ -1,11 +1,14 @@
+import json
 import os
+import shutil
 import tempfile
+import time
 
 import pytest
 import requests
 import responses
 
-from hipaacrates import bundles, crate
+from hipaacrates import bundles, cache, crate, index, ordering, versions
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 CACHE_DIR = os.path.join(HERE, "fixtures")
@@ -73,6 +76,67 @@ def test_load_dependencies(crate_obj):
     assert "bar" in names
     assert "baz" in names
 
+class CountingBundleLoader(bundles.BundleLoader):
+    def __init__(self, graph):
+        self.graph = graph
+        self.calls = []
+
+    def load(self, name):
+        self.calls.append(name)
+        return crate.new(name, "0.0.1", bundles=self.graph[name])
+
+def test_load_dependencies_unquoted_versions(tmpdir):
+    # Hand-written bundles often leave numeric versions unquoted
+    tmpdir.join("foo").write("name: foo\nversion: 1.0\nbundles: ['bar:^2']\n")
+    tmpdir.join("bar").write("name: bar\nversion: 2.1\n")
+    origin = crate.new("mycrate", "0.0.1", bundles=["foo"])
+
+    repo = bundles.BundleRepository(MOCK_HOST, cache_dir=str(tmpdir))
+    assert repo.versions("foo") == ["1.0"]
+    dependencies = bundles.load_dependencies(origin, repo)
+    assert [(c.name, c.version) for c in dependencies] == [("foo", "1.0"), ("bar", "2.1")]
+
+def test_load_dependencies_order():
+    loader = CountingBundleLoader({
+        "a": ["c", "b"],
+        "b": ["d"],
+        "c": ["d", "e"],
+        "d": [],
+        "e": ["b"],
+    })
+    origin = crate.new("origin", "0.0.1", bundles=["a", "e:0.0.1"])
+
+    dependencies = bundles.load_dependencies(origin, loader)
+    assert [d.name for d in dependencies] == ["a", "c", "d", "e", "b"]
+
+def test_load_dependencies_loads_each_bundle_once():
+    graph = {"base": []}
+    for i in range(40):
+        graph["mid{}".format(i)] = ["base"]
+    graph["top"] = sorted(n for n in graph if n.startswith("mid"))
+    loader = CountingBundleLoader(graph)
+    origin = crate.new("origin", "0.0.1", bundles=["top", "base"])
+
+    dependencies = bundles.load_dependencies(origin, loader)
+    assert len(dependencies) == 42
+    assert sorted(loader.calls) == sorted(graph)
+
+def test_load_dependencies_reuses_cache():
+    loader = CountingBundleLoader({"a": ["b"], "b": []})
+    cache = {}
+    bundles.load_dependencies(crate.new("x", "0.0.1", bundles=["a"]), loader, cache)
+    bundles.load_dependencies(crate.new("y", "0.0.1", bundles=["b", "a"]), loader, cache)
+    assert loader.calls == ["a", "b"]
+
+def test_load_dependencies_deep_chain():
+    depth = 5000
+    graph = {"b{}".format(i): ["b{}".format(i + 1)] for i in range(depth)}
+    graph["b{}".format(depth)] = []
+    origin = crate.new("origin", "0.0.1", bundles=["b0"])
+
+    dependencies = bundles.load_dependencies(origin, CountingBundleLoader(graph))
+    assert len(dependencies) == depth + 1
+
 def test_resolve_dependencies(crate_obj):
     loader = MockBundleLoader()
     deps = [loader.load(n) for n in ["foo", "bar", "baz"]]
@@ -92,6 +156,71 @@ def test_resolve_dependencies_circular(crate_obj):
     with pytest.raises(ValueError):
         bundles.resolve_dependencies(crate_obj, deps)
 
+def test_resolve_dependencies_reports_cycle(crate_obj):
+    loader = MockCircularBundleLoader()
+    deps = [loader.load(n) for n in ["foo", "bar", "baz"]]
+
+    with pytest.raises(bundles.CircularDependencyError) as e:
+        bundles.resolve_dependencies(crate_obj, deps)
+    assert e.value.cycle == ["baz", "foo", "baz"]
+    assert "baz -> foo -> baz" in str(e.value)
+
+def test_resolve_dependencies_missing_dependency(crate_obj):
+    deps = [crate.new("foo", "0.0.1", bundles=["nope"]), crate.new("bar", "0.0.1")]
+
+    with pytest.raises(ValueError):
+        bundles.resolve_dependencies(crate_obj, deps)
+
+def test_resolve_dependencies_levels():
+    origin = crate.new("origin", "0.0.1", bundles=["c", "a"])
+    deps = [
+        crate.new("c", "0.0.1", bundles=["b:1.0", "d"]),
+        crate.new("a", "0.0.1", bundles=["d"]),
+        crate.new("d", "0.0.1"),
+        crate.new("b", "0.0.1", bundles=["d"]),
+    ]
+
+    resolved = bundles.resolve_dependencies(origin, deps)
+    assert [c.name for c in resolved] == ["d", "a", "b", "c", "origin"]
+
+def test_resolve_dependencies_order():
+    origin = crate.new("origin", "0.0.1", bundles=["c", "a"])
+    deps = [
+        crate.new("c", "0.0.1", bundles=["b:1.0", "d"]),
+        crate.new("a", "0.0.1", bundles=["d"], volatility=5),
+        crate.new("d", "0.0.1"),
+        crate.new("b", "0.0.1", bundles=["d"]),
+    ]
+
+    resolved = bundles.resolve_dependencies(origin, deps, ordering.VolatilityOrder())
+    assert [c.name for c in resolved] == ["d", "b", "a", "c", "origin"]
+
+    resolved = bundles.resolve_dependencies(origin, deps, ordering.VolatilityOrder({"b": 9}))
+    assert [c.name for c in resolved] == ["d", "a", "b", "c", "origin"]
+
+def layered_graph(layers=100, width=100):
+    """
+    A graph of ``layers * width`` bundles, each depending on a handful of bundles from the layer below
+    """
+    deps = []
+    for layer in range(layers):
+        for i in range(width):
+            below = ["b{}_{}".format(layer - 1, (i + k) % width) for k in range(3)] if layer else []
+            deps.append(crate.new("b{}_{}".format(layer, i), "0.0.1", bundles=below))
+    origin = crate.new("origin", "0.0.1", bundles=["b{}_{}".format(layers - 1, i) for i in range(width)])
+    return origin, deps
+
+def test_resolve_dependencies_10k_bundles():
+    origin, deps = layered_graph()
+    resolved = bundles.resolve_dependencies(origin, deps)
+
+    assert len(resolved) == len(deps) + 1
+    assert resolved[0].name == "b0_0"
+    assert resolved[-1].name == "origin"
+    position = dict((c.name, i) for i, c in enumerate(resolved))
+    for c in resolved:
+        assert all(position[d] < position[c.name] for d in c.bundles)
+
 def test_bundle_repository_load():
     repo = bundles.BundleRepository(host="", cache_dir=CACHE_DIR)
     c = repo.load("foo")
@@ -135,6 +264,8 @@ def test_bundle_repository_download_save_to_disk(crate_obj):
         assert os.path.isfile(os.path.join(HERE, "fixtures", crate_obj.name))
     finally:
         os.remove(os.path.join(HERE, "fixtures", crate_obj.name))
+        shutil.rmtree(os.path.join(HERE, "fixtures", cache.HIPAACRATE_STORE_DIR), ignore_errors=True)
+        shutil.rmtree(os.path.join(HERE, "fixtures", bundles.HIPAACRATE_BUNDLES_LOCK_DIR), ignore_errors=True)
 
 def test_bundle_repository_remove():
     repo = bundles.BundleRepository(host="", cache_dir=CACHE_DIR)
@@ -142,3 +273,241 @@ def test_bundle_repository_remove():
     os.close(fd)
     repo.remove(name)
     assert not os.path.isfile(name)
+
+@responses.activate
+def test_bundle_repository_download_many():
+    names = ["bundle{}".format(i) for i in range(10)]
+    for name in names:
+        responses.add(responses.GET, "{}/bundles/{}".format(MOCK_HOST, name),
+                      body=crate.new(name, "0.0.1").to_yaml())
+
+    http_loader = bundles.BundleRepository(MOCK_HOST, cache_dir=CACHE_DIR, max_workers=4)
+    crates = http_loader.download_many(names + names[:3])
+    assert [c.name for c in crates] == names
+    assert len(responses.calls) == len(names)
+
+@responses.activate
+def test_bundle_repository_fetch_graph(tmpdir):
+    graph = {
+        "foo": ["bar", "baz:0.0.2"],
+        "bar": ["qux"],
+        "baz": ["qux"],
+        "qux": [],
+    }
+    for name, deps in graph.items():
+        version = "0.0.2" if name == "baz" else "0.0.1"
+        responses.add(responses.GET, "{}/bundles/{}".format(MOCK_HOST, name),
+                      body=crate.new(name, version, bundles=deps).to_yaml())
+    responses.add(responses.POST, "{}/bundles:batch".format(MOCK_HOST), status=404)
+
+    http_loader = bundles.BundleRepository(MOCK_HOST, cache_dir=str(tmpdir))
+    crates = http_loader.fetch_graph(crate.new("mycrate", "0.0.1", bundles=["foo"]))
+    assert [c.name for c in crates] == ["foo", "bar", "baz", "qux"]
+    # The batch route is only tried once
+    assert len(responses.calls) == 5
+    assert http_loader.batch_supported is False
+    assert sorted(os.listdir(str(tmpdir))) == [".locks", ".store", "bar", "baz", "foo", "qux"]
+
+    dependencies = bundles.load_dependencies(crate.new("mycrate", "0.0.1", bundles=["foo"]), http_loader)
+    assert sorted(d.name for d in dependencies) == ["bar", "baz", "foo", "qux"]
+
+@responses.activate
+def test_bundle_repository_refresh(tmpdir, crate_obj):
+    def respond(request):
+        if request.headers.get("If-None-Match") == '"v1"':
+            return (304, {}, "")
+        return (200, {"ETag": '"v1"', "Last-Modified": "Mon, 17 Sep 2018 00:00:00 GMT"}, crate_obj.to_yaml())
+    responses.add_callback(responses.GET, "{}/bundles/{}".format(MOCK_HOST, crate_obj.name), callback=respond)
+
+    http_loader = bundles.BundleRepository(MOCK_HOST, cache_dir=str(tmpdir))
+    assert http_loader.refresh(crate_obj.name) == crate_obj
+    assert "If-None-Match" not in responses.calls[0].request.headers
+    assert os.path.isfile(os.path.join(str(tmpdir), crate_obj.name))
+
+    assert http_loader.refresh(crate_obj.name) == crate_obj
+    assert responses.calls[1].request.headers["If-None-Match"] == '"v1"'
+    assert responses.calls[1].request.headers["If-Modified-Since"] == "Mon, 17 Sep 2018 00:00:00 GMT"
+    assert responses.calls[1].response.status_code == 304
+
+@responses.activate
+def test_bundle_repository_refresh_changed(tmpdir, crate_obj):
+    updated = crate.new(crate_obj.name, "0.0.2")
+    responses.add(responses.GET, "{}/bundles/{}".format(MOCK_HOST, crate_obj.name),
+                  body=crate_obj.to_yaml(), headers={"ETag": '"v1"'})
+    responses.add(responses.GET, "{}/bundles/{}".format(MOCK_HOST, crate_obj.name),
+                  body=updated.to_yaml(), headers={"ETag": '"v2"'})
+
+    http_loader = bundles.BundleRepository(MOCK_HOST, cache_dir=str(tmpdir))
+    http_loader.download(crate_obj.name, save_to_disk=True)
+    assert http_loader.refresh(crate_obj.name) == updated
+    assert http_loader.load(crate_obj.name) == updated
+
+    http_loader.remove(crate_obj.name)
+    assert sorted(os.listdir(str(tmpdir))) == [".locks", ".store"]
+    assert http_loader.store.lookup(crate_obj.name) is None
+
+@responses.activate
+def test_bundle_repository_refresh_missing_cache_file(tmpdir, crate_obj):
+    responses.add(responses.GET, "{}/bundles/{}".format(MOCK_HOST, crate_obj.name),
+                  body=crate_obj.to_yaml(), headers={"ETag": '"v1"'})
+
+    http_loader = bundles.BundleRepository(MOCK_HOST, cache_dir=str(tmpdir))
+    http_loader.download(crate_obj.name, save_to_disk=True)
+    os.remove(os.path.join(str(tmpdir), crate_obj.name))
+
+    assert http_loader.refresh(crate_obj.name) == crate_obj
+    assert "If-None-Match" not in responses.calls[1].request.headers
+
+@responses.activate
+def test_bundle_repository_keeps_versions(tmpdir):
+    v1 = crate.new("foo", "0.0.1")
+    v2 = crate.new("foo", "0.0.2")
+    responses.add(responses.GET, "{}/bundles/foo".format(MOCK_HOST), body=v1.to_yaml())
+    responses.add(responses.GET, "{}/bundles/foo".format(MOCK_HOST), body=v2.to_yaml())
+
+    http_loader = bundles.BundleRepository(MOCK_HOST, cache_dir=str(tmpdir))
+    http_loader.download("foo", save_to_disk=True)
+    http_loader.download("foo", save_to_disk=True)
+
+    store = http_loader.store
+    assert store.lookup("foo") == store.lookup("foo", "0.0.2")
+    assert crate.parse(store.get(store.lookup("foo", "0.0.1"))) == v1
+    assert http_loader.load("foo") == v2
+    assert store.stats()["objects"] == 2
+    assert store.stats()["names"] == 1
+    assert store.change_counts() == {"foo": 2}
+
+def test_bundle_repository_gc(tmpdir):
+    http_loader = bundles.BundleRepository(MOCK_HOST, cache_dir=str(tmpdir))
+    texts = dict((name, crate.new(name, "0.0.1").to_yaml()) for name in ["foo", "bar", "baz"])
+    for i, name in enumerate(["foo", "bar", "baz"]):
+        digest = http_loader.store.put(name, "0.0.1", texts[name])
+        with open(os.path.join(str(tmpdir), name), "w") as f:
+            f.write(texts[name])
+        os.utime(http_loader.store.object_path(digest), ns=(i * 10 ** 9, i * 10 ** 9))
+    http_loader.store.touch("foo")
+
+    # Each bundle takes its stored text plus its cached copy
+    removed = http_loader.gc(2 * (len(texts["foo"]) + len(texts["baz"])))
+    assert [entry["name"] for entry in removed] == ["bar"]
+    assert sorted(n for n in os.listdir(str(tmpdir)) if not n.startswith(".")) == ["baz", "foo"]
+    assert http_loader.store.stats()["size"] == 2 * (len(texts["foo"]) + len(texts["baz"]))
+
+    removed = http_loader.gc(0)
+    assert sorted(entry["name"] for entry in removed) == ["baz", "foo"]
+    assert http_loader.store.stats()["objects"] == 0
+
+@responses.activate
+def test_bundle_repository_size_cap_evicts_cached_copies(tmpdir):
+    texts = dict((name, crate.new(name, "0.0.1", build_steps=["make"] * 20).to_yaml()) for name in ["foo", "bar"])
+    for name, text in texts.items():
+        responses.add(responses.GET, "{}/bundles/{}".format(MOCK_HOST, name), body=text, headers={"ETag": '"v1"'})
+
+    http_loader = bundles.BundleRepository(MOCK_HOST, cache_dir=str(tmpdir), cache_max_size=3 * len(texts["foo"]))
+    http_loader.download("foo", save_to_disk=True)
+    assert http_loader.store.stats()["size"] == 2 * len(texts["foo"])
+    http_loader.download("bar", save_to_disk=True)
+
+    # foo was evicted to make room for bar, together with its cached copy
+    assert http_loader.store.lookup("foo") is None
+    with pytest.raises(FileNotFoundError):
+        http_loader.load("foo")
+    assert http_loader.load("bar").name == "bar"
+    assert http_loader.store.stats()["size"] <= 3 * len(texts["foo"])
+
+def test_bundle_store_lookup_republished_version(tmpdir):
+    store = cache.BundleStore(str(tmpdir))
+    texts = ["name: foo\nversion: 0.0.1\n# build {}\n".format(i) for i in range(4)]
+    digests = [store.put("foo", "0.0.1", text) for text in texts]
+    assert store.lookup("foo", "0.0.1") == digests[-1]
+
+    # Once a newer version is current, the last text stored for the old one wins
+    store.put("foo", "0.0.2", "name: foo\nversion: 0.0.2\n")
+    assert store.lookup("foo", "0.0.1") == digests[-1]
+    assert store.lookup("foo", "0.0.3") is None
+
+def test_bundle_store_size_cap(tmpdir):
+    store = cache.BundleStore(str(tmpdir), max_size=1024)
+    for i in range(10):
+        store.put("bundle{}".format(i), "0.0.1", "x" * 300 + str(i))
+    stats = store.stats()
+    assert stats["size"] <= 1024
+    assert store.lookup("bundle9") is not None
+    assert store.lookup("bundle0") is None
+
+def test_parse_size():
+    assert cache.parse_size("1024") == 1024
+    assert cache.parse_size("512K") == 512 * 1024
+    assert cache.parse_size("100M") == 100 * 1024 ** 2
+    assert cache.parse_size("2gb") == 2 * 1024 ** 3
+    with pytest.raises(ValueError):
+        cache.parse_size("lots")
+
+@responses.activate
+def test_bundle_repository_download_batch(tmpdir):
+    texts = dict((name, crate.new(name, "0.0.1").to_yaml()) for name in ["foo", "bar", "baz"])
+
+    def respond(request):
+        requested = [entry["name"] for entry in json.loads(request.body)["bundles"]]
+        found = [dict(name=name, etag='"{}"'.format(name), body=texts[name]) for name in requested if name != "baz"]
+        return (200, {}, json.dumps(dict(bundles=found)))
+    responses.add_callback(responses.POST, "{}/bundles:batch".format(MOCK_HOST), callback=respond)
+    responses.add(responses.GET, "{}/bundles/baz".format(MOCK_HOST), body=texts["baz"])
+
+    http_loader = bundles.BundleRepository(MOCK_HOST, cache_dir=str(tmpdir), batch_size=2)
+    crates = http_loader.download_batch(["foo", "bar", "baz", "foo"], save_to_disk=True)
+    assert [c.name for c in crates] == ["foo", "bar", "baz"]
+    # Two batches, then a GET for the bundle neither returned
+    assert [call.request.method for call in responses.calls] == ["POST", "POST", "GET"]
+    assert http_loader.load("bar").name == "bar"
+    assert http_loader._read_validators("foo") == {"etag": '"foo"'}
+
+@responses.activate
+def test_bundle_repository_download_batch_refresh(tmpdir):
+    text = crate.new("foo", "0.0.1").to_yaml()
+
+    def respond(request):
+        entry = json.loads(request.body)["bundles"][0]
+        if entry.get("etag") == '"v1"':
+            return (200, {}, json.dumps(dict(not_modified=["foo"])))
+        return (200, {}, json.dumps(dict(bundles=[dict(name="foo", etag='"v1"', body=text)])))
+    responses.add_callback(responses.POST, "{}/bundles:batch".format(MOCK_HOST), callback=respond)
+
+    http_loader = bundles.BundleRepository(MOCK_HOST, cache_dir=str(tmpdir))
+    assert http_loader.download_batch(["foo"], refresh=True)[0].name == "foo"
+    assert http_loader.download_batch(["foo"], refresh=True)[0].name == "foo"
+    assert json.loads(responses.calls[1].request.body) == {"bundles": [{"name": "foo", "etag": '"v1"'}]}
+
+def test_index_closure():
+    repository_index = index.RepositoryIndex([
+        index.IndexEntry("foo", "0.0.1", "a", ["bar", "baz:0.0.2"]),
+        index.IndexEntry("bar", "0.0.1", "b", ["qux"]),
+        index.IndexEntry("baz", "0.0.2", "c", ["qux"]),
+        index.IndexEntry("qux", "0.0.1", "d"),
+    ])
+    assert [e.name for e in bundles.index_closure(repository_index, ["foo"])] == ["foo", "bar", "baz", "qux"]
+    with pytest.raises(index.UnknownBundleError):
+        bundles.index_closure(repository_index, ["foo", "missing"])
+
+def test_load_dependencies_selects_versions(tmpdir):
+    repo = bundles.BundleRepository(MOCK_HOST, cache_dir=str(tmpdir))
+    for c in [crate.new("lib", "1.0"), crate.new("lib", "2.0"),
+              crate.new("web", "1.0", bundles=["lib:^1"])]:
+        repo.store.put(c.name, c.version, c.to_yaml())
+        c.to_yaml(os.path.join(str(tmpdir), c.name))
+
+    dependencies = bundles.load_dependencies(crate.new("mycrate", "0.0.1", bundles=["web"]), repo)
+    assert [(d.name, d.version) for d in dependencies] == [("web", "1.0"), ("lib", "1.0")]
+
+    with pytest.raises(versions.ResolutionError):
+        bundles.load_dependencies(crate.new("mycrate", "0.0.1", bundles=["web", "lib:>=2"]), repo)
+
+if __name__ == "__main__":
+    # A standalone benchmark, timed on graphs of growing size; from the
+    # repository root: PYTHONPATH=. python tests/bundles_test.py
+    for layers, width in [(10, 100), (100, 100), (100, 1000)]:
+        origin, deps = layered_graph(layers, width)
+        start = time.perf_counter()
+        resolved = bundles.resolve_dependencies(origin, deps)
+        print("{:6} bundles in {:3} layers: ordered in {:7.3f}s".format(
+            len(deps), layers, time.perf_counter() - start))
@@ -0,0 +1,69 @@
+import hashlib
+import io
+import os
+import tarfile
+
+import pytest
+
+from hipaacrates import context, crate
+
+@pytest.fixture
+def workdir(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    os.makedirs(os.path.join("app", "lib"))
+    with open(os.path.join("app", "main.py"), "w") as f:
+        f.write("print('hi')\n")
+    with open(os.path.join("app", "lib", "util.py"), "w") as f:
+        f.write("")
+    with open("run.sh", "w") as f:
+        f.write("#!/bin/sh\n")
+    os.chmod("run.sh", 0o700)
+    os.symlink("main.py", os.path.join("app", "entry.py"))
+    return tmpdir
+
+def write_tar(crates, dockerfile="FROM scratch\n", scripts=None):
+    out = io.BytesIO()
+    digest = context.write(out, dockerfile, scripts or {}, crates)
+    return out.getvalue(), digest
+
+def test_write(workdir):
+    crates = [
+        crate.new("foo", "0.0.1", includes=["app/"], run_command="python app/main.py"),
+        crate.new("bar", "0.0.1", includes=["./run.sh", "app/lib"]),
+    ]
+    data, digest = write_tar(crates, scripts={"foo": "#!/bin/sh\n\npython app/main.py"})
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        members = tar.getmembers()
+        assert [m.name for m in members] == [
+            ".hipaacrates/foo.sh", "Dockerfile", "app", "app/entry.py", "app/lib", "app/lib/util.py",
+            "app/main.py", "run.sh",
+        ]
+        by_name = dict((m.name, m) for m in members)
+        assert all(m.mtime == 0 and m.uid == 0 and m.gid == 0 for m in members)
+        assert by_name["run.sh"].mode == 0o755
+        assert by_name["app/main.py"].mode == 0o644
+        assert by_name["app/entry.py"].issym() and by_name["app/entry.py"].linkname == "main.py"
+        assert by_name["app"].isdir()
+        assert tar.extractfile("Dockerfile").read() == b"FROM scratch\n"
+        assert tar.extractfile(".hipaacrates/foo.sh").read() == b"#!/bin/sh\n\npython app/main.py\n"
+        assert tar.extractfile("app/main.py").read() == b"print('hi')\n"
+
+    assert digest == hashlib.sha256(data).hexdigest()
+
+def test_write_is_deterministic(workdir):
+    crates = [crate.new("foo", "0.0.1", includes=["app", "run.sh"])]
+    first, digest = write_tar(crates)
+    os.utime(os.path.join("app", "main.py"), (1, 1))
+    second, _ = write_tar(list(reversed(crates)))
+    assert first == second
+
+    with open(os.path.join("app", "main.py"), "a") as f:
+        f.write("# changed\n")
+    assert write_tar(crates)[1] != digest
+
+def test_write_missing_include(workdir):
+    with pytest.raises(context.ContextError):
+        write_tar([crate.new("foo", "0.0.1", includes=["missing.txt"])])
+    with pytest.raises(context.ContextError):
+        write_tar([crate.new("foo", "0.0.1", includes=["../outside"])])
@@ -189,3 +189,120 @@ def test_crate_equality():
     crate2 = deepcopy(crate1)
 
     assert crate1 == crate2
+
+def test_read_yaml_cached(tmpdir, cratetext, monkeypatch):
+    p = tmpdir.join("example.yaml")
+    p.write(cratetext)
+
+    first = crate.read_yaml(str(p))
+    monkeypatch.setattr(crate, "parse", lambda text: pytest.fail("cached file was parsed again"))
+    second = crate.read_yaml(str(p))
+    assert second == first
+
+    # Callers get their own copy to modify
+    second.bundles.append("another")
+    assert crate.read_yaml(str(p)) == first
+
+def test_read_yaml_detects_changes(tmpdir, cratetext):
+    p = tmpdir.join("example.yaml")
+    p.write(cratetext)
+    assert crate.read_yaml(str(p)).author == "me"
+
+    p.write(cratetext.replace("author: me", "author: someone else"))
+    assert crate.read_yaml(str(p)).author == "someone else"
+
+def test_read_yaml_after_to_yaml(tmpdir):
+    p = str(tmpdir.join("example.yaml"))
+    crate.new("mycrate", "0.0.1", author="ab").to_yaml(p)
+    assert crate.read_yaml(p).author == "ab"
+
+    # Same size, and possibly the same mtime on coarse filesystems
+    crate.new("mycrate", "0.0.1", author="cd").to_yaml(p)
+    assert crate.read_yaml(p).author == "cd"
+
+def test_read_yaml_cache_size(tmpdir, monkeypatch):
+    monkeypatch.setattr(crate, "READ_CACHE_SIZE", 2)
+    crate.clear_cache()
+    for i in range(5):
+        p = str(tmpdir.join("crate{}".format(i)))
+        crate.new("crate{}".format(i), "0.0.1").to_yaml(p)
+        crate.read_yaml(p)
+    assert len(crate._read_cache) == 2
+
+def test_frozen_crate():
+    c = crate.new("mycrate", "0.0.1", author="me", bundles=["foo", "bar"], includes=["src/"])
+    frozen = c.freeze()
+
+    assert isinstance(frozen, crate.Crate)
+    assert frozen == c
+    assert frozen.bundles == ("foo", "bar")
+    assert frozen.includes == ("src/",)
+    assert frozen.freeze() is frozen
+    with pytest.raises(AttributeError):
+        frozen.bundles = ["baz"]
+    with pytest.raises(AttributeError):
+        frozen.something = "else"
+
+def test_frozen_crate_hash_and_digest():
+    a = crate.new("mycrate", "0.0.1", bundles=["foo"]).freeze()
+    b = crate.parse(a.to_yaml()).freeze()
+    c = a.replace(version="0.0.2")
+
+    assert a == b
+    assert hash(a) == hash(b)
+    assert a.digest == b.digest
+    assert len({a, b, c}) == 2
+    assert c.digest != a.digest
+    assert c.version == "0.0.2"
+    assert c.bundles == a.bundles
+
+def test_frozen_crate_replace():
+    a = crate.new("mycrate", "0.0.1", bundles=["foo"]).freeze()
+    b = a.replace(bundles=["bar", "baz"])
+    assert isinstance(b, crate.FrozenCrate)
+    assert b.bundles == ("bar", "baz")
+    assert a.bundles == ("foo",)
+    with pytest.raises(TypeError):
+        a.replace(colour="blue")
+
+def test_frozen_crate_thaw_and_copy():
+    frozen = crate.new("mycrate", "0.0.1", bundles=["foo"]).freeze()
+    thawed = frozen.thaw()
+    thawed.bundles.append("bar")
+    assert thawed.bundles == ["foo", "bar"]
+    assert frozen.bundles == ("foo",)
+    assert deepcopy(frozen) == frozen
+
+def test_crate_has_no_instance_dict():
+    assert not hasattr(crate.new("mycrate", "0.0.1"), "__dict__")
+    assert not hasattr(crate.new("mycrate", "0.0.1").freeze(), "__dict__")
+
+def test_read_yaml_frozen(tmpdir, cratetext):
+    p = tmpdir.join("example.yaml")
+    p.write(cratetext)
+
+    first = crate.read_yaml(str(p), frozen=True)
+    assert isinstance(first, crate.FrozenCrate)
+    assert crate.read_yaml(str(p), frozen=True) is first
+    assert not isinstance(crate.read_yaml(str(p)), crate.FrozenCrate)
+
+def test_crate_volatility():
+    c = crate.new("foo", "0.0.1")
+    assert c.volatility is None
+    assert "volatility" not in c.to_yaml()
+
+    hinted = crate.parse(crate.new("foo", "0.0.1", volatility=3).to_yaml())
+    assert hinted.volatility == 3
+    assert hinted != c
+    assert c.freeze().replace(volatility=3) == hinted.freeze()
+    assert c.freeze().replace(volatility=3).digest != c.freeze().digest
+
+def test_crate_builder():
+    c = crate.new("foo", "0.0.1", builder=dict(image="golang:1.11", build_steps=["go build"], artifacts=["app"]))
+    assert c.builder == crate.Builder("golang:1.11", ["go build"], ["app"])
+
+    parsed = crate.parse(c.to_yaml())
+    assert parsed == c
+    assert hash(parsed.freeze()) == hash(c.freeze())
+    assert parsed.freeze().thaw().builder == c.builder
+    assert "builder" not in crate.new("foo", "0.0.1").to_yaml()
@@ -1,3 +1,5 @@
+import os
+
 import pytest
 
 from hipaacrates import bundles, crate, dockerfile
@@ -113,3 +115,158 @@ RUN chmod a+x /etc/service/{name}/run
 
     df = dockerfile.make(crate_obj, deps)
     assert df == expected
+
+def test_chain_build_steps(crate_obj):
+    assert dockerfile.chain_build_steps(crate_obj) == "RUN make \\\n    && make install"
+
+    crate_obj.build_steps = ["apt install foo \\\n&& rm -rf hmm\n", "", "make"]
+    assert dockerfile.chain_build_steps(crate_obj) == "RUN ( apt install foo \\\n&& rm -rf hmm ) \\\n    && make"
+
+    crate_obj.build_steps = []
+    assert dockerfile.chain_build_steps(crate_obj) == ""
+
+def test_chain_build_steps_keeps_step_semantics(crate_obj):
+    crate_obj.build_steps = ["make", "make test || true", "cd build", "make install; echo done"]
+    assert dockerfile.chain_build_steps(crate_obj) == (
+        "RUN make \\\n    && ( make test || true ) \\\n    && ( cd build ) \\\n    && ( make install; echo done )"
+    )
+
+    crate_obj.build_steps = ["make", "make install # as root", "echo 'C#' | tee lang"]
+    assert dockerfile.chain_build_steps(crate_obj) == (
+        "RUN make\nRUN make install # as root\nRUN ( echo 'C#' | tee lang )"
+    )
+
+def test_make_optimized(crate_obj):
+    expected = """FROM {}
+LABEL maintainer "{}"
+LABEL version "{v}"
+# Hipaacrate bundle foo, version 0.0.1
+WORKDIR {wp}/foo
+COPY foobar.txt {wp}/foo/
+RUN bar \\
+    && baz
+COPY .hipaacrates/foo.sh /etc/service/foo/run
+# Hipaacrate bundle {name}, version {v}
+WORKDIR {wp}/{name}
+COPY myapp/ tests/ {wp}/{name}/
+RUN make \\
+    && make install
+COPY .hipaacrates/{name}.sh /etc/service/{name}/run
+RUN chmod a+x /etc/service/foo/run /etc/service/{name}/run
+""".format(dockerfile.DEFAULT_BASE_IMAGE, crate_obj.author, name=crate_obj.name,
+           v=crate_obj.version, wp=dockerfile.WORKDIR_PREFIX)
+
+    loader = MockBundleLoader()
+    deps = [loader.load(b) for b in crate_obj.bundles]
+
+    df = dockerfile.make(crate_obj, deps, options=dockerfile.RenderOptions(optimize=True))
+    assert df == expected
+
+def test_make_collapse_scripts(crate_obj):
+    loader = MockBundleLoader()
+    deps = [loader.load(b) for b in crate_obj.bundles]
+    deps.append(crate.new("quiet", "0.0.1"))
+    crate_obj.bundles.append("quiet")
+
+    df = dockerfile.make(crate_obj, deps, options=dockerfile.RenderOptions(collapse_scripts=True))
+    assert ".hipaacrates/foo.sh /etc/service" not in df
+    assert df.endswith("""COPY .hipaacrates/foo.sh .hipaacrates/{name}.sh /etc/service/
+RUN cd /etc/service \\
+    && mkdir -p foo && mv foo.sh foo/run \\
+    && mkdir -p {name} && mv {name}.sh {name}/run \\
+    && chmod a+x foo/run {name}/run
+""".format(name=crate_obj.name))
+    assert df.count("COPY .hipaacrates") == 1
+    assert df == dockerfile.make(crate_obj, deps, options=dockerfile.RenderOptions(collapse_scripts=True))
+
+def test_make_services_layer_no_services():
+    assert dockerfile.make_services_layer([crate.new("quiet", "0.0.1")]) == ""
+
+def test_make_coalesce_and_dedupe(crate_obj):
+    foo = crate.new("foo", "0.0.1", build_steps=["apt-get update", "apt-get install -y curl", "bar"])
+    bar = crate.new("bar", "0.0.1", build_steps=["apt-get update", "apt-get install -y curl git"])
+    crate_obj.bundles = ["foo", "bar"]
+    crate_obj.build_steps = ["apt-get update", "apt-get install -y git"] + crate_obj.build_steps
+
+    options = dockerfile.RenderOptions(dedupe=True, coalesce=True)
+    df = dockerfile.make(crate_obj, [foo, bar], options=options)
+    assert df.startswith("""FROM {}
+LABEL maintainer "{}"
+LABEL version "{v}"
+# Hipaacrate packages for bar, foo
+RUN apt-get update -q \\
+    && apt-get install -y curl git \\
+    && rm -rf /var/lib/apt/lists/*
+# Hipaacrate bundle bar, version 0.0.1
+WORKDIR {wp}/bar
+""".format(dockerfile.DEFAULT_BASE_IMAGE, crate_obj.author, v=crate_obj.version, wp=dockerfile.WORKDIR_PREFIX))
+    assert df.count("apt-get") == 2
+    assert "RUN bar\n" in df
+    assert "RUN make\nRUN make install\n" in df
+
+    plain = dockerfile.make(crate_obj, [foo, bar])
+    assert plain.count("apt-get update") == 3
+
+def test_make_buildkit(crate_obj):
+    foo = crate.new("foo", "0.0.1", build_steps=["apt-get update", "apt-get install -y curl", "bar"],
+                    includes=["foobar.txt"])
+    crate_obj.build_steps = ["pip install six"] + crate_obj.build_steps
+
+    df = dockerfile.make(crate_obj, [foo], options=dockerfile.RenderOptions(buildkit=True))
+    lines = df.splitlines()
+    assert lines[0] == "# syntax={}".format(dockerfile.BUILDKIT_SYNTAX)
+    assert lines[1] == "FROM {}".format(dockerfile.DEFAULT_BASE_IMAGE)
+    assert "RUN rm -f /etc/apt/apt.conf.d/docker-clean \\" in lines
+    assert "RUN {} apt-get install -y curl".format(dockerfile.APT_CACHE_MOUNT) in lines
+    assert "RUN {} pip install six".format(dockerfile.PIP_CACHE_MOUNT) in lines
+    assert "RUN bar" in lines
+    assert "COPY --link foobar.txt {}/foo/".format(dockerfile.WORKDIR_PREFIX) in lines
+    assert "COPY .hipaacrates/{0}.sh /etc/service/{0}/run".format(crate_obj.name) in lines
+
+    plain = dockerfile.make(crate_obj, [foo])
+    assert "--mount" not in plain and "--link" not in plain and "# syntax" not in plain
+
+def test_make_builder_stage(crate_obj):
+    foo = crate.new("foo", "0.0.1", builder=dict(
+        image="golang:1.11",
+        build_steps=["go get ./...", "go build -o app"],
+        artifacts=["app", "/go/bin/tool"],
+    ), includes=["src/"])
+
+    df = dockerfile.make(crate_obj, [foo])
+    assert df.startswith("""# Hipaacrate builder for bundle foo
+FROM golang:1.11 AS foo-builder
+WORKDIR {wp}/foo
+COPY src/ {wp}/foo/
+RUN go get ./...
+RUN go build -o app
+FROM {}
+""".format(dockerfile.DEFAULT_BASE_IMAGE, wp=dockerfile.WORKDIR_PREFIX))
+    # Relative artifacts come from the builder's WORKDIR, absolute ones as written
+    assert "COPY src/ {wp}/foo/\nCOPY --from=foo-builder {wp}/foo/app /go/bin/tool {wp}/foo/\n".format(
+        wp=dockerfile.WORKDIR_PREFIX) in df
+
+    options = dockerfile.RenderOptions(optimize=True, buildkit=True)
+    df = dockerfile.make(crate_obj, [foo], options=options)
+    assert "RUN go get ./... \\\n    && go build -o app\n" in df
+    assert "COPY --link --from=foo-builder {wp}/foo/app /go/bin/tool {wp}/foo/\n".format(
+        wp=dockerfile.WORKDIR_PREFIX) in df
+
+def test_coalesce_keeps_pip_cache_for_buildkit(crate_obj):
+    foo = crate.new("foo", "0.0.1", build_steps=["pip install six"])
+    options = dockerfile.RenderOptions(coalesce=True, buildkit=True)
+    df = dockerfile.make(crate_obj, [foo], options=options)
+    assert "RUN {} pip install six\n".format(dockerfile.PIP_CACHE_MOUNT) in df
+
+def test_include_patterns(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    for path in ["models/a/one.onnx", "models/b/two.onnx", "models/b/test_two.onnx", "app/main.py", "README"]:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        open(path, "w").close()
+
+    c = crate.new("svc", "0.0.1", includes=["README", "app/", "models/**/*.onnx", "!**/test_*"])
+    assert dockerfile.include_files(c) == "\n".join([
+        "COPY README app {wp}/svc/",
+        "COPY models/a {wp}/svc/models/a/",
+        "COPY models/b/two.onnx {wp}/svc/models/b/",
+    ]).format(wp=dockerfile.WORKDIR_PREFIX)
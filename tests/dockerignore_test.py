@@ -0,0 +1,38 @@
+from hipaacrates import crate, dockerignore
+
+def test_make():
+    crates = [
+        crate.new("foo", "0.0.1", includes=["./foo.txt", "shared/"]),
+        crate.new("bar", "0.0.1", includes=["shared", "/abs/path", "data[1]*.csv", "../outside"]),
+        crate.new("baz", "0.0.1", includes=["models/**/*.onnx", "!models/**/test_*"]),
+    ]
+    assert dockerignore.make(crates) == "\n".join([
+        dockerignore.GENERATED_HEADER,
+        "*",
+        "!Dockerfile",
+        "!.hipaacrates/*.sh",
+        "!abs/path",
+        "!data[1]*.csv",
+        "!foo.txt",
+        "!models/**/*.onnx",
+        "!shared",
+    ]) + "\n"
+
+def test_make_whole_directory():
+    crates = [crate.new("foo", "0.0.1", includes=["foo.txt", "./"])]
+    assert dockerignore.make(crates) == dockerignore.GENERATED_HEADER + "\n"
+
+def test_make_file(tmpdir):
+    path = str(tmpdir.join(".dockerignore"))
+    crates = [crate.new("foo", "0.0.1", includes=["foo.txt"])]
+
+    assert dockerignore.make_file(crates, filepath=path)
+    assert dockerignore.is_generated(path)
+    assert not dockerignore.make_file(crates, filepath=path)
+
+    with open(path, "w") as f:
+        f.write("*.log\n")
+    assert not dockerignore.is_generated(path)
+    assert not dockerignore.make_file(crates, filepath=path)
+    with open(path) as f:
+        assert f.read() == "*.log\n"
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from hipaacrates import crate, hashing
+
+@pytest.fixture
+def workdir(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    os.makedirs("models")
+    for name, content in [("a.onnx", b"a" * 10), ("b.onnx", b"b" * 10)]:
+        with open(os.path.join("models", name), "wb") as f:
+            f.write(content)
+    with open("app.py", "w") as f:
+        f.write("print('hi')\n")
+    # Old enough for their digests to be cached
+    for path in ["app.py", os.path.join("models", "a.onnx"), os.path.join("models", "b.onnx")]:
+        os.utime(path, (1000000000, 1000000000))
+    return tmpdir
+
+def test_hash_file_mmap(tmpdir, monkeypatch):
+    path = str(tmpdir.join("big"))
+    with open(path, "wb") as f:
+        f.write(b"x" * 4096)
+    small = hashing.hash_file(path)
+    monkeypatch.setattr(hashing, "HASHING_MMAP_THRESHOLD", 1024)
+    assert hashing.hash_file(path) == small
+
+def test_file_hasher_cache(workdir, monkeypatch):
+    hasher = hashing.FileHasher()
+    paths = ["app.py", os.path.join("models", "a.onnx"), os.path.join("models", "b.onnx")]
+    digests = hasher.digest_many(paths)
+    assert hasher.misses == 3
+    hasher.save()
+    assert os.path.isfile(hashing.HASH_CACHE_FILENAME)
+
+    monkeypatch.setattr(hashing, "hash_file", lambda *args: pytest.fail("file was read"))
+    hasher = hashing.FileHasher()
+    assert hasher.digest_many(paths) == digests
+    assert hasher.hits == 3
+
+def test_file_hasher_skips_recent_files(workdir):
+    with open("fresh.txt", "w") as f:
+        f.write("fresh")
+    hasher = hashing.FileHasher()
+    hasher.digest("fresh.txt")
+    hasher.save()
+
+    hasher = hashing.FileHasher()
+    hasher.digest("fresh.txt")
+    assert hasher.misses == 1
+
+def test_bundle_keys(workdir):
+    crates = [
+        crate.new("models", "0.0.1", includes=["models/"]),
+        crate.new("app", "0.0.1", includes=["app.py"], bundles=["models"]),
+    ]
+    keys = hashing.bundle_keys(crates)
+    assert list(keys) == ["models", "app"]
+    image = hashing.image_key("FROM scratch\n", keys)
+
+    with open(os.path.join("models", "b.onnx"), "wb") as f:
+        f.write(b"c" * 10)
+    changed = hashing.bundle_keys(crates, hashing.FileHasher())
+    assert changed["models"] != keys["models"]
+    assert changed["app"] == keys["app"]
+    assert hashing.image_key("FROM scratch\n", changed) != image
+
+    os.chmod("app.py", 0o755)
+    assert hashing.bundle_keys(crates)["app"] != keys["app"]
@@ -0,0 +1,249 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from hipaacrates import bundles, crate, dockerfile, hipaacrates, lockfile
+
+@pytest.fixture
+def workdir(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    return tmpdir
+
+@pytest.fixture
+def repo(workdir):
+    repo = bundles.BundleRepository("", cache_dir=str(workdir.join("bundles")))
+    os.makedirs(repo.cache_dir)
+    crate.new("foo", "0.0.1", bundles=["bar"], build_steps=["make foo"]).to_yaml(os.path.join(repo.cache_dir, "foo"))
+    crate.new("bar", "0.0.1", build_steps=["make bar"]).to_yaml(os.path.join(repo.cache_dir, "bar"))
+    return repo
+
+@pytest.fixture
+def hc(repo):
+    hc = hipaacrates.Hipaacrates(repo)
+    hc.init_file("mycrate", "0.0.1")
+    hc.add_bundles("foo")
+    return hc
+
+def read_dockerfile():
+    with open("Dockerfile") as f:
+        return f.read()
+
+def test_build_dockerfile(hc):
+    hc.build_dockerfile()
+
+    df = read_dockerfile()
+    assert df.index("RUN make bar") < df.index("RUN make foo")
+    assert os.path.isfile(os.path.join(".hipaacrates", "mycrate.sh"))
+
+def test_lock_dependencies(hc):
+    lock = hc.lock_dependencies()
+
+    assert os.path.isfile("Hipaacrate.lock")
+    assert [str(b) for b in lock.bundles] == ["bar:0.0.1", "foo:0.0.1"]
+    assert lockfile.read_yaml("Hipaacrate.lock") == lock
+
+def test_build_dockerfile_locked(hc, repo, monkeypatch):
+    hc.build_dockerfile()
+    expected = read_dockerfile()
+    hc.lock_dependencies()
+    os.remove("Dockerfile")
+
+    monkeypatch.setattr(bundles, "load_dependencies", lambda *args: pytest.fail("graph walked"))
+    monkeypatch.setattr(bundles, "resolve_dependencies", lambda *args: pytest.fail("graph resolved"))
+    hc.build_dockerfile()
+    assert read_dockerfile() == expected
+
+def test_build_dockerfile_locked_uses_pinned_version(hc, repo):
+    repo.store.put("bar", "0.0.1", crate.new("bar", "0.0.1", build_steps=["make bar"]).to_yaml())
+    hc.lock_dependencies()
+    crate.new("bar", "0.0.2", build_steps=["make new bar"]).to_yaml(os.path.join(repo.cache_dir, "bar"))
+
+    hc.build_dockerfile()
+    df = read_dockerfile()
+    assert "RUN make bar" in df
+    assert "make new bar" not in df
+
+def test_build_dockerfile_locked_digest_mismatch(hc, repo):
+    hc.lock_dependencies()
+    crate.new("bar", "0.0.1", build_steps=["make evil bar"]).to_yaml(os.path.join(repo.cache_dir, "bar"))
+
+    with pytest.raises(lockfile.LockfileError) as e:
+        hc.build_dockerfile()
+    assert "bar:0.0.1" in str(e.value)
+
+def test_build_dockerfile_stale_lock(hc):
+    hc.lock_dependencies()
+    hc.add_bundles("bar")
+
+    with pytest.raises(lockfile.LockfileError):
+        hc.build_dockerfile()
+
+def test_build_dockerfile_reports_changes(hc):
+    changed = hc.build_dockerfile()
+    assert sorted(changed) == [".dockerignore", os.path.join(".hipaacrates", "mycrate.sh"), "Dockerfile"]
+    mtime = os.stat("Dockerfile").st_mtime_ns
+
+    assert hc.build_dockerfile() == []
+    assert os.stat("Dockerfile").st_mtime_ns == mtime
+
+def test_build_dockerfile_noop_when_unchanged(hc, monkeypatch):
+    hc.build_dockerfile()
+
+    with monkeypatch.context() as m:
+        m.setattr(crate, "read_yaml", lambda *args, **kwargs: pytest.fail("Hipaacrate was parsed"))
+        assert hc.build_dockerfile() == []
+
+    hc.include_files("app/")
+    assert hc.build_dockerfile() == ["Dockerfile", ".dockerignore"]
+
+def test_build_dockerfile_rebuilds_on_bundle_change(hc, repo):
+    hc.build_dockerfile()
+    crate.new("bar", "0.0.1", build_steps=["make better bar"]).to_yaml(os.path.join(repo.cache_dir, "bar"))
+
+    assert hc.build_dockerfile() == ["Dockerfile"]
+    assert "RUN make better bar" in read_dockerfile()
+
+def test_build_dockerfile_force(hc):
+    hc.build_dockerfile()
+    os.remove(os.path.join(".hipaacrates", "mycrate.sh"))
+
+    assert hc.build_dockerfile() == [os.path.join(".hipaacrates", "mycrate.sh")]
+    assert hc.build_dockerfile(force=True) == []
+
+def test_build_dockerfile_options_change_rebuilds(hc):
+    hc.build_dockerfile()
+    assert hc.build_dockerfile(options=dockerfile.RenderOptions(optimize=True)) == ["Dockerfile"]
+    assert "RUN make bar" in read_dockerfile()
+
+def test_build_dockerfile_writes_dockerignore(hc):
+    hc.include_files("app/", "data/models")
+    hc.build_dockerfile()
+
+    with open(".dockerignore") as f:
+        patterns = f.read().splitlines()[1:]
+    assert patterns == ["*", "!Dockerfile", "!.hipaacrates/*.sh", "!app", "!data/models"]
+
+def test_build_dockerfile_keeps_handwritten_dockerignore(hc):
+    with open(".dockerignore", "w") as f:
+        f.write(".git\n")
+
+    assert ".dockerignore" not in hc.build_dockerfile()
+    with open(".dockerignore") as f:
+        assert f.read() == ".git\n"
+
+def test_write_context(hc):
+    with open("app.py", "w") as f:
+        f.write("")
+    hc.include_files("app.py")
+    out = io.BytesIO()
+    hc.write_context(out)
+
+    with tarfile.open(fileobj=io.BytesIO(out.getvalue())) as tar:
+        assert tar.getnames() == [".hipaacrates/mycrate.sh", "Dockerfile", "app.py"]
+        assert "RUN make bar" in tar.extractfile("Dockerfile").read().decode("utf-8")
+    assert not os.path.exists("Dockerfile")
+
+def test_content_keys(hc):
+    with open("app.py", "w") as f:
+        f.write("")
+    hc.include_files("app.py")
+
+    keys = hc.content_keys()
+    assert list(keys.bundles) == ["bar", "foo", "mycrate"]
+    assert hc.content_keys().image == keys.image
+    assert hc.content_keys(options=dockerfile.RenderOptions(optimize=True)).image != keys.image
+
+    with open("app.py", "w") as f:
+        f.write("print('changed')")
+    changed = hc.content_keys()
+    assert changed.bundles["bar"] == keys.bundles["bar"]
+    assert changed.bundles["mycrate"] != keys.bundles["mycrate"]
+
+def test_build_dockerfile_include_patterns(hc):
+    os.makedirs("models")
+    open(os.path.join("models", "a.onnx"), "w").close()
+    open(os.path.join("models", "a.txt"), "w").close()
+    hc.include_files("models/*.onnx")
+    hc.build_dockerfile()
+    assert "COPY models/a.onnx /opt/services/mycrate/models/" in read_dockerfile()
+    assert hc.build_dockerfile() == []
+
+    open(os.path.join("models", "b.onnx"), "w").close()
+    assert hc.build_dockerfile() == ["Dockerfile"]
+    assert "COPY models/a.onnx models/b.onnx /opt/services/mycrate/models/" in read_dockerfile()
+
+def test_include_files_keeps_order(hc):
+    hc.include_files("models/**", "!models/tmp")
+    hc.include_files("app.py", "models/**")
+    assert hc.get_value("includes") == ("models/**", "!models/tmp", "app.py")
+    hc.omit_files("!models/tmp")
+    assert hc.get_value("includes") == ("models/**", "app.py")
+
+def test_set_value_saves(hc):
+    assert hc.set_value("version", "0.0.2") == "0.0.1"
+    assert crate.read_yaml("Hipaacrate").version == "0.0.2"
+
+def test_transaction(hc, monkeypatch):
+    writes = []
+    save = hc._save_crate
+    monkeypatch.setattr(hc, "_save_crate", lambda c: writes.append(c) or save(c))
+
+    with hc.transaction() as txn:
+        txn.add_bundles("bar")
+        txn.include_files("app/")
+        txn.set_value("author", "me")
+        assert txn.get_value("bundles") == ("bar", "foo")
+    assert len(writes) == 1
+    c = crate.read_yaml("Hipaacrate")
+    assert (c.bundles, c.includes, c.author) == (["bar", "foo"], ["app/"], "me")
+
+    with hc.transaction():
+        pass
+    assert len(writes) == 1
+
+def test_transaction_rolls_back(hc):
+    with pytest.raises(ValueError):
+        with hc.transaction() as txn:
+            txn.add_bundles("bar")
+            txn.remove_bundles("missing")
+    assert crate.read_yaml("Hipaacrate").bundles == ["foo"]
+
+def test_apply_operations(hc):
+    operations = hipaacrates.parse_operations("""
+# provisioning
+add bar baz
+include 'models/**/*.onnx' '!models/tmp'
+set run_command "python -m app"
+remove baz
+""")
+    assert [number for number, _ in operations] == [3, 4, 5, 6]
+    with hc.transaction() as txn:
+        for _, words in operations:
+            txn.apply(*words)
+
+    c = crate.read_yaml("Hipaacrate")
+    assert c.bundles == ["bar", "foo"]
+    assert c.includes == ["models/**/*.onnx", "!models/tmp"]
+    assert c.run_command == "python -m app"
+
+def test_apply_rejects_bad_operations(hc):
+    with hc.transaction() as txn:
+        for words in [["frobnicate"], ["set", "bundles", "x"], ["set", "version"], ["add"]]:
+            with pytest.raises(ValueError):
+                txn.apply(*words)
+    with pytest.raises(ValueError):
+        hipaacrates.parse_operations("add 'unterminated")
+
+def test_reads_share_the_lock(hc):
+    with hc._shared():
+        assert hc.get_value("name") == "mycrate"
+        with pytest.raises(hipaacrates.HipaacrateLockTimeout):
+            hipaacrates.Hipaacrates(hc.bundle_repo, lock_timeout=0).add_bundles("bar")
+
+def test_lock_is_per_hipaacrate(hc, repo):
+    other = hipaacrates.Hipaacrates(repo, "Other", lock_timeout=0)
+    other.init_file("other", "0.0.1")
+    with hc._exclusive():
+        other.add_bundles("bar")
@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+from hipaacrates import includes
+
+@pytest.fixture
+def workdir(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    for path in [
+        "models/a/one.onnx",
+        "models/a/two.onnx",
+        "models/b/three.onnx",
+        "models/b/test_three.onnx",
+        "models/b/notes.txt",
+        "app/main.py",
+        "app/tmp/cache.bin",
+        ".hipaacrates/build.stamp",
+    ]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(path)
+    return tmpdir
+
+def paths(entries):
+    return [path for path, _, _ in entries]
+
+def test_is_pattern():
+    assert not includes.is_pattern("app/main.py")
+    assert includes.is_pattern("models/**/*.onnx")
+    assert includes.is_pattern("!app/tmp")
+    assert includes.is_pattern("data[0-9].csv")
+
+def test_translate():
+    match = includes._matcher("models/**/*.onnx")
+    assert match("models/one.onnx")
+    assert match("models/a/b/one.onnx")
+    assert not match("models/a/one.onnxx")
+    assert not match("other/models/one.onnx")
+
+    match = includes._matcher("data[!0-9]?.csv")
+    assert match("dataxy.csv")
+    assert not match("data1y.csv")
+    assert not match("datax/.csv")
+
+def test_expand_literals(workdir):
+    assert includes.expand(["app/", "./models/a/one.onnx", "missing/"]) == [
+        ("app", "app", True),
+        ("models/a/one.onnx", "models/a", False),
+        ("missing", "missing", True),
+    ]
+
+def test_expand_glob(workdir):
+    entries = includes.expand(["models/**/*.onnx"])
+    # models/a only holds matches, so it is kept whole
+    assert entries == [
+        ("models/a", ".", True),
+        ("models/b/test_three.onnx", ".", False),
+        ("models/b/three.onnx", ".", False),
+    ]
+
+def test_expand_exclusions(workdir):
+    assert paths(includes.expand(["models/**/*.onnx", "!**/test_*"])) == ["models/a", "models/b/three.onnx"]
+
+    entries = includes.expand(["app/", "!app/tmp"])
+    assert entries == [("app/main.py", "app", False)]
+
+    assert includes.expand(["*", "!models"]) == [("app", ".", True)]
+
+def test_expand_skips_work_dir(workdir):
+    assert ".hipaacrates" not in paths(includes.expand(["*"]))
+
+def test_file_index_scans_each_directory_once(workdir):
+    index = includes.FileIndex()
+    includes.expand(["models/**/*.onnx", "!**/test_*"], index)
+    includes.expand(["models/*/*.txt"], index)
+    assert index.scans == 3
+    assert index.directories() == ["models", "models/a", "models/b"]
+
+def test_file_index_cache(workdir):
+    cache_path = os.path.join(".hipaacrates", "files.json")
+    for d in ["models", "models/a", "models/b"]:
+        os.utime(d, (1000000000, 1000000000))
+
+    index = includes.FileIndex(cache_path=cache_path)
+    expected = includes.expand(["models/**/*.onnx"], index)
+    index.save()
+
+    index = includes.FileIndex(cache_path=cache_path)
+    assert includes.expand(["models/**/*.onnx"], index) == expected
+    assert index.scans == 0
+
+    with open(os.path.join("models", "b", "four.onnx"), "w") as f:
+        f.write("")
+    index = includes.FileIndex(cache_path=cache_path)
+    assert "models/b/four.onnx" in paths(includes.expand(["models/**/*.onnx"], index))
+    assert index.scans == 1
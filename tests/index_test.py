@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from hipaacrates import crate, index
+
+@pytest.fixture
+def directory(tmpdir):
+    for name, deps in [("foo", ["bar"]), ("bar", [])]:
+        crate.new(name, "0.0.1", bundles=deps).to_yaml(str(tmpdir.join(name)))
+    tmpdir.join(".foo.http").write("{}")
+    tmpdir.join("notes.txt").write("- not a bundle")
+    return tmpdir
+
+def test_directory_index_revisions(directory):
+    served = index.DirectoryIndex(str(directory))
+    first = served.scan()
+    assert sorted(first.entries) == ["bar", "foo"]
+    assert first.revision == 1
+    assert first.get("foo").digest == crate.read_yaml(str(directory.join("foo")), frozen=True).digest
+    assert served.scan().revision == 1
+
+    crate.new("foo", "0.0.2", bundles=["bar"]).to_yaml(str(directory.join("foo")))
+    os.remove(str(directory.join("bar")))
+    delta = served.delta(1, first.epoch)
+    assert delta["revision"] == 2
+    assert not delta["full"]
+    assert [(e["name"], e["version"]) for e in delta["bundles"]] == [("foo", "0.0.2")]
+    assert delta["removed"] == ["bar"]
+
+    assert served.delta(2, first.epoch)["bundles"] == []
+    assert served.delta(2, "other epoch")["full"]
+
+def test_repository_index_apply(directory, tmpdir):
+    served = index.DirectoryIndex(str(directory))
+    local = index.RepositoryIndex()
+    changed, removed = local.apply(served.delta(local.revision, local.epoch))
+    assert sorted(e.name for e in changed) == ["bar", "foo"]
+    assert removed == []
+
+    crate.new("baz", "0.0.1").to_yaml(str(directory.join("baz")))
+    os.remove(str(directory.join("bar")))
+    changed, removed = local.apply(served.delta(local.revision, local.epoch))
+    assert [e.name for e in changed] == ["baz"]
+    assert removed == ["bar"]
+    assert list(local.entries) == ["baz", "foo"]
+
+    path = str(tmpdir.join("index.json"))
+    local.save(path)
+    saved = index.read(path)
+    assert (saved.entries, saved.revision, saved.epoch) == (local.entries, local.revision, local.epoch)
+
+    # A server restart starts a new epoch, and a full index that only reports real changes
+    changed, removed = saved.apply(index.DirectoryIndex(str(directory)).delta(saved.revision, saved.epoch))
+    assert (changed, removed) == ([], [])
+
+def test_read_missing_index(tmpdir):
+    assert len(index.read(str(tmpdir.join("missing")))) == 0
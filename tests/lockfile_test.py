@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from hipaacrates import crate, lockfile
+
+@pytest.fixture
+def crate_obj():
+    return crate.new("mycrate", "0.0.1", bundles=["foo", "bar:0.0.2"])
+
+@pytest.fixture
+def resolved():
+    return [
+        crate.new("bar", "0.0.2"),
+        crate.new("foo", "0.0.1", bundles=["bar"]),
+    ]
+
+def test_new(crate_obj, resolved):
+    lock = lockfile.new(crate_obj, resolved)
+
+    assert lock.requires == ["bar:0.0.2", "foo"]
+    assert [str(b) for b in lock.bundles] == ["bar:0.0.2", "foo:0.0.1"]
+    assert lock.bundles[1].digest == resolved[1].freeze().digest
+
+def test_round_trip(tmpdir, crate_obj, resolved):
+    p = str(tmpdir.join("Hipaacrate.lock"))
+    lock = lockfile.new(crate_obj, resolved)
+    lock.to_yaml(p)
+
+    assert lockfile.read_yaml(p) == lock
+
+def test_to_yaml_replaces_atomically(tmpdir, crate_obj, resolved, monkeypatch):
+    p = str(tmpdir.join("Hipaacrate.lock"))
+    lock = lockfile.new(crate_obj, resolved)
+    lock.to_yaml(p)
+
+    def interrupted(src, dst):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(os, "replace", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        lockfile.new(crate_obj, resolved[:1]).to_yaml(p)
+
+    # The old lockfile is intact and no temporary file is left behind
+    assert lockfile.read_yaml(p) == lock
+    assert tmpdir.listdir() == [tmpdir.join("Hipaacrate.lock")]
+
+def test_is_current(crate_obj, resolved):
+    lock = lockfile.new(crate_obj, resolved)
+
+    assert lock.is_current(crate_obj)
+    assert lock.is_current(crate.new("mycrate", "0.0.1", bundles=["bar:0.0.2", "foo"]))
+    assert not lock.is_current(crate.new("mycrate", "0.0.1", bundles=["foo"]))
+
+def test_parse_malformed():
+    with pytest.raises(lockfile.LockfileError):
+        lockfile.parse("bundles:\n- name: foo\n")
@@ -0,0 +1,52 @@
+import threading
+import time
+
+import pytest
+
+from hipaacrates import locking
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join("test.lock"))
+
+def test_shared_locks_overlap(path):
+    lock = locking.ReadWriteLock(path, timeout=1)
+    with lock.shared():
+        with locking.ReadWriteLock(path, timeout=0).shared():
+            pass
+    assert lock.stats.to_dict()["contended"] == 0
+
+def test_exclusive_lock_excludes(path):
+    lock = locking.ReadWriteLock(path, timeout=0.05)
+    with lock.shared():
+        with pytest.raises(locking.LockTimeout):
+            with lock.exclusive():
+                pass
+    with lock.exclusive():
+        with pytest.raises(locking.LockTimeout):
+            with lock.shared():
+                pass
+
+    stats = lock.stats.to_dict()
+    assert (stats["acquired"], stats["timeouts"], stats["contended"]) == (2, 2, 2)
+    assert stats["max_wait"] >= 0.05
+
+def test_waits_for_writer(path):
+    lock = locking.ReadWriteLock(path, timeout=5)
+    held = threading.Event()
+
+    def write():
+        with lock.exclusive():
+            held.set()
+            time.sleep(0.1)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    held.wait()
+    with lock.shared():
+        pass
+    writer.join()
+
+    stats = lock.stats.to_dict()
+    assert stats["contended"] == 1
+    assert stats["max_wait"] > 0
@@ -0,0 +1,29 @@
+import pytest
+
+from hipaacrates import crate, ordering
+
+@pytest.fixture
+def crates():
+    return [
+        crate.new("web", "0.0.1", volatility=10),
+        crate.new("base", "0.0.1", volatility=0),
+        crate.new("logging", "0.0.1"),
+        crate.new("metrics", "0.0.1"),
+    ]
+
+def test_name_order(crates):
+    assert [c.name for c in ordering.NameOrder().sort(crates)] == ["base", "logging", "metrics", "web"]
+
+def test_volatility_order(crates):
+    order = ordering.VolatilityOrder()
+    assert [c.name for c in order.sort(crates)] == ["base", "logging", "metrics", "web"]
+
+    order = ordering.VolatilityOrder({"logging": 3, "base": 50})
+    assert [c.name for c in order.sort(crates)] == ["base", "metrics", "logging", "web"]
+
+def test_new():
+    assert isinstance(ordering.new("name"), ordering.NameOrder)
+    assert ordering.new("volatility").changes == {}
+    assert ordering.new("history", {"foo": 2}).to_dict() == dict(policy="VolatilityOrder", changes={"foo": 2})
+    with pytest.raises(ValueError):
+        ordering.new("random")
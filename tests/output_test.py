@@ -0,0 +1,47 @@
+import os
+import stat
+
+from hipaacrates import output
+
+def test_write_if_changed(tmpdir):
+    p = str(tmpdir.join("out.txt"))
+
+    assert output.write_if_changed(p, b"hello\n")
+    with open(p, "rb") as f:
+        assert f.read() == b"hello\n"
+    mtime = os.stat(p).st_mtime_ns
+    inode = os.stat(p).st_ino
+
+    assert not output.write_if_changed(p, b"hello\n")
+    assert os.stat(p).st_mtime_ns == mtime
+    assert os.stat(p).st_ino == inode
+
+    assert output.write_if_changed(p, b"hullo\n")
+    with open(p, "rb") as f:
+        assert f.read() == b"hullo\n"
+
+def test_write_atomic_leaves_no_temp_files(tmpdir):
+    p = str(tmpdir.join("out.txt"))
+    output.write_atomic(p, b"one")
+    output.write_atomic(p, b"two")
+    assert os.listdir(str(tmpdir)) == ["out.txt"]
+
+def test_write_atomic_keeps_mode(tmpdir):
+    p = str(tmpdir.join("run.sh"))
+    output.write_atomic(p, b"#!/bin/sh\n")
+    os.chmod(p, 0o755)
+    output.write_atomic(p, b"#!/bin/sh\necho hi\n")
+    assert stat.S_IMODE(os.stat(p).st_mode) == 0o755
+
+def test_output_writer(tmpdir):
+    a = str(tmpdir.join("a"))
+    b = str(tmpdir.join("b"))
+    tmpdir.join("stale").write("old")
+
+    writer = output.OutputWriter()
+    assert writer.write(a, "a")
+    assert writer.write(b, b"b")
+    assert not writer.write(a, "a")
+    assert writer.remove(str(tmpdir.join("stale")))
+    assert not writer.remove(str(tmpdir.join("missing")))
+    assert writer.changed == [a, b, str(tmpdir.join("stale"))]
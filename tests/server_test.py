@@ -0,0 +1,134 @@
+import multiprocessing
+import threading
+import time
+
+import pytest
+import requests
+
+from hipaacrates import bundles, crate, index, server
+
+@pytest.fixture
+def served(tmpdir):
+    directory = tmpdir.mkdir("served")
+    for name, deps in [("foo", ["bar"]), ("bar", [])]:
+        crate.new(name, "0.0.1", bundles=deps, build_steps=["make {}".format(name)] * 20).to_yaml(
+            str(directory.join(name)))
+    directory.join(".foo.http").write("{}")
+
+    httpd = server.BundleServer(str(directory), ("127.0.0.1", 0))
+    thread = threading.Thread(target=httpd.serve_forever, kwargs=dict(poll_interval=0.01))
+    thread.start()
+    try:
+        yield "http://127.0.0.1:{}".format(httpd.server_address[1])
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
+
+def test_get_bundle(served):
+    r = requests.get(served + "/bundles/foo")
+    assert r.status_code == 200
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert crate.parse(r.text).name == "foo"
+
+    r = requests.get(served + "/bundles/foo", headers={"If-None-Match": r.headers["ETag"]})
+    assert r.status_code == 304
+
+    for name in ["missing", ".foo.http", "..%2Fserved%2Ffoo"]:
+        assert requests.get(served + "/bundles/" + name).status_code == 404
+
+def test_batch(served):
+    etag = requests.get(served + "/bundles/bar").headers["ETag"]
+    r = requests.post(served + "/bundles:batch", json=dict(bundles=[
+        dict(name="foo"), dict(name="bar", etag=etag), dict(name="missing")]))
+    body = r.json()
+    assert [entry["name"] for entry in body["bundles"]] == ["foo"]
+    assert body["not_modified"] == ["bar"]
+    assert body["missing"] == ["missing"]
+
+    assert requests.post(served + "/bundles:batch", data="nonsense").status_code == 400
+    assert requests.post(served + "/bundles:other", json={}).status_code == 404
+
+def test_repository_against_server(served, tmpdir, monkeypatch):
+    repo = bundles.BundleRepository(served, cache_dir=str(tmpdir.join("cache")))
+    methods = []
+    request = repo.session.request
+    monkeypatch.setattr(repo.session, "request", lambda method, *args, **kwargs: methods.append(method) or
+                        request(method, *args, **kwargs))
+
+    crates = repo.fetch_graph(crate.new("mycrate", "0.0.1", bundles=["foo"]))
+    assert [c.name for c in crates] == ["foo", "bar"]
+    assert methods == ["POST", "POST"]
+
+    repo.fetch_graph(crate.new("mycrate", "0.0.1", bundles=["foo"]), refresh=True)
+    assert repo.load("bar").name == "bar"
+    assert methods == ["POST", "POST", "POST", "POST"]
+
+def test_sync(served, tmpdir):
+    repo = bundles.BundleRepository(served, cache_dir=str(tmpdir.join("cache")))
+    changed, removed = repo.sync()
+    assert sorted(e.name for e in changed) == ["bar", "foo"]
+    assert repo.load("foo").name == "foo"
+
+    crate.new("baz", "0.0.1").to_yaml(str(tmpdir.join("served", "baz")))
+    tmpdir.join("served", "bar").remove()
+    changed, removed = repo.sync(prefetch=False)
+    assert ([e.name for e in changed], removed) == (["baz"], ["bar"])
+    assert index.read(str(tmpdir.join("cache", ".index.json"))).revision == 2
+
+def test_fetch_graph_from_index(served, tmpdir, monkeypatch):
+    repo = bundles.BundleRepository(served, cache_dir=str(tmpdir.join("cache")))
+    repo.sync(prefetch=False)
+    methods = []
+    request = repo.session.request
+    monkeypatch.setattr(repo.session, "request", lambda method, *args, **kwargs: methods.append(method) or
+                        request(method, *args, **kwargs))
+
+    origin = crate.new("mycrate", "0.0.1", bundles=["foo"])
+    assert [c.name for c in repo.fetch_graph(origin)] == ["foo", "bar"]
+    # The whole graph is resolved from the index, so both bundles come in one batch
+    assert methods == ["POST"]
+    assert [c.name for c in repo.fetch_graph(origin)] == ["foo", "bar"]
+    assert methods == ["POST"]
+
+class SlowHandler(server.BundleRequestHandler):
+    def do_GET(self):
+        with self.server.mutex:
+            self.server.gets += 1
+        time.sleep(0.2)
+        super().do_GET()
+
+def _download(url, cache_dir, results):
+    repo = bundles.BundleRepository(url, cache_dir=cache_dir)
+    results.put(repo.download("foo", save_to_disk=True).version)
+
+def test_download_is_single_flight_across_processes(tmpdir):
+    served = tmpdir.mkdir("served")
+    crate.new("foo", "0.0.1").to_yaml(str(served.join("foo")))
+    httpd = server.BundleServer(str(served), ("127.0.0.1", 0))
+    httpd.RequestHandlerClass = SlowHandler
+    httpd.mutex = threading.Lock()
+    httpd.gets = 0
+    thread = threading.Thread(target=httpd.serve_forever, kwargs=dict(poll_interval=0.01))
+    thread.start()
+    try:
+        url = "http://127.0.0.1:{}".format(httpd.server_address[1])
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        processes = [context.Process(target=_download, args=(url, str(tmpdir.join("cache")), results))
+                     for _ in range(4)]
+        for p in processes:
+            p.start()
+        versions = [results.get(timeout=10) for _ in processes]
+        for p in processes:
+            p.join()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
+
+    assert versions == ["0.0.1"] * 4
+    assert httpd.gets == 1
+    # Nothing but the bundle, its validators, the store and the locks
+    assert sorted(tmpdir.join("cache").listdir()) == sorted(
+        tmpdir.join("cache", name) for name in [".foo.http", ".locks", ".store", "foo"])
@@ -1,3 +1,5 @@
+import os
+
 import pytest
 
 from hipaacrates import crate, services
@@ -39,3 +41,23 @@ def test_make_script_empty_run_command(crate_obj):
     statement = services.make_script(crate_obj)
     
     assert statement == ""
+
+def test_to_file(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    scripts = {"foo": "#!/bin/sh\n\nfoo", "bar": "#!/bin/sh\n\nbar"}
+
+    changed = services.to_file(scripts)
+    assert changed == [os.path.join(services.HIPAACRATES_WORK_DIR, "bar.sh"),
+                       os.path.join(services.HIPAACRATES_WORK_DIR, "foo.sh")]
+    assert tmpdir.join(services.HIPAACRATES_WORK_DIR, "foo.sh").read() == "#!/bin/sh\n\nfoo\n"
+
+    assert services.to_file(scripts) == []
+
+def test_to_file_removes_stale_scripts(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    services.to_file({"foo": "#!/bin/sh\n\nfoo", "bar": "#!/bin/sh\n\nbar"})
+    tmpdir.join(services.HIPAACRATES_WORK_DIR, "notes.txt").write("keep me")
+
+    changed = services.to_file({"foo": "#!/bin/sh\n\nfoo"})
+    assert changed == [os.path.join(services.HIPAACRATES_WORK_DIR, "bar.sh")]
+    assert sorted(os.listdir(services.HIPAACRATES_WORK_DIR)) == ["foo.sh", "notes.txt"]
@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+from hipaacrates import output, stamp
+
+SETTINGS = {"version": "0.0.1", "base_image": "phusion/baseimage:0.10.1"}
+
+@pytest.fixture
+def files(tmpdir):
+    tmpdir.join("input").write("in")
+    tmpdir.join("output").write("out")
+    return str(tmpdir.join("input")), str(tmpdir.join("output")), str(tmpdir.join("missing"))
+
+def test_is_current(tmpdir, files):
+    inp, out, missing = files
+    filepath = str(tmpdir.join("stamps", "build.stamp"))
+    stamp.new(SETTINGS, [inp, missing], [out], filepath).write()
+
+    previous = stamp.read(filepath)
+    assert previous.is_current(dict(SETTINGS))
+    assert not previous.is_current(dict(SETTINGS, version="0.0.2"))
+
+def test_is_current_detects_changes(tmpdir, files):
+    inp, out, missing = files
+    s = stamp.new(SETTINGS, [inp, missing], [out], str(tmpdir.join("build.stamp")))
+
+    tmpdir.join("output").write("changed")
+    assert not s.is_current(SETTINGS)
+    tmpdir.join("output").write("out")
+    assert s.is_current(SETTINGS)
+
+    tmpdir.join("missing").write("now it exists")
+    assert not s.is_current(SETTINGS)
+    os.remove(missing)
+
+    os.remove(inp)
+    assert not s.is_current(SETTINGS)
+
+def test_is_current_refreshes_stat(tmpdir, files, monkeypatch):
+    inp, out, missing = files
+    filepath = str(tmpdir.join("build.stamp"))
+    stamp.new(SETTINGS, [inp], [out], filepath).write()
+    output.write_atomic(inp, b"in")
+
+    assert stamp.read(filepath).is_current(SETTINGS)
+
+    monkeypatch.setattr(output, "digest_file", lambda path: pytest.fail("file was hashed"))
+    assert stamp.read(filepath).is_current(SETTINGS)
+
+def test_read_missing_or_corrupt(tmpdir):
+    assert stamp.read(str(tmpdir.join("nope"))) is None
+    tmpdir.join("bad").write("{not json")
+    assert stamp.read(str(tmpdir.join("bad"))) is None
@@ -0,0 +1,124 @@
+from hipaacrates import bundles, crate, steps
+
+def test_parse_step():
+    s = steps.parse_step("apt-get install -y curl git")
+    assert s == steps.PackageStep(("apt-get",), "install", ["-y"], ["curl", "git"])
+    assert s.manager == "apt"
+    assert s.render() == "apt-get install -y curl git"
+
+    s = steps.parse_step("python3 -m pip install --no-cache-dir requests==2.19.1")
+    assert s.manager == "python3 -m pip"
+    assert s.packages == ("requests==2.19.1",)
+
+    assert steps.parse_step("apt-get update -q").action == "update"
+
+def test_parse_step_ignores_shell_syntax():
+    for step in [
+        "apt-get update && apt-get install -y curl",
+        "apt-get install -y $PACKAGES",
+        "pip install -r requirements.txt",
+        "apt-get install -y curl \\\n    git",
+        "make install",
+        "apt-get remove -y curl",
+    ]:
+        assert steps.parse_step(step) is None
+
+def make_levels(*specs):
+    crates = []
+    for name, build_steps, deps in specs:
+        crates.append(crate.new(name, "0.0.1", build_steps=build_steps, bundles=deps))
+    return bundles.group_levels(crates)
+
+def test_coalesce_level():
+    levels = make_levels(
+        ("a", ["apt-get update", "apt-get install -y curl", "pip install six", "make"], []),
+        ("b", ["apt-get update", "apt-get install -y git curl"], []),
+        ("c", ["./configure"], ["a", "b"]),
+    )
+    groups = steps.coalesce(levels)
+    assert len(groups) == 2
+
+    layer, crates = groups[0]
+    assert layer.commands() == [
+        "apt-get update -q",
+        "apt-get install -y curl git",
+        "rm -rf /var/lib/apt/lists/*",
+        "pip install --no-cache-dir six",
+    ]
+    assert [c.build_steps for c in crates] == [("make",), ()]
+
+    layer, crates = groups[1]
+    assert layer.steps == []
+    assert list(crates[0].build_steps) == ["./configure"]
+
+def test_coalesce_keeps_lists_for_later_apt_steps():
+    levels = make_levels(
+        ("a", ["apt-get update", "apt-get install -y curl"], []),
+        ("b", ["make", "apt-get install -y git"], ["a"]),
+    )
+    layer, _ = steps.coalesce(levels)[0]
+    assert not layer.cleanup
+    assert "rm -rf /var/lib/apt/lists/*" not in layer.commands()
+
+    levels = make_levels(
+        ("a", ["apt-get update", "apt-get install -y curl"], []),
+        ("b", ["make", "apt-get update", "apt-get install -y git"], ["a"]),
+    )
+    layer, _ = steps.coalesce(levels)[0]
+    assert layer.cleanup
+
+def test_coalesce_leaves_apt_steps_of_bundles_still_using_apt():
+    levels = make_levels(
+        ("a", ["apt-get update", "apt-get install -y curl", "pip install six", "apt-cache policy curl"], []),
+    )
+    layer, crates = steps.coalesce(levels)[0]
+    assert layer.commands() == ["pip install --no-cache-dir six"]
+    assert list(crates[0].build_steps) == [
+        "apt-get update", "apt-get install -y curl", "apt-cache policy curl",
+    ]
+
+def test_dedupe():
+    a = crate.new("a", "0.0.1", build_steps=["apt-get update", "apt-get install -y curl git", "make"])
+    b = crate.new("b", "0.0.1", build_steps=["apt-get update", "apt-get install -y git vim", "make"])
+    groups = steps.dedupe([(steps.InstallLayer([]), [a, b])])
+    _, (a2, b2) = groups[0]
+    assert a2 is a
+    assert list(b2.build_steps) == ["apt-get install -y vim", "make"]
+
+def test_dedupe_after_removals():
+    a = crate.new("a", "0.0.1", build_steps=["pip install six"])
+    b = crate.new("b", "0.0.1", build_steps=["pip uninstall -y six", "pip install six"])
+    c = crate.new("c", "0.0.1", build_steps=["rm -rf /var/lib/apt/lists/*", "apt-get update", "pip3 install six"])
+    _, crates = steps.dedupe([(steps.InstallLayer([]), [a, b, c])])[0]
+    assert [list(x.build_steps) for x in crates] == [
+        ["pip install six"],
+        ["pip uninstall -y six", "pip install six"],
+        ["rm -rf /var/lib/apt/lists/*", "apt-get update", "pip3 install six"],
+    ]
+
+def test_dedupe_keeps_updates_after_new_apt_sources():
+    a = crate.new("a", "0.0.1", build_steps=["apt-get update", "apt-get install -y curl"])
+    b = crate.new("b", "0.0.1", build_steps=[
+        "echo 'deb https://download.docker.com/linux/ubuntu bionic stable' > /etc/apt/sources.list.d/docker.list",
+        "apt-get update",
+        "apt-get install -y docker-ce",
+    ])
+    c = crate.new("c", "0.0.1", build_steps=["add-apt-repository -y ppa:git-core/ppa && apt-get update",
+                                             "apt-get update", "apt-get install -y git"])
+    _, (a2, b2, c2) = steps.dedupe([(steps.InstallLayer([]), [a, b, c])])[0]
+    assert b2 is b
+    # The repository step updated the lists itself
+    assert list(c2.build_steps) == ["add-apt-repository -y ppa:git-core/ppa && apt-get update", "apt-get install -y git"]
+
+def test_dedupe_coalesced_layers():
+    levels = make_levels(
+        ("a", ["apt-get update", "apt-get install -y curl"], []),
+        ("b", ["apt-get update", "apt-get install -y curl vim"], ["a"]),
+    )
+    groups = steps.dedupe(steps.coalesce(levels))
+    assert groups[0][0].commands() == [
+        "apt-get update -q", "apt-get install -y curl", "rm -rf /var/lib/apt/lists/*",
+    ]
+    assert groups[1][0].commands() == [
+        "apt-get update -q", "apt-get install -y vim", "rm -rf /var/lib/apt/lists/*",
+    ]
@@ -0,0 +1,182 @@
+import collections
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+from hipaacrates import bundles, crate, server, transport
+
+class FaultyHandler(server.BundleRequestHandler):
+    def do_GET(self):
+        self.server.requests += 1
+        if not self._inject():
+            super().do_GET()
+
+    def do_POST(self):
+        self.server.requests += 1
+        if not self._inject():
+            super().do_POST()
+
+    def _inject(self):
+        fault = self.server.faults.popleft() if self.server.faults else None
+        if fault == "error":
+            self._send(503, b"Service Unavailable", "text/plain")
+        elif fault == "hang":
+            time.sleep(0.5)
+            self.close_connection = True
+        elif fault == "reset":
+            self.close_connection = True
+        elif fault == "truncate":
+            # Promise a whole bundle, then drop the connection partway through it
+            self.send_response(200)
+            self.send_header("Content-Length", "100")
+            self.end_headers()
+            self.wfile.write(b"name:")
+            self.close_connection = True
+        return fault is not None
+
+class FaultyServer(server.BundleServer):
+    def __init__(self, directory):
+        super().__init__(directory, ("127.0.0.1", 0))
+        self.RequestHandlerClass = FaultyHandler
+        self.faults = collections.deque()
+        self.requests = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+@pytest.fixture
+def faulty(tmpdir):
+    crate.new("foo", "0.0.1").to_yaml(str(tmpdir.join("foo")))
+    httpd = FaultyServer(str(tmpdir))
+    thread = threading.Thread(target=httpd.serve_forever, kwargs=dict(poll_interval=0.01))
+    thread.start()
+    try:
+        yield httpd
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
+
+@pytest.fixture
+def dead_host():
+    # A port nothing listens on, so connections are refused
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    return "http://127.0.0.1:{}".format(port)
+
+def make_repo(tmpdir, host, **kwargs):
+    repo = bundles.BundleRepository(host, cache_dir=str(tmpdir.join("cache")), batch_size=0, **kwargs)
+    repo.transport.backoff = 0
+    return repo
+
+@pytest.mark.parametrize("fault", ["error", "hang", "reset", "truncate"])
+def test_retries_faults(faulty, tmpdir, fault):
+    faulty.faults.extend([fault, fault])
+    repo = make_repo(tmpdir, faulty.url, timeout=0.2)
+    assert repo.download("foo").name == "foo"
+    assert faulty.requests == 3
+
+def test_gives_up_after_retries(faulty, tmpdir):
+    faulty.faults.extend(["error"] * 10)
+    repo = make_repo(tmpdir, faulty.url, retries=2)
+    with pytest.raises(requests.HTTPError):
+        repo.download("foo")
+    assert faulty.requests == 3
+
+def test_fails_over_to_mirror(faulty, tmpdir, dead_host):
+    repo = make_repo(tmpdir, dead_host, mirrors=[faulty.url], connect_timeout=1)
+    for _ in range(transport.TRANSPORT_FAILURE_THRESHOLD + 2):
+        assert repo.download("foo").name == "foo"
+    primary, mirror = repo.transport.hosts.hosts
+    # After its first failure the primary ranks below the healthy mirror
+    assert primary.failures == 1
+    assert mirror.latency is not None
+    assert faulty.requests == transport.TRANSPORT_FAILURE_THRESHOLD + 2
+
+def test_connection_errors_raise(tmpdir, dead_host):
+    repo = make_repo(tmpdir, dead_host, retries=1, connect_timeout=1)
+    with pytest.raises(requests.ConnectionError):
+        repo.download("foo")
+
+def test_host_pool_circuit_breaker():
+    now = [0.0]
+    pool = transport.HostPool(["http://a", "http://b"], failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+    a, b = pool.hosts
+    assert pool.choose() is a
+
+    pool.failed(a)
+    assert pool.choose() is b
+    assert pool.choose(exclude=["http://b"]) is a
+    pool.failed(a)
+    assert pool.choose(exclude=["http://b"]) is b
+
+    pool.failed(b)
+    pool.failed(b)
+    # Every circuit is open, so the host skipped longest is tried
+    assert pool.choose() is a
+
+    now[0] = 10
+    pool.succeeded(a, 0.1)
+    assert (a.failures, a.opened_at) == (0, None)
+
+def test_host_pool_prefers_faster_hosts():
+    pool = transport.HostPool(["http://a", "http://b"])
+    a, b = pool.hosts
+    pool.succeeded(a, 0.5)
+    pool.succeeded(b, 0.1)
+    assert pool.choose() is b
+    for _ in range(10):
+        pool.succeeded(b, 1.0)
+    assert pool.choose() is a
+
+def test_host_pool_lets_one_probe_through():
+    now = [0.0]
+    pool = transport.HostPool(["http://a", "http://b"], failure_threshold=1, reset_timeout=10, clock=lambda: now[0])
+    a, b = pool.hosts
+    pool.failed(a)
+    now[0] = 10
+
+    # The recovering host gets one probe; every other caller is sent elsewhere
+    assert pool.choose(exclude=["http://b"]) is a
+    assert pool.choose(exclude=["http://b"]) is b
+    pool.failed(a)
+    assert pool.choose(exclude=["http://b"]) is b
+    now[0] = 20
+    assert pool.choose(exclude=["http://b"]) is a
+    pool.succeeded(a, 0.1)
+    assert not a.probing
+    assert pool.choose(exclude=["http://b"]) is a
+
+def test_host_pool_probes_concurrently_once_per_host():
+    pool = transport.HostPool(["http://a", "http://b"], failure_threshold=1, reset_timeout=10)
+    for state in pool.hosts:
+        pool.failed(state)
+
+    barrier = threading.Barrier(8)
+    chosen = []
+    def choose():
+        barrier.wait()
+        try:
+            chosen.append(pool.choose().host)
+        except transport.HostsUnavailable:
+            chosen.append(None)
+    threads = [threading.Thread(target=choose) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Every circuit is open: each host is probed by exactly one caller
+    assert sorted(h for h in chosen if h) == ["http://a", "http://b"]
+    assert chosen.count(None) == 6
+
+def test_unavailable_hosts_raise(tmpdir, dead_host):
+    repo = make_repo(tmpdir, dead_host, retries=0, connect_timeout=1)
+    state = repo.transport.hosts.hosts[0]
+    state.failures, state.opened_at, state.probing = transport.TRANSPORT_FAILURE_THRESHOLD, 0.0, True
+    with pytest.raises(requests.ConnectionError):
+        repo.download("foo")
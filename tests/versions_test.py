@@ -0,0 +1,132 @@
+import random
+import time
+
+import pytest
+
+from hipaacrates import versions
+
+class GraphProvider(object):
+    def __init__(self, graph):
+        self.graph = graph
+        self.calls = 0
+
+    def versions(self, name):
+        self.calls += 1
+        return list(self.graph.get(name, {}))
+
+    def dependencies(self, name, version):
+        self.calls += 1
+        return self.graph[name][version]
+
+def stress_graph(bundles=300, versions_per_bundle=5, fanout=4, seed=0):
+    """
+    A layered graph where version 1.0 of every bundle is compatible, but newer versions conflict
+
+    Each version of a bundle requires a random range of majors of bundles
+    below it, so the newest versions usually clash and the resolver has to
+    backtrack.
+    """
+    rng = random.Random(seed)
+    names = ["b{:03d}".format(i) for i in range(bundles)]
+    graph = {}
+    for i, name in enumerate(names):
+        graph[name] = {}
+        for major in range(1, versions_per_bundle + 1):
+            deps = []
+            for j in rng.sample(range(i), min(fanout, i)):
+                if major == 1:
+                    deps.append("{}:^1.0".format(names[j]))
+                else:
+                    low = rng.randint(1, versions_per_bundle)
+                    deps.append("{}:>={},<{}".format(names[j], low, rng.randint(low, versions_per_bundle) + 1))
+            graph[name]["{}.0".format(major)] = deps
+    return graph, names[-10:]
+
+def check(graph, requirements, chosen):
+    for reference in requirements:
+        name, constraint = versions.parse_reference(reference)
+        assert constraint.allows(chosen[name])
+    for name, version in chosen.items():
+        for reference in graph[name][version]:
+            dep, constraint = versions.parse_reference(reference)
+            assert constraint.allows(chosen[dep]), (name, version, reference, chosen[dep])
+
+def test_version_key():
+    ordered = ["0.9", "1.0-rc.1", "1.0-rc.2", "1.0", "1.0.1", "1.2", "1.10"]
+    assert sorted(ordered, key=versions.version_key) == ordered
+    assert versions.version_key("1.2") == versions.version_key("1.2.0")
+
+@pytest.mark.parametrize("text, allowed, denied", [
+    ("", ["0.1", "9.9"], []),
+    ("1.2.3", ["1.2.3"], ["1.2.4"]),
+    ("=1.2", ["1.2.0"], ["1.2.1"]),
+    (">=1.0, <2", ["1.0", "1.9.9"], ["0.9", "2.0"]),
+    ("!=1.5", ["1.4"], ["1.5"]),
+    ("^1.2.3", ["1.2.3", "1.9"], ["1.2.2", "2.0"]),
+    ("^0.2.3", ["0.2.3", "0.2.9"], ["0.3.0"]),
+    ("^0.0.3", ["0.0.3"], ["0.0.4"]),
+])
+def test_constraint(text, allowed, denied):
+    constraint = versions.Constraint(text)
+    assert all(constraint.allows(v) for v in allowed)
+    assert not any(constraint.allows(v) for v in denied)
+
+def test_invalid_constraint():
+    with pytest.raises(versions.ConstraintError):
+        versions.Constraint(">=1.0 <2")
+
+def test_resolve_backtracks():
+    graph = {
+        "app": {"1.0": ["web:^2", "db"]},
+        "web": {"2.0": ["lib:^1"], "2.1": ["lib:^2"]},
+        "db": {"1.0": ["lib:<2"], "1.1": ["lib:>=3"]},
+        "lib": {"1.0": [], "1.5": [], "2.0": []},
+    }
+    chosen = versions.Resolver(GraphProvider(graph)).resolve(["app"])
+    assert dict(chosen) == {"app": "1.0", "web": "2.0", "db": "1.0", "lib": "1.5"}
+    check(graph, ["app"], chosen)
+
+def test_resolve_explains_conflicts():
+    graph = {
+        "web": {"1.0": ["lib:^2"]},
+        "lib": {"1.0": [], "1.5": []},
+    }
+    with pytest.raises(versions.ResolutionError) as e:
+        versions.Resolver(GraphProvider(graph)).resolve(["web", "lib:^1"], "mycrate")
+    assert str(e.value) == "no version of lib satisfies ^1 (required by mycrate), ^2 (required by web 1.0); " \
+        "available: 1.0, 1.5"
+
+    with pytest.raises(versions.ResolutionError) as e:
+        versions.Resolver(GraphProvider(graph)).resolve(["missing:^1"], "mycrate")
+    assert "no versions of missing" in str(e.value)
+
+def test_resolve_deep_chain():
+    depth = 5000
+    graph = dict(("b{}".format(i), {"1.0": ["b{}".format(i + 1)]}) for i in range(depth))
+    graph["b{}".format(depth)] = {"1.0": []}
+    chosen = versions.Resolver(GraphProvider(graph)).resolve(["b0"])
+    assert len(chosen) == depth + 1
+
+def test_resolve_stress():
+    graph, requirements = stress_graph()
+    provider = GraphProvider(graph)
+    resolver = versions.Resolver(provider)
+    chosen = resolver.resolve(requirements)
+
+    check(graph, requirements, chosen)
+    # Every version and dependency list is read from the provider at most once
+    assert provider.calls <= len(graph) * 6
+    # Backjumping keeps the search close to one step per bundle
+    assert resolver.steps <= len(graph) * 2
+
+if __name__ == "__main__":
+    # A standalone benchmark, timed on graphs of growing size; from the
+    # repository root: PYTHONPATH=. python tests/versions_test.py
+    for size in [100, 300, 1000]:
+        for per in [3, 5, 10]:
+            graph, requirements = stress_graph(size, per)
+            resolver = versions.Resolver(GraphProvider(graph))
+            start = time.perf_counter()
+            chosen = resolver.resolve(requirements)
+            print("{:5} bundles x {:2} versions: {:4} decided in {:7.3f}s, {} steps".format(
+                size, per, len(chosen), time.perf_counter() - start, resolver.steps))